@@ -4,107 +4,3286 @@
 #
 # Usage:
 # See print_usage() below.
+# Can also be imported: TreeBackup.plan() yields the operations a backup
+# would carry out, and TreeBackup.run() carries them out.  A metadata file
+# in <dst-dir> that can't be opened raises MetaError.
 #
 # Modification History:
+# 10/16/2026 - Tom Kerr
+# Added --verify option to hash files as they are copied and keep the
+# hashes in <dst-dir>, and --verify-read to also read back each copy.
+# Mismatches are counted.
+#
+# 10/16/2026 - Tom Kerr
+# Split the backup into a planner that yields a stream of operations and
+# an executor that carries them out, so backup.py can be imported.  -d
+# prints the plan.  Moved the run counters and the command line into
+# Counts and main().
+#
+# 10/16/2026 - Tom Kerr
+# Added --scan-jobs option to list and stat the source and destination
+# directories ahead of the walk with a pool of threads.
+#
+# 10/16/2026 - Tom Kerr
+# Accept several destination directories.  The source is scanned once and
+# each file copied to several destinations is read once.  Counts are
+# printed for each destination.
+#
+# 10/16/2026 - Tom Kerr
+# Added --watch option to keep running and back up changes as inotify
+# reports them, with --debounce and --rescan to tune it.  Moved the walk
+# into the TreeBackup class so it can back up just the changed directories.
+#
+# 10/16/2026 - Tom Kerr
+# Added --stats option to write phase timing and throughput statistics as
+# JSON, and --progress option to show a live progress line.
+#
+# 10/16/2026 - Tom Kerr
+# Write copies to a temporary file and rename them into place.  Keep a
+# journal of finished directories in <dst-dir>, and added --resume option
+# to skip them after an interrupted run.
+#
+# 10/16/2026 - Tom Kerr
+# Added --detect-moves option to rename moved files in <dst-dir> during a
+# sync instead of copying them again.
+#
+# 10/16/2026 - Tom Kerr
+# Added --snapshot option for deduplicated, hard linked dated snapshots,
+# and --keep and --prune to expire old ones.
+#
+# 10/16/2026 - Tom Kerr
+# Added --checksum option to compare files by content, with a hash cache.
+#
+# 10/16/2026 - Tom Kerr
+# Added --delta option to rewrite only the changed blocks of large files.
+# Report the number of bytes written.
+#
+# 10/16/2026 - Tom Kerr
+# Copy file data with reflink, copy_file_range or sendfile when possible,
+# keeping sparse files sparse.  Added -r option to report the method used.
+#
+# 10/16/2026 - Tom Kerr
+# Compile the -x exclude list once, with glob support, and prune excluded
+# directories from the walk instead of excluding their files one by one.
+#
+# 10/16/2026 - Tom Kerr
+# Walk the source and destination trees together with os.scandir.
+#
+# 10/16/2026 - Tom Kerr
+# Added -m option to keep a manifest of backed up files in <dst-dir>.
+#
+# 10/16/2026 - Tom Kerr
+# Added -j option to copy files with a pool of worker threads.
+# Converted to Python 3.
+#
 # 04/19/2015 - Tom Kerr
 # Modified indents to use tabs throughout.
 # Modified to exclude directories when file paths end in a slash.
 #
-# 09/29/2015 - Tom Kerr
-# Added -x option to exclude files from backup.
+# 09/29/2015 - Tom Kerr
+# Added -x option to exclude files from backup.
+#
+# 09/15/2015 - Tom Kerr
+# Remove destination directories during sync that don't exist in source tree.
+#
+# 09/10/2015 - Tom Kerr
+# Created.
+##############################################################################
+
+##############################################################################
+# NOTE:
+# Indentation is important to Python files.
+# This file uses tabs for indentation.  Please set your editor accordingly.
+# I use Notepad++ with 4-space tabs.
+##############################################################################
+
+import concurrent.futures
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import functools
+import getopt
+import hashlib
+import heapq
+import json
+import os.path
+import queue
+import re
+import select
+import shutil
+import signal
+import sqlite3
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None  # Not available on Windows
+
+# Backup metadata such as the manifest is kept in this directory under
+# <dst-dir>.  It is never copied to or deleted from by a sync.
+META_DIR      = ".backup-meta"
+MANIFEST_FILE = "manifest.db"
+HASHES_FILE   = "hashes.db"
+JOURNAL_FILE  = "journal"
+
+# Copies are written in this directory under META_DIR, with this prefix,
+# and renamed into place when complete.  Being outside the mirrored tree,
+# the names can't clash with source files.
+TMP_DIR       = "tmp"
+TMP_PREFIX    = ".backup-tmp-"
+
+# Snapshot layout.  See run_snapshot().
+OBJECTS_DIR      = "objects"
+SNAPSHOTS_FILE   = "snapshots.db"
+SNAPSHOT_FORMAT  = "%Y-%m-%d_%H%M%S"
+SNAPSHOT_RE      = re.compile(r"^\d{4}-\d{2}-\d{2}_\d{6}(-\d+)?$")
+SNAPSHOT_PARTIAL = ".partial"
+
+# File copy tuning.  See copy_data().
+COPY_BUFSIZE = 1024 * 1024          # read/write buffer for the plain copy
+COPY_CHUNK   = 64 * 1024 * 1024     # bytes per copy_file_range/sendfile call
+FICLONE      = 0x40049409           # Linux ioctl to reflink a whole file
+DELTA_BLOCK  = 256 * 1024           # compare/rewrite unit for --delta
+HASH_CHUNK   = 1024 * 1024          # read size when hashing for --checksum
+COPY_FALLBACK_ERRORS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EBADF,
+	errno.ENOTSUP, errno.EOPNOTSUPP, errno.ETXTBSY, errno.ENOTSOCK)
+
+# --watch tuning.  See watch_tree().
+WATCH_DEBOUNCE  = 2.0       # default seconds without changes before a pass
+WATCH_MAX_DELAY = 60.0      # longest a change waits while more keep arriving
+WATCH_RESCAN    = 3600.0    # default seconds between full passes
+
+# Keeps lines printed by different threads from interleaving.
+output_lock = threading.Lock()
+
+##############################################################################
+# Print usage syntax.
+##############################################################################
+def print_usage():
+	print("Usage:", sys.argv[0], "[-dfhmrsvx] [-j <num>] [--checksum] [--delta=<size>]")
+	print("       [--detect-moves] [--resume] [--scan-jobs=<num>] [--snapshot] [--keep=<num>]")
+	print("       [--verify] [--verify-read]")
+	print("       [--stats=<file>] [--progress] [--watch [--debounce=<sec>] [--rescan=<sec>]]")
+	print("       <src-dir> <dst-dir> [<dst-dir> ...]")
+	print("   or:", sys.argv[0], "--prune --keep=<num> [-dv] <dst-dir>")
+	print("  Copy files from <src-dir> to <dst-dir>")
+	print("  <src-dir> and <dst-dir> are directories.  With several <dst-dir>, the source")
+	print("  is scanned once and each changed file is read once for all of them")
+	print("  --checksum Copy files whose contents differ, instead of comparing")
+	print("            modification times.  Hashes are cached in <dst-dir>")
+	print("  -d = Dry run: print the plan of copies, moves and deletions without")
+	print("            carrying it out")
+	print("  --debounce=<sec> With --watch, wait until there have been no changes for")
+	print("            <sec> seconds before copying them (default = " + str(WATCH_DEBOUNCE) + ")")
+	print("  --delta=<size> Update existing destination files of at least <size>")
+	print("            bytes (e.g. 64M) in place, rewriting only changed blocks")
+	print("  --detect-moves With -s, rename destination files that were moved or")
+	print("            renamed in the source instead of copying and deleting them")
+	print("  -f = Force copy even if destination file is newer")
+	print("  -h = Halt on copy error (default = skip and keep copying)")
+	print("  -j <num> Copy files with <num> parallel workers (default = 1)")
+	print("  --keep=<num> Keep only the newest <num> snapshots (with --snapshot or --prune)")
+	print("  -m = Keep a manifest in <dst-dir> to skip unchanged files quickly")
+	print("  -r = Report the copy method used for each file (reflink, copy_file_range, ...)")
+	print("  --rescan=<sec> With --watch, make a full pass every <sec> seconds to catch")
+	print("            anything missed (default = " + str(WATCH_RESCAN) + ", 0 = never)")
+	print("  --resume Continue an interrupted run, skipping directories it finished")
+	print("            (not with --detect-moves)")
+	print("  -s = Sync: delete files in <dst-dir> that are not in <src-dir>")
+	print("  --scan-jobs=<num> List and stat directories with <num> parallel threads,")
+	print("            for network file systems (default = 1)")
+	print("  --snapshot Write a dated snapshot in <dst-dir>, hard linking files")
+	print("            unchanged since the last snapshot and storing each")
+	print("            distinct file content only once")
+	print("  --prune = Delete old snapshots and their unused file contents")
+	print("  --progress Show a progress line with the copy rate on stderr")
+	print("  --stats=<file> Write timing and throughput statistics to <file> as JSON:")
+	print("            time per phase, MB/s, the slowest files and largest directories")
+	print("  -v = Verbose printing")
+	print("  --verify  Hash files as they are copied and keep the hashes in <dst-dir>.")
+	print("            Files left alone are checked against the source when they")
+	print("            changed since their hash was kept.  Copies go through a")
+	print("            buffer instead of reflink or copy_file_range")
+	print("  --verify-read Like --verify, and also read back each copy from disk")
+	print("  --watch = After the first pass, keep running and copy changes as they")
+	print("            happen, using Linux inotify.  Stop with Ctrl-C")
+	print("  -x <file> Exclude files listed in <file>")
+	print("            Names ending in a slash are directories, and * ? [] are globs.")
+	print("            An excluded directory is not scanned and counts as one file.")
+	sys.exit(2)
+
+
+##############################################################################
+# Print copy, deleted and error counts.
+##############################################################################
+def print_counts(counts, dry_run):
+	if dry_run:
+		print("Dry run results, no actions actually taken")
+	print("Files copied:   " + str(counts["copied"]))
+	if (counts["linked"] > 0):
+		print("Files linked:   " + str(counts["linked"]))
+	if (counts["moved"] > 0):
+		print("Files moved:    " + str(counts["moved"]))
+	print("Files deleted:  " + str(counts["deleted"]))
+	print("Files excluded: " + str(counts["excluded"]))
+	print("Errors:         " + str(counts["errors"]))
+	print("Bytes written:  " + str(counts["bytes"]))
+	if (counts["delta_skipped"] > 0):
+		print("Bytes skipped:  " + str(counts["delta_skipped"]) + " (unchanged blocks)")
+	if (counts["verified"] > 0) or (counts["mismatches"] > 0):
+		print("Files verified: " + str(counts["verified"]))
+		print("Mismatches:     " + str(counts["mismatches"]))
+	if (counts["pruned"] > 0) or (counts["freed"] > 0):
+		print("Snapshots pruned: " + str(counts["pruned"]))
+		print("Objects freed:    " + str(counts["freed"]))
+
+
+##############################################################################
+# Parse a size such as 4096, 64K, 100M or 2G.
+# Returns the size in bytes, or None if it isn't a valid size.
+##############################################################################
+def parse_size(text):
+	units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+	text = str(text).strip().upper().rstrip("B")
+	scale = 1
+	if (len(text) > 0) and (text[-1] in units):
+		scale = units[text[-1]]
+		text = text[:-1]
+	try:
+		return int(float(text) * scale)
+	except ValueError:
+		return None
+
+
+##############################################################################
+# Counts of what a run did, by name: files copied, deleted and so on.
+# Shared by the tree scan and the copy workers, so always update them
+# through count().
+##############################################################################
+class Counts(dict):
+
+	NAMES = ("copied", "deleted", "excluded", "errors", "bytes", "delta_skipped",
+		"linked", "moved", "pruned", "freed", "verified", "mismatches")
+
+	def __init__(self):
+		dict.__init__(self, dict.fromkeys(self.NAMES, 0))
+		self._lock = threading.Lock()
+
+	# Increment a counter.
+	def count(self, name, n=1):
+		with self._lock:
+			self[name] += n
+
+	# A consistent copy of the counts, as a plain dictionary.
+	def copy(self):
+		with self._lock:
+			return dict(self)
+
+
+##############################################################################
+# Print a progress or error message.
+# Keeps lines from the copy workers and the tree scan from interleaving.
+##############################################################################
+def message(text):
+	with output_lock:
+		if (RunStats.shown is not None):
+			RunStats.shown.clear_progress()
+		print(text)
+
+
+##############################################################################
+# Copy one file from source to destination.
+# The destination directory must already exist.  The copy is written in
+# tmp_dir, or beside dfn_abs if that is on another file system (see
+# make_temp()), and renamed into place.  The results are counted with
+# tally, which works like Counts.count().  The data copied is added to
+# hasher, if given, and the copy is timed in stats, a RunStats, if given.
+# Returns True if the copy succeeded, False if an error was reported.
+##############################################################################
+def copy_file(sfn_abs, dfn_abs, tmp_dir, tally, report=False, delta=False, hasher=None,
+		stats=None):
+	tmp_abs = None
+	start = time.perf_counter()
+	try:
+		# Perform the copy.  Same result as shutil.copy2(), but the new
+		# file is written under a temporary name and renamed into place,
+		# so an interrupted copy never leaves a partial file behind.
+		if delta:
+			(strategy, written, unchanged) = delta_copy(sfn_abs, dfn_abs, tmp_dir, hasher)
+			tally("delta_skipped", unchanged)
+			target = dfn_abs
+		else:
+			(fd, tmp_abs) = make_temp(tmp_dir, dfn_abs)
+			os.close(fd)
+			(strategy, written) = copy_data(sfn_abs, tmp_abs, hasher)
+			target = tmp_abs
+		shutil.copystat(sfn_abs, target)
+		os.utime(target, None)          # update destination atime + mtime
+		if (tmp_abs is not None):
+			os.replace(tmp_abs, dfn_abs)
+			tmp_abs = None
+		tally("copied")
+		tally("bytes", written)
+		if (stats is not None):
+			stats.copied(sfn_abs, written, time.perf_counter() - start)
+		if (report):
+			message("Copied " + str(sfn_abs) + " using " + strategy)
+		return True
+
+	except (shutil.Error, OSError) as err:
+		message("Error copying " + str(sfn_abs) + ": " + str(err))
+		tally("errors")
+		return False
+
+	finally:
+		if (tmp_abs is not None):
+			try:
+				os.remove(tmp_abs)
+			except OSError:
+				pass
+
+
+##############################################################################
+# Copy one file from source to several destinations, reading it only once.
+#
+# targets is a list of (dfn_abs, tmp_dir, tally), tally counting the
+# results for that destination like Counts.count().  Each block read is
+# written to every destination at the same time by the writers thread
+# pool, while the next block is read.  Holes in sparse source files are
+# skipped.  A destination that fails is dropped and the others carry on.
+# Each copy is written under a temporary name and renamed into place, like
+# copy_file().  The data read is added to hasher, if given, and the copy
+# is timed in stats, if given.
+#
+# Returns a list of True or False, for whether each copy succeeded.
+##############################################################################
+def copy_file_fanout(sfn_abs, targets, report, writers, hasher=None, stats=None):
+	start = time.perf_counter()
+	outs = [{"dfn_abs": dfn_abs, "tmp_dir": tmp_dir, "tally": tally, "tmp_abs": None, "fd": None,
+		"error": None} for (dfn_abs, tmp_dir, tally) in targets]
+	written = 0
+	try:
+		with open_source(sfn_abs) as fsrc:
+			sfd = fsrc.fileno()
+			for out in outs:
+				try:
+					(out["fd"], out["tmp_abs"]) = make_temp(out["tmp_dir"], out["dfn_abs"])
+				except OSError as err:
+					out["error"] = err
+
+			st = os.fstat(sfd)
+			extents = data_extents(sfd, st)
+			sparse = (extents is not None)
+			if not sparse:
+				extents = [(0, st.st_size)]
+			pending = []
+			offset = 0
+			for (begin, end) in extents:
+				if (hasher is not None):
+					hash_zeros(hasher, begin - offset)
+				offset = begin
+				while (offset < end):
+					block = os.pread(sfd, min(COPY_BUFSIZE, end - offset), offset)
+					if not block:
+						break
+					if (hasher is not None):
+						hasher.update(block)
+					fanout_wait(pending)
+					pending = [(out, writers.submit(pwrite_all, out["fd"], block, offset))
+						for out in outs if (out["error"] is None)]
+					offset += len(block)
+					written += len(block)
+			fanout_wait(pending)
+			if (hasher is not None):
+				hash_zeros(hasher, st.st_size - offset)
+
+			# Finish each copy the same way as copy_file().
+			for out in [out for out in outs if (out["error"] is None)]:
+				try:
+					if sparse:
+						os.ftruncate(out["fd"], st.st_size)
+					os.close(out["fd"])
+					out["fd"] = None
+					shutil.copystat(sfn_abs, out["tmp_abs"])
+					os.utime(out["tmp_abs"], None)
+					os.replace(out["tmp_abs"], out["dfn_abs"])
+					out["tmp_abs"] = None
+				except (shutil.Error, OSError) as err:
+					out["error"] = err
+
+	except OSError as err:
+		# The source couldn't be read, so every copy failed.
+		for out in outs:
+			if (out["error"] is None):
+				out["error"] = err
+
+	finally:
+		for out in outs:
+			if (out["fd"] is not None):
+				os.close(out["fd"])
+			if (out["tmp_abs"] is not None):
+				try:
+					os.remove(out["tmp_abs"])
+				except OSError:
+					pass
+
+	results = []
+	for out in outs:
+		if (out["error"] is None):
+			out["tally"]("copied")
+			out["tally"]("bytes", written)
+			if (report):
+				message("Copied " + str(sfn_abs) + " to " + str(out["dfn_abs"]) + " using fan-out")
+		else:
+			message("Error copying " + str(sfn_abs) + " to " + str(out["dfn_abs"]) + ": " +
+				str(out["error"]))
+			out["tally"]("errors")
+		results.append(out["error"] is None)
+	if any(results) and (stats is not None):
+		stats.copied(sfn_abs, written, time.perf_counter() - start)
+	return results
+
+
+##############################################################################
+# Wait for the block writes of copy_file_fanout() to finish, recording the
+# error of any destination that failed.
+##############################################################################
+def fanout_wait(pending):
+	for (out, future) in pending:
+		try:
+			future.result()
+		except OSError as err:
+			out["error"] = err
+
+
+##############################################################################
+# Write a whole block at an offset.
+##############################################################################
+def pwrite_all(fd, block, offset):
+	view = memoryview(block)
+	while view:
+		n = os.pwrite(fd, view, offset)
+		view = view[n:]
+		offset += n
+
+
+##############################################################################
+# Open a source file for reading.
+# Only regular files are copied.  Like shutil.copyfile(), anything else is
+# refused before it is opened, so a named pipe or a device can't hang the
+# backup waiting for data that never ends.
+##############################################################################
+def open_source(sfn_abs):
+	st = os.stat(sfn_abs)
+	if stat.S_ISFIFO(st.st_mode):
+		raise shutil.SpecialFileError("`%s` is a named pipe" % sfn_abs)
+	if not stat.S_ISREG(st.st_mode):
+		raise shutil.SpecialFileError("`%s` is not a regular file" % sfn_abs)
+	return open(sfn_abs, "rb")
+
+
+##############################################################################
+# Copy file contents using the cheapest method the platform supports.
+#
+# In order of preference:
+#   reflink         - clone the file's blocks (Btrfs, XFS); no data is copied
+#   copy_file_range - copy inside the kernel, or offload to the file system
+#   sendfile        - copy inside the kernel
+#   buffer          - plain read/write through a large buffer
+# Each method falls back to the next if the file systems don't support it.
+# Holes in sparse source files are skipped, so the copy stays sparse.
+#
+# With hasher, the data is copied through a buffer and added to it, holes
+# included, so it ends up with the hash of the whole file.
+#
+# Returns (method, bytes written).  The method has " (sparse)" appended when
+# only the data regions of a sparse file were copied.
+##############################################################################
+def copy_data(sfn_abs, dfn_abs, hasher=None):
+	with open_source(sfn_abs) as fsrc, open(dfn_abs, "wb") as fdst:
+		sfd = fsrc.fileno()
+		dfd = fdst.fileno()
+		if (hasher is None) and reflink(sfd, dfd):
+			return ("reflink", 0)
+
+		st = os.fstat(sfd)
+		extents = data_extents(sfd, st)
+		sparse = (extents is not None)
+		if not sparse:
+			extents = [(0, st.st_size)]
+		strategy = None
+		offset = 0
+		for (start, end) in extents:
+			if (hasher is not None):
+				hash_zeros(hasher, start - offset)
+			strategy = copy_range(sfd, dfd, start, end, strategy, hasher)
+			offset = end
+		if (hasher is not None):
+			hash_zeros(hasher, st.st_size - offset)
+		written = sum((end - start) for (start, end) in extents)
+		if sparse:
+			os.ftruncate(dfd, st.st_size)
+			return (str(strategy or "buffer") + " (sparse)", written)
+		return (strategy or "buffer", written)
+
+
+##############################################################################
+# Update an existing destination file in place, rewriting only the blocks
+# that differ from the source.
+#
+# Both files are read block by block at the same offsets.  Matching blocks
+# are left alone, so a large file with a few changed regions costs a read
+# of both copies but only a few block writes.  Data inserted or removed in
+# the middle of the source shifts every following block, which then gets
+# rewritten, so that case costs no more than a full copy.
+#
+# Before the first block is changed, the destination is renamed to a
+# temporary name in tmp_dir, and it is only renamed back once the last
+# block is written.  An interrupted update leaves the destination missing
+# rather than a mix of old and new blocks with a new mtime, so the next run
+# copies it in full; the journal, when kept, records the update too.  Files
+# with no changed blocks are never renamed.
+#
+# The source data is added to hasher, if given.
+#
+# Returns ("delta", bytes written, bytes left unchanged).
+##############################################################################
+def delta_copy(sfn_abs, dfn_abs, tmp_dir, hasher=None):
+	written = 0
+	unchanged = 0
+	offset = 0
+	tmp_abs = None
+	with open_source(sfn_abs) as fsrc, open(dfn_abs, "r+b") as fdst:
+		try:
+			while True:
+				data = fsrc.read(DELTA_BLOCK)
+				if (len(data) == 0):
+					break
+				if (hasher is not None):
+					hasher.update(data)
+				fdst.seek(offset)
+				if (fdst.read(len(data)) == data):
+					unchanged += len(data)
+				else:
+					if (tmp_abs is None):
+						tmp_abs = move_aside(dfn_abs, tmp_dir)
+					fdst.seek(offset)
+					fdst.write(data)
+					written += len(data)
+				offset += len(data)
+			if (os.fstat(fdst.fileno()).st_size != offset):
+				if (tmp_abs is None):
+					tmp_abs = move_aside(dfn_abs, tmp_dir)
+				fdst.truncate(offset)
+		except BaseException:
+			if (tmp_abs is not None):
+				try:
+					os.remove(tmp_abs)
+				except OSError:
+					pass
+			raise
+	if (tmp_abs is not None):
+		os.replace(tmp_abs, dfn_abs)
+	return ("delta", written, unchanged)
+
+
+##############################################################################
+# Rename a file that is about to be changed in place to a temporary name in
+# tmp_dir.  Returns the temporary name.
+##############################################################################
+def move_aside(path, tmp_dir):
+	(fd, tmp_abs) = make_temp(tmp_dir, path)
+	os.close(fd)
+	os.replace(path, tmp_abs)
+	return tmp_abs
+
+
+##############################################################################
+# Create a temporary file to be renamed to dfn_abs, in tmp_dir, creating the
+# directory if need be.  A rename only works within one file system, so if
+# dfn_abs's directory is on another, below a mount point or a symbolic
+# link, the temporary file is made in that directory instead.  One left
+# there by an interrupted run is an ordinary file to later runs.
+# Returns (fd, path) like tempfile.mkstemp().
+##############################################################################
+def make_temp(tmp_dir, dfn_abs):
+	dst_dir = os.path.dirname(dfn_abs)
+	if (os.stat(dst_dir).st_dev != device_of(tmp_dir)):
+		return tempfile.mkstemp(dir=dst_dir, prefix=TMP_PREFIX)
+	try:
+		return tempfile.mkstemp(dir=tmp_dir, prefix=TMP_PREFIX)
+	except FileNotFoundError:
+		os.makedirs(tmp_dir, exist_ok=True)
+		return tempfile.mkstemp(dir=tmp_dir, prefix=TMP_PREFIX)
+
+
+##############################################################################
+# The device of the file system a path is or would be created on: that of
+# its nearest existing parent.
+##############################################################################
+def device_of(path):
+	while True:
+		try:
+			return os.stat(path).st_dev
+		except FileNotFoundError:
+			parent = os.path.dirname(path)
+			if (parent == path):
+				raise
+			path = parent
+
+
+##############################################################################
+# Clone a whole file with the Linux FICLONE ioctl.
+# Returns True if the destination now shares the source's blocks.
+##############################################################################
+def reflink(sfd, dfd):
+	if (fcntl is None) or not sys.platform.startswith("linux"):
+		return False
+	try:
+		fcntl.ioctl(dfd, FICLONE, sfd)
+		return True
+	except OSError:
+		return False
+
+
+##############################################################################
+# Find the data regions of a sparse file with SEEK_DATA and SEEK_HOLE.
+# Returns a list of (start, end) offsets, or None if the file has no holes
+# or the platform can't report them.
+##############################################################################
+def data_extents(fd, st):
+	if not hasattr(os, "SEEK_DATA") or not hasattr(st, "st_blocks"):
+		return None
+	if (st.st_blocks * 512 >= st.st_size):
+		return None
+	extents = []
+	offset = 0
+	try:
+		while (offset < st.st_size):
+			try:
+				start = os.lseek(fd, offset, os.SEEK_DATA)
+			except OSError as err:
+				if (err.errno == errno.ENXIO):   # only a hole remains
+					break
+				raise
+			end = os.lseek(fd, start, os.SEEK_HOLE)
+			extents.append((start, end))
+			offset = end
+	except OSError:
+		return None
+	finally:
+		os.lseek(fd, 0, os.SEEK_SET)
+	return extents
+
+
+##############################################################################
+# Copy bytes [start, end) of one file to the same offsets in another.
+# strategy is the method that worked for the previous range of this file,
+# or None to try them all.  With hasher, the data is copied through a
+# buffer and added to it.  Returns the method used.
+##############################################################################
+def copy_range(sfd, dfd, start, end, strategy, hasher=None):
+	offset = start
+	if (hasher is not None):
+		strategy = "buffer"
+
+	if (strategy in (None, "copy_file_range")) and hasattr(os, "copy_file_range"):
+		try:
+			while (offset < end):
+				n = os.copy_file_range(sfd, dfd, min(end - offset, COPY_CHUNK), offset, offset)
+				if (n == 0):
+					break
+				offset += n
+			if (offset >= end):
+				return "copy_file_range"
+		except OSError as err:
+			if (offset != start) or (err.errno not in COPY_FALLBACK_ERRORS):
+				raise
+
+	if (strategy in (None, "sendfile")) and hasattr(os, "sendfile"):
+		try:
+			os.lseek(dfd, offset, os.SEEK_SET)
+			while (offset < end):
+				n = os.sendfile(dfd, sfd, offset, min(end - offset, COPY_CHUNK))
+				if (n == 0):
+					break
+				offset += n
+			if (offset >= end):
+				return "sendfile"
+		except OSError as err:
+			if (offset != start) or (err.errno not in COPY_FALLBACK_ERRORS):
+				raise
+
+	os.lseek(sfd, offset, os.SEEK_SET)
+	os.lseek(dfd, offset, os.SEEK_SET)
+	while (offset < end):
+		data = os.read(sfd, min(end - offset, COPY_BUFSIZE))
+		if (len(data) == 0):
+			break
+		if (hasher is not None):
+			hasher.update(data)
+		view = memoryview(data)
+		while (len(view) > 0):
+			view = view[os.write(dfd, view):]
+		offset += len(data)
+	return "buffer"
+
+
+##############################################################################
+# Take a deduplicating snapshot of the source tree.
+#
+# Each run writes a new snapshot directory in <dst-dir>, named for the date
+# and time.  File contents are kept once each in an object store under the
+# metadata directory, named by their hash, and every file in a snapshot is
+# a hard link to its object.  A file whose size and mtime match the previous
+# snapshot is linked to the same object without being read; any other file
+# is hashed (using the hash cache) and only copied if no object has its
+# contents yet.  A snapshot is built under a ".partial" name and renamed
+# when complete.  Hard linked files share their metadata, so a snapshot
+# file's mtime is that of the first file stored with the same contents.
+# A second snapshot taken within the same second gets a "-2" suffix, and
+# so on, so it never reuses the name of one that already exists.  Names
+# don't give the order the snapshots were taken in, since a pruned name can
+# be taken again or the clock go back; the index numbers them instead.
+#
+# Returns the exit code: 0 on success, 3 if halted on an error.
+##############################################################################
+def run_snapshot(src_root_abs, dst_root_abs, excluder, jobs, dry_run, verbose, error_halt,
+		counts, scan_jobs=1, stats=None):
+	objects_abs = os.path.join(dst_root_abs, META_DIR, OBJECTS_DIR)
+
+	index = open_meta_db(SnapshotIndex, dst_root_abs, SNAPSHOTS_FILE, dry_run)
+	hashes = open_meta_db(HashStore, dst_root_abs, HASHES_FILE, dry_run)
+	if (index is None):
+		index = SnapshotIndex(":memory:", readonly=True)
+	if (hashes is None):
+		hashes = HashStore(":memory:", readonly=True)
+	previous = index.latest()
+
+	# Pick a name not used by a snapshot directory or index entry.
+	base = time.strftime(SNAPSHOT_FORMAT)
+	name = base
+	n = 1
+	while True:
+		snap_abs = os.path.join(dst_root_abs, name)
+		build_abs = snap_abs + SNAPSHOT_PARTIAL
+		if not (os.path.lexists(snap_abs) or os.path.lexists(build_abs)) and index.begin(name):
+			break
+		n += 1
+		name = "%s-%d" % (base, n)
+	pool = concurrent.futures.ThreadPoolExecutor(jobs)
+	storing = {}
+	storing_lock = threading.Lock()
+
+	# Store or link one file.  Returns (copied, digest).
+	def snapshot_file(sfn_abs, src_stat, digest, sfn_snap):
+		if (digest is None):
+			digest = hashes.cached(src_stat)
+		if (digest is None):
+			digest = hash_file(sfn_abs)
+			hashes.set(src_stat, digest)
+		obj_abs = object_path(objects_abs, digest)
+
+		# Only one worker stores a given object.  Others with the same
+		# contents wait for it and then link to it.
+		with storing_lock:
+			copied = not os.path.exists(obj_abs) and (digest not in storing)
+			if copied:
+				storing[digest] = threading.Event()
+			waiting = storing.get(digest)
+		if not copied and (waiting is not None):
+			waiting.wait()
+		if copied:
+			key = digest
+			try:
+				if not dry_run:
+					digest = store_object(sfn_abs, src_stat, digest, objects_abs)
+			finally:
+				storing[key].set()
+			obj_abs = object_path(objects_abs, digest)
+		if dry_run:
+			return (copied, digest)
+		try:
+			os.link(obj_abs, sfn_snap)
+		except OSError as err:
+			if (err.errno != errno.EMLINK):
+				raise
+			copy_data(obj_abs, sfn_snap)           # too many links to one object
+			shutil.copystat(obj_abs, sfn_snap)
+		return (copied, digest)
+
+	code = 0
+	lister = DirLister(scan_jobs, stats)
+	tree = scan_tree(src_root_abs, lister=lister)
+	if (excluder is not None) and excluder.tree_excluded(src_root_abs):
+		tree = []
+		counts.count("excluded")
+	for (dirpath, dir_rel, files, dirs) in tree:
+		snap_dir = build_abs if (dir_rel == ".") else os.path.join(build_abs, dir_rel)
+		if not dry_run:
+			try:
+				os.makedirs(snap_dir, exist_ok=True)
+			except OSError as err:
+				message("Error creating " + str(snap_dir) + ": " + str(err))
+				counts.count("errors")
+				if error_halt:
+					code = 3
+					break
+				dirs[:] = []
+				continue
+
+		# Prune excluded directories.
+		if (excluder is not None):
+			for d in [d for d in dirs if excluder.dir_excluded(d.path)]:
+				dirs.remove(d)
+				counts.count("excluded")
+				if (verbose):
+					message("Excluding " + d.path)
+
+		# Reuse the previous snapshot's hash for unchanged files.
+		previous_entries = index.entries(previous, dir_rel)
+		jobs_list = []
+		for entry in files:
+			if (excluder is not None) and excluder.file_excluded(entry.path):
+				counts.count("excluded")
+				if (verbose):
+					message("Excluding " + entry.path)
+				continue
+			try:
+				src_stat = entry.stat()
+			except OSError as err:
+				message("Error copying " + str(entry.path) + ": " + str(err))
+				counts.count("errors")
+				if error_halt:
+					code = 3
+					break
+				continue
+			digest = None
+			prev = previous_entries.get(entry.name)
+			if (prev is not None) and (prev[0] == src_stat.st_size) and (prev[1] == src_stat.st_mtime_ns):
+				digest = prev[2]
+			jobs_list.append((entry.path, src_stat, digest, os.path.join(snap_dir, entry.name)))
+		if (code != 0):
+			break
+
+		# Store and link this directory's files in parallel.
+		futures = [pool.submit(snapshot_file, *job) for job in jobs_list]
+		for (job, future) in zip(jobs_list, futures):
+			try:
+				(copied, digest) = future.result()
+			except (shutil.Error, OSError) as err:
+				message("Error copying " + str(job[0]) + ": " + str(err))
+				counts.count("errors")
+				if error_halt:
+					code = 3
+				continue
+			if copied:
+				if (dry_run or verbose):
+					message(str(job[0]) + " -> " + str(job[3]))
+				counts.count("copied")
+				if not dry_run:
+					counts.count("bytes", job[1].st_size)
+			else:
+				counts.count("linked")
+			index.add(name, dir_rel, os.path.basename(job[0]), job[1], digest)
+		if (code != 0):
+			break
+
+	pool.shutdown()
+	lister.close()
+	if (code == 0) and not dry_run:
+		try:
+			os.rename(build_abs, snap_abs)
+			index.finish(name)
+			if (verbose):
+				message("Created snapshot " + snap_abs)
+		except OSError as err:
+			message("Error creating snapshot " + str(snap_abs) + ": " + str(err))
+			counts.count("errors")
+			code = 3
+	index.close()
+	hashes.close()
+	return code
+
+
+##############################################################################
+# Sort key for snapshot names, putting "-10" suffixes after "-9".  Only used
+# for snapshots the index doesn't number.
+##############################################################################
+def snapshot_key(name):
+	m = SNAPSHOT_RE.match(name)
+	if (m is None) or (m.group(1) is None):
+		return (name, 1)
+	return (name[:m.start(1)], int(m.group(1)[1:]))
+
+
+##############################################################################
+# Path of the object holding the contents with the given hash.
+##############################################################################
+def object_path(objects_abs, digest):
+	hexdigest = digest.hex()
+	return os.path.join(objects_abs, hexdigest[:2], hexdigest[2:])
+
+
+##############################################################################
+# Copy a file into the object store.
+# The copy is made under a temporary name and renamed into place, so an
+# object is always complete.  If the file changed since it was hashed, the
+# copy is hashed again so the object name matches what was stored.
+# Returns the hash of the stored contents.
+##############################################################################
+def store_object(sfn_abs, src_stat, digest, objects_abs):
+	os.makedirs(objects_abs, exist_ok=True)
+	(fd, tmp_abs) = tempfile.mkstemp(dir=objects_abs, prefix=".tmp")
+	os.close(fd)
+	try:
+		copy_data(sfn_abs, tmp_abs)
+		shutil.copystat(sfn_abs, tmp_abs)
+		st = os.stat(sfn_abs)
+		if (st.st_size != src_stat.st_size) or (st.st_mtime_ns != src_stat.st_mtime_ns):
+			digest = hash_file(tmp_abs)
+		obj_abs = object_path(objects_abs, digest)
+		os.makedirs(os.path.dirname(obj_abs), exist_ok=True)
+		os.replace(tmp_abs, obj_abs)
+	except BaseException:
+		try:
+			os.remove(tmp_abs)
+		except OSError:
+			pass
+		raise
+	return digest
+
+
+##############################################################################
+# Delete all but the newest keep snapshots in <dst-dir>, along with any
+# partial snapshots left by interrupted runs.  Objects no longer linked
+# from any snapshot are then removed from the object store.
+##############################################################################
+def prune_snapshots(dst_root_abs, keep, dry_run, verbose, counts):
+	names = []
+	partials = []
+	for name in sorted(os.listdir(dst_root_abs), key=snapshot_key):
+		if SNAPSHOT_RE.match(name):
+			names.append(name)
+		elif name.endswith(SNAPSHOT_PARTIAL) and SNAPSHOT_RE.match(name[:-len(SNAPSHOT_PARTIAL)]):
+			partials.append(name)
+
+	index = open_meta_db(SnapshotIndex, dst_root_abs, SNAPSHOTS_FILE, dry_run)
+	if (index is not None):
+		order = index.order()
+		names.sort(key=lambda name: (order.get(name, 0), snapshot_key(name)))
+	for name in partials + names[:max(len(names) - keep, 0)]:
+		path = os.path.join(dst_root_abs, name)
+		if (dry_run or verbose):
+			message("Pruning " + str(path))
+		if not dry_run:
+			try:
+				shutil.rmtree(path)
+				if (index is not None):
+					index.remove(name[:len(name) - len(SNAPSHOT_PARTIAL)]
+						if name.endswith(SNAPSHOT_PARTIAL) else name)
+			except OSError as err:
+				message("Error pruning " + str(path) + ": " + str(err))
+				counts.count("errors")
+				continue
+		if (name in names):
+			counts.count("pruned")
+	if (index is not None):
+		index.close()
+
+	# An object with a single link is not in any snapshot.
+	if dry_run:
+		return
+	objects_abs = os.path.join(dst_root_abs, META_DIR, OBJECTS_DIR)
+	for (dirpath, dirnames, filenames) in os.walk(objects_abs):
+		for file in filenames:
+			path = os.path.join(dirpath, file)
+			try:
+				if (os.stat(path).st_nlink == 1):
+					os.remove(path)
+					counts.count("freed")
+			except OSError as err:
+				message("Error pruning " + str(path) + ": " + str(err))
+				counts.count("errors")
+
+
+##############################################################################
+# Hash the contents of a regular file.
+# Reads in large chunks; hashlib releases the GIL while hashing them, so
+# several files can be hashed at once from different threads.
+##############################################################################
+def hash_file(path):
+	h = hashlib.blake2b()
+	with open_source(path) as f:
+		while True:
+			data = f.read(HASH_CHUNK)
+			if (len(data) == 0):
+				break
+			h.update(data)
+	return h.digest()
+
+
+##############################################################################
+# Add n zero bytes to a hash, for a hole in a sparse file.
+##############################################################################
+def hash_zeros(hasher, n):
+	if (n <= 0):
+		return
+	zeros = memoryview(bytes(min(n, HASH_CHUNK)))
+	while (n > 0):
+		hasher.update(zeros[:n])
+		n -= len(zeros)
+
+
+##############################################################################
+# Record a backed up file in the manifest and the hash store.
+# Called after the file is copied, or found to be up to date.
+##############################################################################
+def record_backup(manifest, dir_rel, name, src_stat, hashes, dfn_abs, digest):
+	if (manifest is not None):
+		manifest.set_file(dir_rel, name, src_stat)
+	if (hashes is not None) and (digest is not None):
+		try:
+			hashes.set(os.stat(dfn_abs), digest)
+		except OSError:
+			pass
+
+
+##############################################################################
+# True if a DirEntry is a real directory (not a symbolic link to one).
+##############################################################################
+def entry_is_dir(entry):
+	try:
+		return entry.is_dir(follow_symlinks=False)
+	except OSError:
+		return False
+
+
+##############################################################################
+# List a directory with os.scandir, timing it in stats if given.
+# Returns a dictionary of name -> DirEntry, or None if the directory is
+# missing or can't be read.
+##############################################################################
+def list_dir(path, stats=None):
+	start = time.perf_counter()
+	try:
+		with os.scandir(path) as it:
+			entries = {entry.name: entry for entry in it}
+	except OSError:
+		return None
+	if (stats is not None):
+		stats.listed(path, len(entries), time.perf_counter() - start)
+	return entries
+
+
+##############################################################################
+# Walk a directory tree top-down with os.scandir.
+# Yields (dirpath, dir_rel, files, dirs) for each directory, where dir_rel is
+# "." for the root and files and dirs are lists of DirEntry objects sorted by
+# name.  The DirEntry objects cache their stat results, so each entry costs
+# at most one stat call.  Like os.walk, symbolic links to directories are
+# listed in dirs but not followed, unreadable directories are skipped, and
+# entries removed from dirs by the caller are not walked.
+# To walk part of the tree, dir_rel is the directory to start from.  If
+# recursive is False only that directory is listed.
+#
+# With a DirLister, the next directories of the walk are listed ahead by
+# its threads while the caller works on the current one, along with any
+# paths companions(dir_rel) returns for each, such as the matching
+# destination directories.  The order of the walk stays the same.
+##############################################################################
+def scan_tree(root_abs, dir_rel=".", recursive=True, lister=None, companions=None):
+	if (lister is None):
+		lister = DirLister(1)
+	stack = [(root_abs if (dir_rel == ".") else os.path.join(root_abs, dir_rel), dir_rel)]
+	lister.prefetch_walk(stack, companions)
+	while stack:
+		(dirpath, dir_rel) = stack.pop()
+		with lister.stats.phase("scan"):
+			entries = lister.list(dirpath)
+			if entries is None:
+				continue
+
+			files = []
+			dirs = []
+			for name in sorted(entries):
+				entry = entries[name]
+				try:
+					is_dir = entry.is_dir()
+				except OSError:
+					is_dir = False
+				if is_dir:
+					dirs.append(entry)
+				else:
+					files.append(entry)
+
+		yield (dirpath, dir_rel, files, dirs)
+		if not recursive:
+			break
+
+		# Push in reverse so subdirectories are walked in name order.
+		for entry in reversed(dirs):
+			if not entry.is_symlink():
+				sub_rel = entry.name if (dir_rel == ".") else os.path.join(dir_rel, entry.name)
+				stack.append((entry.path, sub_rel))
+		lister.prefetch_walk(stack, companions)
+
+
+##############################################################################
+# Lists directories ahead of a walk with a pool of threads.
+#
+# On a network file system every listing and stat is a round trip, and a
+# serial walk leaves the link idle while it waits for each one.  prefetch()
+# queues a directory to be listed, and its entries stat'ed so the DirEntry
+# objects have their stat results cached, by one of the threads.  list()
+# returns a listing like list_dir(), waiting for it if it was queued and
+# listing it right away if not.  The walk asks for the listings in its
+# own order, so the threads don't change the order of the results.  With
+# one worker nothing is listed ahead.  The listings, and the time the walk
+# spends on them, are recorded in stats.
+##############################################################################
+class DirLister(object):
+
+	AHEAD = 4       # directories queued ahead of the walk per worker
+
+	def __init__(self, workers, stats=None):
+		self.stats = RunStats() if (stats is None) else stats
+		self._pool = None
+		self._pending = {}
+		self._ahead = workers * self.AHEAD
+		if (workers > 1):
+			self._pool = concurrent.futures.ThreadPoolExecutor(workers)
+
+	# Queue a directory to be listed.
+	def prefetch(self, path):
+		if (self._pool is not None) and (path not in self._pending):
+			self._pending[path] = self._pool.submit(self._list, path)
+
+	# Queue the directories next on a walk's stack, whose top is its end,
+	# and their companion paths.
+	def prefetch_walk(self, stack, companions=None):
+		if (self._pool is None):
+			return
+		for (path, dir_rel) in reversed(stack[-self._ahead:]):
+			self.prefetch(path)
+			if (companions is not None):
+				for other in companions(dir_rel):
+					self.prefetch(other)
+
+	# List a directory.
+	# Returns a dictionary of name -> DirEntry, or None if the directory is
+	# missing or can't be read.
+	def list(self, path):
+		future = self._pending.pop(path, None)
+		if (future is None):
+			return list_dir(path, self.stats)
+		return future.result()
+
+	# Drop a queued listing that won't be needed.
+	def forget(self, path):
+		future = self._pending.pop(path, None)
+		if (future is not None):
+			future.cancel()
+
+	def close(self):
+		if (self._pool is not None):
+			self._pool.shutdown(cancel_futures=True)
+			self._pending = {}
+
+	def _list(self, path):
+		entries = list_dir(path, self.stats)
+		if (entries is not None):
+			for entry in entries.values():
+				try:
+					entry.stat()
+				except OSError:
+					pass
+		return entries
+
+
+##############################################################################
+# Walk the directories of a tree that changed.
+# changes is a dictionary of dir_rel -> recursive.  Yields the same tuples
+# as scan_tree(), parents before their subdirectories.  Directories under
+# one that is walked recursively are only walked once.
+##############################################################################
+def scan_changes(root_abs, changes, lister=None, companions=None):
+	for dir_rel in sorted(changes, key=lambda d: d.split(os.sep)):
+		parent = dir_rel
+		covered = False
+		while (parent != ".") and not covered:
+			parent = os.path.dirname(parent) or "."
+			covered = changes.get(parent, False)
+		if not covered:
+			yield from scan_tree(root_abs, dir_rel, changes[dir_rel], lister, companions)
+
+
+##############################################################################
+# Pool of copy workers fed from a bounded queue.
+# With a single worker, copies are performed inline by submit() so the
+# default run behaves exactly like a plain serial loop.
+#
+# Each copy is of one source file to one or more destinations.  A file
+# copied in full to several destinations is read once, with
+# copy_file_fanout(); in-place --delta updates are made one at a time.
+##############################################################################
+class CopyPool(object):
+
+	def __init__(self, workers, error_halt, report=False, fanout=1, verify=False,
+			read_back=False, stats=None):
+		self.halted = threading.Event()
+		self._stats = stats
+		self.submitted = 0
+		self.watermark = 0
+		self._error_halt = error_halt
+		self._report = report
+		self._verify = verify or read_back
+		self._read_back = read_back
+		self._finished = set()
+		self._lock = threading.Lock()
+		self._threads = []
+		self._queue = queue.Queue(maxsize=workers * 4)
+		self._writers = None
+		if (fanout > 1):
+			self._writers = concurrent.futures.ThreadPoolExecutor(workers * fanout)
+		if (workers > 1):
+			for i in range(workers):
+				t = threading.Thread(target=self._worker)
+				t.daemon = True
+				t.start()
+				self._threads.append(t)
+
+	# Copy a file, or queue it for a worker.
+	# Blocks while the queue is full so the scan never runs far ahead.
+	# targets is a list of (dest, dfn_abs, done, delta) for the
+	# destinations that need the file.  done(digest) is called after a
+	# successful copy, with the hash of the data copied if verifying or else
+	# None.  If delta is True the existing destination file is updated in
+	# place.  With read_back, each copy is read back and compared with the
+	# hash, and one that doesn't match counts as failed.
+	# Copies are numbered in order of submission; every copy up to number
+	# watermark has finished.
+	def submit(self, sfn_abs, targets):
+		self.submitted += 1
+		item = (sfn_abs, targets, self.submitted)
+		if (len(self._threads) == 0):
+			self._copy(item)
+		else:
+			self._queue.put(item)
+
+	# Wait for queued copies to finish and stop the workers.
+	def close(self):
+		for t in self._threads:
+			self._queue.put(None)
+		for t in self._threads:
+			t.join()
+		self._threads = []
+		if (self._writers is not None):
+			self._writers.shutdown()
+			self._writers = None
+
+	def _copy(self, item):
+		(sfn_abs, targets, seq) = item
+		try:
+			full = []
+			for (dest, dfn_abs, done, delta) in targets:
+				if not delta:
+					full.append((dest, dfn_abs, done))
+					continue
+				if (dest.journal is not None):
+					dest.journal.delta_begin(dfn_abs)
+				hasher = hashlib.blake2b() if self._verify else None
+				ok = copy_file(sfn_abs, dfn_abs, dest.tmp_abs, dest.count, self._report, True, hasher,
+					self._stats)
+				self._finish(dest, sfn_abs, dfn_abs, done, ok, hasher)
+
+			results = []
+			hasher = hashlib.blake2b() if self._verify else None
+			if (len(full) == 1):
+				(dest, dfn_abs, done) = full[0]
+				results = [copy_file(sfn_abs, dfn_abs, dest.tmp_abs, dest.count, self._report, False,
+					hasher, self._stats)]
+			elif (len(full) > 1):
+				results = copy_file_fanout(sfn_abs, [(dfn_abs, dest.tmp_abs, dest.count)
+					for (dest, dfn_abs, done) in full], self._report, self._writers, hasher,
+					self._stats)
+			for ((dest, dfn_abs, done), ok) in zip(full, results):
+				self._finish(dest, sfn_abs, dfn_abs, done, ok, hasher)
+		finally:
+			with self._lock:
+				self._finished.add(seq)
+				while (self.watermark + 1) in self._finished:
+					self.watermark += 1
+					self._finished.remove(self.watermark)
+
+	# Record the result of one copy.
+	def _finish(self, dest, sfn_abs, dfn_abs, done, ok, hasher):
+		digest = None
+		if ok and (hasher is not None):
+			digest = hasher.digest()
+			if self._read_back:
+				ok = self._check(dest, sfn_abs, dfn_abs, digest)
+		if ok:
+			if (dest.journal is not None):
+				dest.journal.copied(dfn_abs)
+			if done is not None:
+				done(digest)
+		else:
+			if (dest.journal is not None):
+				dest.journal.failed(dfn_abs)
+			if self._error_halt:
+				self.halted.set()
+
+	# Read a finished copy back from disk and compare it with the hash of
+	# the data written.  The copy is flushed and dropped from the page cache
+	# first where the platform allows, so the read comes from the disk.
+	# A copy that doesn't match is copied again in full on the next run.
+	# Returns True if it matches.
+	def _check(self, dest, sfn_abs, dfn_abs, digest):
+		try:
+			if hasattr(os, "posix_fadvise"):
+				with open(dfn_abs, "rb") as f:
+					os.fsync(f.fileno())
+					os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+			ok = (hash_file(dfn_abs) == digest)
+		except OSError:
+			ok = False
+		if ok:
+			dest.count("verified")
+			return True
+		message("Verify failed: " + str(dfn_abs) + " doesn't match " + str(sfn_abs))
+		dest.count("mismatches")
+		if (dest.journal is not None):
+			dest.journal.mismatch(dfn_abs)
+		return False
+
+	def _worker(self):
+		while True:
+			item = self._queue.get()
+			if item is None:
+				break
+			# After a halt, drain the remaining queue without copying.
+			if not self.halted.is_set():
+				self._copy(item)
+
+
+##############################################################################
+# Journal of a backup run's progress, kept in <dst-dir>.
+#
+# Records each source directory whose whole subtree has been backed up,
+# once every copy queued for it has finished without error, so --resume can
+# skip those subtrees after an interruption.  Also records in-place --delta
+# updates before they start, so a file left half updated is copied in full
+# on the next run.  The journal is deleted when a run completes.
+#
+# Each record is flushed as it is written, so none are lost if the process
+# is killed, and the file is fsynced every SYNC_INTERVAL seconds, so a crash
+# of the system loses at most the directories finished since.  In-place
+# updates are fsynced before they start.
+##############################################################################
+class Journal(object):
+
+	SYNC_INTERVAL = 5.0   # seconds between fsyncs of directory entries
+
+	def __init__(self, path, dst_root_abs, resume):
+		self.done = set()
+		self.dirty = set()
+		self.skipped = False
+		self._path = path
+		self._dst_root_abs = dst_root_abs
+		self._lock = threading.Lock()
+		self._open = []
+		self._pending = []
+		self._failed = set()
+		self._synced = time.time()
+
+		if os.path.exists(path):
+			with open(path, "r") as f:
+				for line in f:
+					try:
+						record = json.loads(line)
+					except ValueError:
+						break       # torn last line from an interrupted write
+					if ("done" in record) and resume:
+						self.done.add(record["done"])
+					elif "delta" in record:
+						self.dirty.add(record["delta"])
+					elif "copied" in record:
+						self.dirty.discard(record["copied"])
+
+		# Start a fresh journal that carries over what is still relevant.
+		self._file = open(path, "w")
+		for dir_rel in sorted(self.done):
+			self._write({"done": dir_rel})
+		for rel in sorted(self.dirty):
+			self._write({"delta": rel})
+		self._sync()
+
+	# The scan has moved on to a new source directory.  Directories it has
+	# left are finished once the copies submitted so far are done.
+	def enter(self, dir_rel, submitted):
+		while self._open and not is_ancestor(self._open[-1], dir_rel):
+			self._pending.append((submitted, self._open.pop()))
+		self._open.append(dir_rel)
+
+	# The scan is complete.
+	def finish(self, submitted):
+		while self._open:
+			self._pending.append((submitted, self._open.pop()))
+
+	# Write out the directories whose copies have all finished.
+	def flush(self, watermark):
+		while self._pending and (self._pending[0][0] <= watermark):
+			dir_rel = self._pending.pop(0)[1]
+			with self._lock:
+				ok = not any(is_ancestor(dir_rel, f) for f in self._failed)
+			if ok:
+				self._write({"done": dir_rel})
+		if (time.time() - self._synced >= self.SYNC_INTERVAL):
+			self._sync()
+
+	# Note an error in a source directory, so its subtree isn't marked done.
+	def error(self, dir_rel):
+		with self._lock:
+			self._failed.add(dir_rel)
+
+	# A copy failed.
+	def failed(self, dfn_abs):
+		self.error(os.path.relpath(os.path.dirname(dfn_abs), self._dst_root_abs))
+
+	# An in-place update is about to start.  Must be on disk first.
+	def delta_begin(self, dfn_abs):
+		self._write({"delta": self._rel(dfn_abs)})
+		self._sync()
+
+	# A copy didn't match its source when read back.  Like an unfinished
+	# in-place update, it is copied again in full on the next run.
+	def mismatch(self, dfn_abs):
+		self.delta_begin(dfn_abs)
+
+	# A copy or in-place update finished.
+	def copied(self, dfn_abs):
+		rel = self._rel(dfn_abs)
+		with self._lock:
+			if (rel not in self.dirty):
+				return
+			self.dirty.discard(rel)
+		self._write({"copied": rel})
+
+	# Close the journal.  After a complete run only unfinished in-place
+	# updates are still relevant, so it is emptied of everything else, or
+	# deleted.
+	def close(self, complete):
+		with self._lock:
+			self._file.close()
+		if complete and self.dirty:
+			with open(self._path, "w") as f:
+				for rel in sorted(self.dirty):
+					f.write(json.dumps({"delta": rel}) + "\n")
+		elif complete:
+			os.remove(self._path)
+
+	def _rel(self, dfn_abs):
+		return os.path.relpath(dfn_abs, self._dst_root_abs)
+
+	def _write(self, record):
+		with self._lock:
+			self._file.write(json.dumps(record) + "\n")
+			self._file.flush()
+			if "delta" in record:
+				self.dirty.add(record["delta"])
+
+	def _sync(self):
+		with self._lock:
+			self._file.flush()
+			os.fsync(self._file.fileno())
+			self._synced = time.time()
+
+
+##############################################################################
+# True if directory a is b or one of its parents.  Both are relative to
+# the same root, which is ".".
+##############################################################################
+def is_ancestor(a, b):
+	return (a == ".") or (a == b) or b.startswith(a + os.sep)
+
+
+##############################################################################
+# Whether a directory named META_DIR holds this script's metadata.
+##############################################################################
+def is_meta_dir(path):
+	for name in (MANIFEST_FILE, HASHES_FILE, JOURNAL_FILE, TMP_DIR, OBJECTS_DIR, SNAPSHOTS_FILE):
+		if os.path.lexists(os.path.join(path, name)):
+			return True
+	return False
+
+
+##############################################################################
+# Error opening a metadata file in <dst-dir>, such as the journal or one of
+# the databases.  main() can't go on without it, and exits with code 1.
+##############################################################################
+class MetaError(Exception):
+	pass
+
+
+##############################################################################
+# Base class for the SQLite databases kept in <dst-dir>'s metadata directory.
+# The connection is shared by the scan and the copy workers under a lock.
+# Changes are committed in batches, so an interrupted run keeps most of its
+# progress without paying for a commit per file.
+##############################################################################
+class MetaDB(object):
+
+	COMMIT_INTERVAL = 1000
+
+	def __init__(self, path, readonly=False):
+		self._lock = threading.Lock()
+		self._pending = 0
+		self._readonly = readonly
+		self._db = sqlite3.connect(path, check_same_thread=False)
+		self._db.execute("PRAGMA synchronous = NORMAL")
+
+	def close(self):
+		with self._lock:
+			self._db.commit()
+			self._db.close()
+
+	# Count a change, committing once enough have accumulated.
+	# Call with the lock held.
+	def _changed(self, n):
+		self._pending += n
+		if (self._pending >= self.COMMIT_INTERVAL):
+			self._db.commit()
+			self._pending = 0
+
+
+##############################################################################
+# One destination directory of a backup, with its own metadata files and
+# counts.  The journal belongs to the current backup pass.  total is the
+# Counts of the whole run, which every count is added to as well; it is set
+# by TreeBackup.
+##############################################################################
+class Destination(object):
+
+	def __init__(self, root_abs, manifest=None, hashes=None):
+		self.root_abs = root_abs
+		self.meta_abs = os.path.join(root_abs, META_DIR)
+		self.tmp_abs = os.path.join(self.meta_abs, TMP_DIR)
+		self.manifest = manifest
+		self.hashes = hashes
+		self.journal = None
+		self.sync_errors = 0
+		self.counts = Counts()
+		self.total = None
+
+	# Increment a counter for this destination and the run total.
+	def count(self, name, n=1):
+		self.counts.count(name, n)
+		if (self.total is not None):
+			self.total.count(name, n)
+
+	# The destination directory for a source directory.
+	def dir_abs(self, dir_rel):
+		return self.root_abs if (dir_rel == ".") else os.path.join(self.root_abs, dir_rel)
+
+
+##############################################################################
+# One step of a backup plan.  See TreeBackup.plan().
+#
+# kind is one of:
+#   "dir"     - the walk has reached source directory path
+#   "exclude" - source file path is excluded, or with is_dir a directory
+#   "skip"    - source file path is up to date in target, or with is_dir
+#               path is a subtree finished by an interrupted run; verified
+#               if --verify compared their contents
+#   "mismatch" - target doesn't have the contents of source file path,
+#               which --verify found; a copy follows
+#   "error"   - source file path can't be read; error is the exception
+#   "mkdir"   - create destination directory target
+#   "copy"    - copy source file path to target; with delta, update the
+#               existing target in place
+#   "move"    - rename origin to target instead of copying path there
+#   "delete"  - delete target, a file or with is_dir an empty directory
+#   "manifest" - record source directory dir_rel as scanned in dest's
+#               manifest, dropping the files no longer in it
+# dir_rel is the source directory the step belongs to, relative to the
+# source root, and dest is the Destination it changes.  stat and digest are
+# the source file's stat result and --checksum hash, when known.
+##############################################################################
+class Operation(object):
+
+	__slots__ = ("kind", "dir_rel", "path", "dest", "target", "origin", "stat",
+		"digest", "delta", "is_dir", "error", "verified")
+
+	def __init__(self, kind, dir_rel, path=None, dest=None, target=None, origin=None,
+			stat=None, digest=None, delta=False, is_dir=False, error=None, verified=False):
+		self.kind = kind
+		self.dir_rel = dir_rel
+		self.path = path
+		self.dest = dest
+		self.target = target
+		self.origin = origin
+		self.stat = stat
+		self.digest = digest
+		self.delta = delta
+		self.is_dir = is_dir
+		self.error = error
+		self.verified = verified
+
+	def __repr__(self):
+		return "Operation(" + self.kind + ", " + repr(self.path if (self.target is None) else self.target) + ")"
+
+
+##############################################################################
+# Backup of a source tree to one or more destination directories.
 #
-# 09/15/2015 - Tom Kerr
-# Remove destination directories during sync that don't exist in source tree.
+# Holds the options and the destinations.  A backup pass is split in two:
+# plan() walks the source and yields a lazy stream of Operations, and
+# execute() carries them out, queueing the copies on a CopyPool so they run
+# while the rest of the tree is still being planned.  run() does both.
+# The planner doesn't change the destinations or their manifests; deleting
+# leftover temporary files and updating the manifest are left to
+# execute().  Other tools can use it to see what a backup would do.  It
+# does keep the hashes it computes for --checksum and --verify in the hash
+# store, so they aren't computed again; with dry_run nothing at all is
+# written.
 #
-# 09/10/2015 - Tom Kerr
-# Created.
+# run() makes one backup pass, over the whole tree or over a set of
+# directories that changed.  Each pass has its own copy pool and journals,
+# so --watch can make one pass after another with the same manifests and
+# hash stores.  The source is walked once however many destinations there
+# are, and each file is compared with every destination but read only once.
+# The passes are timed in stats, a RunStats of the instance's own counts
+# unless one is given.
 ##############################################################################
+class TreeBackup(object):
+
+	def __init__(self, src_root_abs, dests, excluder=None, jobs=1, dry_run=False,
+			verbose=False, error_halt=False, force_copy=False, sync=False, delta_min=0,
+			detect_moves=False, report=False, scan_jobs=1, counts=None, checksum=False,
+			verify=False, read_back=False, stats=None):
+		self.src_root_abs = src_root_abs
+		self.dests = dests
+		self.excluder = excluder
+		self.jobs = jobs
+		self.dry_run = dry_run
+		self.verbose = verbose
+		self.error_halt = error_halt
+		self.force_copy = force_copy
+		self.sync = sync
+		self.delta_min = delta_min
+		self.detect_moves = detect_moves
+		self.report = report
+		self.checksum = checksum
+		self.verify = verify or read_back
+		self.read_back = read_back
+		self.counts = Counts() if (counts is None) else counts
+		self.stats = RunStats(self.counts) if (stats is None) else stats
+		for dest in dests:
+			dest.total = self.counts
+		self.hash_pool = None
+		if any((dest.hashes is not None) for dest in dests):
+			self.hash_pool = concurrent.futures.ThreadPoolExecutor(max(jobs, 4))
+		self.lister = DirLister(scan_jobs, self.stats)
+
+	# Make a backup pass.
+	# With changes, a dictionary of dir_rel -> recursive, only those source
+	# directories are compared, and their subdirectories too if recursive is
+	# True.  Otherwise the whole tree is.  With resume, directories finished
+	# by an interrupted run are skipped, except with detect_moves, which
+	# needs to see the whole tree.  If watcher is given, every directory
+	# walked is added to it.
+	# Returns False if halted on an error.
+	def run(self, changes=None, resume=False, watcher=None):
+		for dest in self.dests:
+			if (dest.manifest is not None):
+				dest.manifest.new_run()
+			dest.journal = self._open_journal(dest, resume and not self.detect_moves)
+			dest.sync_errors = 0
+		pool = CopyPool(self.jobs, self.error_halt, self.report, len(self.dests),
+			self.verify, self.read_back, self.stats)
+		ops = self.plan(changes, watcher)
+		try:
+			complete = self.execute(ops, pool)
+		finally:
+			ops.close()
+
+		# Wait for the copy workers to finish.
+		for dest in self.dests:
+			if (dest.journal is not None):
+				dest.journal.finish(pool.submitted)
+		with self.stats.phase("copy"):
+			pool.close()
+		complete = complete and not pool.halted.is_set()
+		with self.stats.phase("finish"):
+			for dest in self.dests:
+				journal = dest.journal
+				if (journal is not None):
+					journal.flush(pool.watermark)
+					journal.close(complete)
+					if complete:
+						self._remove_meta_dir(dest)
+
+				# Subtrees skipped by --resume weren't seen by this pass, so
+				# the manifest can't tell which of its entries are stale;
+				# that takes a pass over the whole tree.
+				skipped = (journal is not None) and journal.skipped
+				if complete and (dest.manifest is not None) and not skipped:
+					if (changes is None):
+						dest.manifest.prune()
+
+					# Only trust the sync state if every deletion succeeded.
+					if self.sync and (dest.sync_errors == 0):
+						dest.manifest.mark_synced()
+				dest.journal = None
+		return complete
+
+	# Close the metadata files.
+	def close(self):
+		self.lister.close()
+		if (self.hash_pool is not None):
+			self.hash_pool.shutdown()
+		with self.stats.phase("finish"):
+			for dest in self.dests:
+				for db in (dest.manifest, dest.hashes):
+					if (db is not None):
+						db.close()
+
+	# Plan a backup pass.  Takes the same changes and watcher as run().
+	# Walks the source tree one directory at a time and yields the
+	# Operations that bring the destinations up to date with it.  Each
+	# source directory is compared with its destination directories by
+	# name: files missing from or older in a destination are copied, and
+	# with -s, destination entries missing from the source are deleted.
+	# A destination directory is only listed when something needs to be
+	# checked against it.  The copies of a file to several destinations
+	# are yielded one after another.
+	def plan(self, changes=None, watcher=None):
+		moves = [None] * len(self.dests)
+		if (self.detect_moves):
+			moves = [MoveDetector(dest.root_abs, dest.manifest, dest.hashes)
+				for dest in self.dests]
+
+		# A subtree is only skipped if every destination finished it.
+		resumed = set()
+		journals = [dest.journal for dest in self.dests if (dest.journal is not None)]
+		if (len(journals) > 0) and (len(journals) == len(self.dests)):
+			resumed = set.intersection(*[journal.done for journal in journals])
+
+		if (changes is None):
+			tree = scan_tree(self.src_root_abs, lister=self.lister, companions=self._companions)
+			if (self.excluder is not None) and self.excluder.tree_excluded(self.src_root_abs):
+				tree = []
+				yield Operation("exclude", ".", self.src_root_abs, is_dir=True)
+			if ("." in resumed):
+				tree = []
+				yield Operation("skip", ".", self.src_root_abs, is_dir=True)
+		else:
+			tree = scan_changes(self.src_root_abs, self._included(changes), self.lister,
+				self._companions)
+		if (watcher is not None):
+			tree = watcher.watching(tree)
+
+		for (dirpath, dir_rel, files, dirs) in tree:
+			yield from self._plan_dir(dirpath, dir_rel, files, dirs, resumed, moves)
+
+		# Move, copy and delete the files held back by --detect-moves.
+		for (dest, detector) in zip(self.dests, moves):
+			if (detector is not None):
+				yield from self._plan_moves(dest, detector)
+
+	# Carry out a plan from plan().
+	# Copies are queued on pool, so they run while the plan goes on.  The
+	# copies of one file to several destinations are queued together, so
+	# the file is read once.  With dry_run the plan is only printed.
+	# Returns False if halted on an error.
+	def execute(self, ops, pool):
+		if not self.dry_run:
+			for dest in self.dests:
+				self._clean_temp(dest)
+		group = []
+		for op in ops:
+			if group and ((op.kind != "copy") or (op.path != group[0].path)):
+				self._submit(group, pool)
+				group = []
+				if pool.halted.is_set():
+					return False
+			self._show(op)
+			if (op.kind == "copy") and not self.dry_run:
+				group.append(op)
+			elif not self._apply(op, pool):
+				return False
+		if group:
+			self._submit(group, pool)
+		return not pool.halted.is_set()
+
+	# Plan one source directory.
+	# Entries removed from dirs are not walked.
+	def _plan_dir(self, dirpath, dir_rel, files, dirs, resumed, moves):
+		excluder = self.excluder
+		meta_dirs = []
+		if (dir_rel == "."):
+			meta_dirs = [d for d in dirs if (d.name == META_DIR)]
+			dirs[:] = [d for d in dirs if (d.name != META_DIR)]
+		yield Operation("dir", dir_rel, dirpath)
+
+		# A source that is itself a destination has metadata of its own,
+		# which is left out.  Any other directory with that name would land
+		# in the destination's metadata directory, so it is excluded.
+		for d in meta_dirs:
+			if not is_meta_dir(d.path):
+				yield Operation("exclude", dir_rel, d.path, is_dir=True)
+
+		# Prune excluded directories so they are never entered.
+		# Each one counts once in the excluded count.
+		excluded_dirs = []
+		if (excluder is not None):
+			with self.stats.phase("exclude"):
+				excluded_dirs = [d for d in dirs if excluder.dir_excluded(d.path)]
+			if (len(excluded_dirs) > 0):
+				names = set(d.name for d in excluded_dirs)
+				dirs[:] = [d for d in dirs if (d.name not in names)]
+			for d in excluded_dirs:
+				yield Operation("exclude", dir_rel, d.path, is_dir=True)
+
+		# Skip subtrees finished by an interrupted run.
+		resumed_dirs = []
+		if (len(resumed) > 0):
+			for d in dirs:
+				d_rel = d.name if (dir_rel == ".") else os.path.join(dir_rel, d.name)
+				if (d_rel in resumed):
+					resumed_dirs.append(d)
+			if (len(resumed_dirs) > 0):
+				names = set(d.name for d in resumed_dirs)
+				dirs[:] = [d for d in dirs if (d.name not in names)]
+			for d in resumed_dirs:
+				yield Operation("skip", dir_rel, d.path, is_dir=True)
+
+		# Stat the source files that aren't excluded.
+		sources = []
+		for entry in files:
+			sfn_abs = entry.path                         # source file absolute path
+
+			# See if this file is in the exclusion list.
+			if (excluder is not None):
+				with self.stats.phase("exclude"):
+					excluded = excluder.file_excluded(sfn_abs)
+				if excluded:
+					yield Operation("exclude", dir_rel, sfn_abs)
+					continue
+
+			try:
+				with self.stats.phase("stat"):
+					self.stats.stat_calls += 1
+					src_stat = entry.stat()
+			except OSError as err:
+				yield Operation("error", dir_rel, sfn_abs, error=err)
+				continue
+			sources.append((entry, src_stat))
+
+		# Compare the files with each destination, then yield the copies
+		# of each file to all the destinations that need it together.
+		mtime_ns = None
+		if any((dest.manifest is not None) for dest in self.dests):
+			try:
+				self.stats.stat_calls += 1
+				mtime_ns = os.stat(dirpath).st_mtime_ns
+			except OSError:
+				pass
+		copies = {}
+		src_digests = {}
+		dst_listings = []
+		for (dest, detector) in zip(self.dests, moves):
+			(dst_entries, ops) = self._compare(dest, detector, dir_rel, mtime_ns, files,
+				sources, src_digests)
+			dst_listings.append(dst_entries)
+			for op in ops:
+				if (op.kind == "copy"):
+					copies.setdefault(op.path, []).append(op)
+				else:
+					yield op
+		for (entry, src_stat) in sources:
+			yield from copies.get(entry.path, ())
+
+		# Sync option.
+		if self.sync:
+			kept = set(d.name for d in excluded_dirs + resumed_dirs)
+			for (dest, detector, dst_entries) in zip(self.dests, moves, dst_listings):
+				yield from self._plan_sync(dest, detector, dir_rel, files, dirs, kept,
+					dst_entries)
+		for dest in self.dests:
+			self.lister.forget(dest.dir_abs(dir_rel))
+
+	# Compare a directory's source files with one destination.
+	# sources is a list of (DirEntry, stat) for the files.  Source hashes are
+	# kept in src_digests so each source file is hashed once for all the
+	# destinations.  New files are held back in moves, if given.
+	# Returns (listing, ops): the destination directory's listing, or None
+	# if it wasn't needed, and a list of Operations for the directory.
+	def _compare(self, dest, moves, dir_rel, mtime_ns, files, sources, src_digests):
+		(manifest, hashes, journal) = (dest.manifest, dest.hashes, dest.journal)
+		(force_copy, delta_min) = (self.force_copy, self.delta_min)
+		dst_dir = dest.dir_abs(dir_rel)
+		dst_entries = None
+		missing = False
+
+		entries = {}
+		ops = []
+		if (manifest is not None) and (mtime_ns is not None):
+			with self.stats.phase("manifest"):
+				entries = manifest.begin_dir(dir_rel, mtime_ns, [e.name for e in files])
+			ops.append(Operation("manifest", dir_rel, dest=dest))
+
+		# Find the files that need to be compared with the destination.
+		candidates = []
+		for (entry, src_stat) in sources:
+
+			# A file left half updated by an interrupted --delta run must be
+			# copied again in full.
+			dirty = (journal is not None) and \
+				((entry.name if (dir_rel == ".") else os.path.join(dir_rel, entry.name)) in journal.dirty)
+
+			# Unchanged since the last backup according to the manifest.
+			if (not force_copy) and (not dirty) and (entries.get(entry.name) ==
+					(src_stat.st_size, src_stat.st_mtime_ns, src_stat.st_ino)):
+				continue
+
+			# Check for this file in the destination directory listing.
+			with self.stats.phase("stat"):
+				if (dst_entries is None):
+					dst_entries = self.lister.list(dst_dir)
+					missing = (dst_entries is None)
+					if missing:
+						dst_entries = {}
+				dst_stat = None
+				if (entry.name in dst_entries):
+					try:
+						self.stats.stat_calls += 1
+						dst_stat = dst_entries[entry.name].stat()
+					except OSError:
+						pass
+			candidates.append((entry, src_stat, dst_stat, dirty))
+
+		# With --checksum, hash both sides of every file that might be the
+		# same.  The hashes for a directory are computed in parallel.
+		digests = {}
+		if (self.checksum):
+			with self.stats.phase("checksum"):
+				jobs_list = []
+				for (entry, src_stat, dst_stat, dirty) in candidates:
+					if (not force_copy) and (dst_stat is not None) and \
+							(dst_stat.st_size == src_stat.st_size) and stat.S_ISREG(dst_stat.st_mode):
+						if (entry.path not in src_digests):
+							jobs_list.append((entry.path, src_stat, src_digests))
+						jobs_list.append((os.path.join(dst_dir, entry.name), dst_stat, digests))
+				results = self.hash_pool.map(lambda job: hashes.digest(job[0], job[1]), jobs_list)
+				for (job, digest) in zip(jobs_list, results):
+					job[2][job[0]] = digest
+
+		# With --verify, a destination file that is up to date by mtime is
+		# compared with the source by hash if it changed since its hash was
+		# kept.  Files copied with --verify have their hash kept, so only
+		# files touched since are read.
+		checked = {}
+		if (self.verify) and (not self.checksum) and (not force_copy):
+			with self.stats.phase("verify"):
+				jobs_list = [(entry, src_stat, dst_stat) for (entry, src_stat, dst_stat, dirty) in candidates
+					if (not dirty) and (dst_stat is not None) and (src_stat.st_mtime <= dst_stat.st_mtime)
+					and stat.S_ISREG(dst_stat.st_mode)]
+				results = self.hash_pool.map(lambda job: self._verify_file(hashes, dst_dir, *job),
+					jobs_list)
+				for (job, match) in zip(jobs_list, results):
+					checked[job[0].name] = match
+
+		for (entry, src_stat, dst_stat, dirty) in candidates:
+			sfn_abs = entry.path                         # source file absolute path
+			dfn_abs = os.path.join(dst_dir, entry.name)  # destination file absolute path
+			src_mtime = src_stat.st_mtime                # source file modification time
+			dst_mtime = 0
+			if (dst_stat is not None):
+				dst_mtime = dst_stat.st_mtime            # destination file modification time
+
+			# Decide whether to copy: by content with --checksum, otherwise
+			# by modification time.
+			src_digest = src_digests.get(sfn_abs)
+			match = checked.get(entry.name)
+			if force_copy or dirty or (match is False):
+				copy = True
+			elif (self.checksum):
+				copy = (src_digest is None) or (src_digest != digests.get(dfn_abs))
+			else:
+				copy = (src_mtime > dst_mtime)
+			if (match is False):
+				ops.append(Operation("mismatch", dir_rel, sfn_abs, dest, dfn_abs))
+
+			# Update large files in place with --delta.
+			delta = (delta_min > 0) and (dst_stat is not None) and (not dirty) and \
+				(src_stat.st_size >= delta_min) and stat.S_ISREG(dst_stat.st_mode) and \
+				not dst_entries[entry.name].is_symlink()
+
+			op = Operation("copy" if copy else "skip", dir_rel, sfn_abs, dest, dfn_abs,
+				stat=src_stat, digest=src_digest, delta=delta,
+				verified=self.verify and (self.checksum or (match is True)))
+
+			# With --detect-moves, new files are held back until the end of
+			# the walk in case they match a file about to be deleted.
+			if copy and (moves is not None) and (dst_stat is None):
+				moves.add_copy(op)
+				if missing:
+					moves.new_dirs.add(dst_dir)
+				continue
+			ops.append(op)
+
+		# The destination directory is created before the first copy to it.
+		if missing and any((op.kind == "copy") for op in ops):
+			ops.insert(0, Operation("mkdir", dir_rel, dest=dest, target=dst_dir))
+		return (dst_entries, ops)
+
+	# Compare a destination file with its source for --verify.  Each side's
+	# kept hash is used if the file hasn't changed since; otherwise the file
+	# is hashed, and the hash kept.
+	# Returns True if they match, False if not or if only one side could be
+	# hashed, or None if neither could.
+	def _verify_file(self, hashes, dst_dir, entry, src_stat, dst_stat):
+		src_digest = hashes.digest(entry.path, src_stat)
+		dst_digest = hashes.digest(os.path.join(dst_dir, entry.name), dst_stat)
+		if (src_digest is None) and (dst_digest is None):
+			return None
+		return (src_digest == dst_digest)
+
+	# Sync option.
+	# Plan the deletion of destination files and directories that don't
+	# exist in the source directory.  kept holds the names of source
+	# directories left out of the walk, which are kept too.  Directories the
+	# manifest shows as unchanged since the last sync are skipped.  With
+	# moves, the deletions are held back in it instead.
+	def _plan_sync(self, dest, moves, dir_rel, files, dirs, kept, dst_entries):
+		if (dest.manifest is not None) and dest.manifest.unchanged(dir_rel):
+			return
+		with self.stats.phase("sync"):
+			if (dst_entries is None):
+				dst_entries = self.lister.list(dest.dir_abs(dir_rel)) or {}
+			src_names = set(e.name for e in files)
+			src_names.update(e.name for e in dirs)
+			src_names.update(kept)
+			if (dir_rel == "."):
+				src_names.add(META_DIR)
+			extra = [dst_entries[name] for name in sorted(dst_entries) if (name not in src_names)]
+		for entry in extra:
+			if (moves is not None):
+				moves.add_delete(entry.path, entry_is_dir(entry))
+			else:
+				yield from self._plan_delete(dest, dir_rel, entry.path, entry_is_dir(entry))
+
+	# Plan the deletion of a destination file or directory tree.
+	# Directories are emptied depth first.  Every file and directory is
+	# deleted on its own, the same as if each had been found missing from
+	# the source.
+	def _plan_delete(self, dest, dir_rel, path, is_dir):
+		if is_dir:
+			entries = list_dir(path, self.stats) or {}
+			for name in sorted(entries):
+				yield from self._plan_delete(dest, dir_rel, entries[name].path,
+					entry_is_dir(entries[name]))
+		yield Operation("delete", dir_rel, dest=dest, target=path, is_dir=is_dir)
+
+	# Plan the copies and deletions held back by --detect-moves, moving
+	# destination files where a new file matches one about to be deleted.
+	def _plan_moves(self, dest, moves):
+		for op in moves.copies:
+			with self.stats.phase("moves"):
+				origin = moves.match(op.path, op.stat)
+			dst_dir = os.path.dirname(op.target)
+			if (dst_dir in moves.new_dirs):
+				moves.new_dirs.discard(dst_dir)
+				yield Operation("mkdir", op.dir_rel, dest=dest, target=dst_dir)
+			if (origin is not None):
+				yield Operation("move", op.dir_rel, op.path, dest, op.target, origin,
+					op.stat, op.digest, op.delta)
+			else:
+				yield op
+
+		(delete_files, delete_dirs) = moves.deletes()
+		for (path, is_dir) in [(f, False) for f in delete_files] + [(d, True) for d in delete_dirs]:
+			dir_rel = os.path.relpath(os.path.dirname(path), dest.root_abs)
+			yield Operation("delete", dir_rel, dest=dest, target=path, is_dir=is_dir)
+
+	# Print an operation, with -d or -v.
+	def _show(self, op):
+		kind = op.kind
+		if (kind == "exclude"):
+			if (self.verbose):
+				message("Excluding " + str(op.path))
+		elif not (self.dry_run or self.verbose):
+			return
+		elif (kind == "copy"):
+			message(str(op.path) + " -> " + str(op.target))
+		elif (kind == "move"):
+			message("Moving " + str(op.origin) + " -> " + str(op.target))
+		elif (kind == "delete"):
+			message("Deleting " + str(op.target))
+		elif (kind == "mkdir"):
+			message("Creating " + str(op.target))
+
+	# Carry out an operation other than a copy.  With dry_run only count it.
+	# Returns False if halted on an error.
+	def _apply(self, op, pool):
+		(kind, dest) = (op.kind, op.dest)
+		if (kind == "dir"):
+			# Held back --detect-moves work isn't done until the end of the
+			# walk, so no directory is finished before then.
+			if not self.detect_moves:
+				for dest in self.dests:
+					if (dest.journal is not None):
+						dest.journal.enter(op.dir_rel, pool.submitted)
+						dest.journal.flush(pool.watermark)
+		elif (kind == "exclude"):
+			self._count_source("excluded")
+		elif (kind == "skip"):
+			if op.is_dir:
+				self._set_skipped()
+			elif (dest.manifest is not None):
+				dest.manifest.set_file(op.dir_rel, os.path.basename(op.path), op.stat)
+			if op.verified:
+				dest.count("verified")
+		elif (kind == "manifest"):
+			dest.manifest.update_dir(op.dir_rel)
+		elif (kind == "mismatch"):
+			message("Verify failed: " + str(op.target) + " doesn't match " + str(op.path))
+			dest.count("mismatches")
+		elif (kind == "error"):
+			message("Error copying " + str(op.path) + ": " + str(op.error))
+			self._count_source("errors")
+			for dest in self.dests:
+				if (dest.journal is not None):
+					dest.journal.error(op.dir_rel)
+			return not self.error_halt
+		elif self.dry_run:
+			if (kind == "copy"):
+				dest.count("copied")   # Dry run: fake copy count
+			elif (kind == "move"):
+				dest.count("moved")    # Dry run: fake moved count
+			elif (kind == "delete"):
+				dest.count("deleted")  # Dry run: fake deleted count
+		elif (kind == "mkdir"):
+			try:
+				os.makedirs(op.target, exist_ok=True)
+			except OSError as err:
+				message("Error creating " + str(op.target) + ": " + str(err))
+				dest.count("errors")
+				if (dest.journal is not None):
+					dest.journal.error(op.dir_rel)
+				return not self.error_halt
+		elif (kind == "move"):
+			return self._move(op, pool)
+		elif (kind == "delete"):
+			return self._delete(op)
+		return True
+
+	# Queue the copies of one file to one or more destinations.
+	def _submit(self, group, pool):
+		targets = [(op.dest, op.target, self._recorder(op), op.delta) for op in group]
+		with self.stats.phase("copy"):
+			pool.submit(group[0].path, targets)
+
+	# The function that records a copy in the manifest and the hash store
+	# once it is done, or None if there are neither.  See CopyPool.submit().
+	def _recorder(self, op):
+		if (op.dest.manifest is None) and (op.dest.hashes is None):
+			return None
+		return functools.partial(self._record, op)
+
+	# Record a finished copy.  digest is the hash of the data copied, with
+	# --verify, which is kept for both the source and the destination.
+	def _record(self, op, digest):
+		dest = op.dest
+		if (digest is None):
+			digest = op.digest
+		elif (dest.hashes is not None):
+			dest.hashes.set(op.stat, digest)
+		record_backup(dest.manifest, op.dir_rel, os.path.basename(op.path), op.stat,
+			dest.hashes, op.target, digest)
+
+	# Move a destination file into place for --detect-moves.  If it can't
+	# be moved, the source file is copied and the old file deleted instead.
+	# Returns False if halted on an error.
+	def _move(self, op, pool):
+		dest = op.dest
+		with self.stats.phase("moves"):
+			try:
+				os.rename(op.origin, op.target)
+				dest.count("moved")
+				done = self._recorder(op)
+				if (done is not None):
+					done(None)
+				return True
+			except OSError as err:
+				message("Error moving " + str(op.origin) + ": " + str(err))
+				dest.count("errors")
+				dest.sync_errors += 1
+		copy = Operation("copy", op.dir_rel, op.path, dest, op.target, stat=op.stat,
+			digest=op.digest, delta=op.delta)
+		self._show(copy)
+		self._submit([copy], pool)
+		delete = Operation("delete", op.dir_rel, dest=dest, target=op.origin)
+		self._show(delete)
+		return self._delete(delete)
+
+	# Delete a destination file or empty directory.
+	# Returns False if halted on an error.
+	def _delete(self, op):
+		dest = op.dest
+		with self.stats.phase("sync"):
+			try:
+				if op.is_dir:
+					os.rmdir(op.target)
+				else:
+					os.remove(op.target)
+				dest.count("deleted")
+				return True
+			except OSError as err:
+				message("Error deleting " + str(op.target) + ": " + str(err))
+				dest.count("errors")
+		dest.sync_errors += 1
+		if (dest.journal is not None):
+			dest.journal.error(op.dir_rel)
+		return not self.error_halt
+
+	# Destination directories to list ahead along with a source directory.
+	# Without a manifest, every destination directory with files in the
+	# source is listed; with one, most never need listing.
+	def _companions(self, dir_rel):
+		return [dest.dir_abs(dir_rel) for dest in self.dests if (dest.manifest is None)]
+
+	# Count a result of the source scan, which applies to every destination.
+	def _count_source(self, name):
+		self.counts.count(name)
+		for dest in self.dests:
+			dest.counts.count(name)
+
+	# Note that subtrees were skipped by --resume.
+	def _set_skipped(self):
+		for dest in self.dests:
+			dest.journal.skipped = True
+
+	# Open the journal for a destination.  Directories finished by an
+	# interrupted run are skipped with resume.  Raises MetaError if it can't
+	# be opened.
+	def _open_journal(self, dest, resume):
+		if self.dry_run:
+			return None
+		journal_path = os.path.join(dest.meta_abs, JOURNAL_FILE)
+		try:
+			if not os.path.isdir(dest.meta_abs):
+				os.makedirs(dest.meta_abs)
+			return Journal(journal_path, dest.root_abs, resume)
+		except OSError as err:
+			raise MetaError("Error opening " + str(journal_path) + ": " + str(err)) from err
+
+	# Delete the temporary files left in a destination by copies that were
+	# interrupted.
+	def _clean_temp(self, dest):
+		entries = list_dir(dest.tmp_abs)
+		for entry in (entries or {}).values():
+			try:
+				os.remove(entry.path)
+			except OSError:
+				pass
+
+	# Remove a destination's temporary and metadata directories after a
+	# complete pass if nothing is left in them, so a backup without
+	# metadata options leaves no trace in the destination.
+	def _remove_meta_dir(self, dest):
+		for path in (dest.tmp_abs, dest.meta_abs):
+			try:
+				os.rmdir(path)
+			except OSError:
+				pass
+
+	# Drop changed directories that are excluded or in the metadata
+	# directory.  New directories weren't checked against the exclude list
+	# when they appeared.
+	def _included(self, changes):
+		included = {}
+		for (dir_rel, recursive) in changes.items():
+			if (dir_rel.split(os.sep)[0] == META_DIR):
+				continue
+			path = os.path.join(self.src_root_abs, dir_rel)
+			if (self.excluder is not None) and self.excluder.tree_excluded(path):
+				continue
+			included[dir_rel] = recursive
+		return included
+
 
 ##############################################################################
-# NOTE:
-# Indentation is important to Python files.
-# This file uses tabs for indentation.  Please set your editor accordingly.
-# I use Notepad++ with 4-space tabs.
+# Persistent manifest of the source tree, kept in <dst-dir>.
+#
+# Records the size, mtime_ns and inode of every source file as of its last
+# successful backup, and the mtime of every source directory.  A file whose
+# stat still matches its manifest entry is known to be backed up, so the
+# destination does not need to be checked at all.  A directory whose mtime
+# is unchanged since the last sync has the same entries as before, so the
+# sync pass can skip it.
+#
+# The manifest is a SQLite database.  Entries are only written after a copy
+# succeeds and are committed in batches, so an interrupted run just loses
+# the last few entries and those files get checked again next time.
+# Assumes <dst-dir> is only modified by backup.py.
 ##############################################################################
+class Manifest(MetaDB):
+
+	def __init__(self, path, readonly=False):
+		MetaDB.__init__(self, path, readonly)
+		self._run = time.time_ns()
+		self._unchanged = set()
+		self._gone = {}
+		self._dirs = {}
+		if not readonly:
+			self._db.execute("CREATE TABLE IF NOT EXISTS dirs ("
+				"dir TEXT PRIMARY KEY, mtime_ns INTEGER, synced INTEGER, seen INTEGER"
+				") WITHOUT ROWID")
+			self._db.execute("CREATE TABLE IF NOT EXISTS files ("
+				"dir TEXT, name TEXT, size INTEGER, mtime_ns INTEGER, ino INTEGER, "
+				"PRIMARY KEY (dir, name)) WITHOUT ROWID")
+			self._db.commit()
+
+	# Start a new backup pass.  Directories scanned from now on are the ones
+	# prune() keeps and mark_synced() marks.
+	def new_run(self):
+		with self._lock:
+			self._run = time.time_ns()
+			self._unchanged = set()
+			self._gone = {}
+			self._dirs = {}
+
+	# Start scanning a source directory.
+	# Returns the manifest entries for the directory's files as a dictionary
+	# of name -> (size, mtime_ns, ino).  Entries for files that are no longer
+	# in the directory are left out, and dropped from the manifest along
+	# with recording the directory's mtime when update_dir() is called.
+	# Nothing is written until then, so planning a backup doesn't change
+	# the manifest.
+	def begin_dir(self, dir_rel, mtime_ns, filenames):
+		with self._lock:
+			row = self._db.execute("SELECT mtime_ns, synced FROM dirs WHERE dir = ?",
+				(dir_rel,)).fetchone()
+			entries = {}
+			for (name, size, mtime, ino) in self._db.execute(
+					"SELECT name, size, mtime_ns, ino FROM files WHERE dir = ?", (dir_rel,)):
+				entries[name] = (size, mtime, ino)
+
+			unchanged = (row is not None) and (row[0] == mtime_ns)
+			if unchanged and row[1]:
+				self._unchanged.add(dir_rel)
+			if self._readonly:
+				return entries
+
+			gone = set()
+			if not unchanged:
+				gone = set(entries) - set(filenames)
+				for name in gone:
+					self._gone[(dir_rel, name)] = entries.pop(name)
+			self._dirs[dir_rel] = (mtime_ns, 1 if (unchanged and row[1]) else 0, gone)
+			return entries
+
+	# Write what begin_dir() found for a source directory to the manifest.
+	def update_dir(self, dir_rel):
+		if self._readonly:
+			return
+		with self._lock:
+			(mtime_ns, synced, gone) = self._dirs.pop(dir_rel)
+			self._db.executemany("DELETE FROM files WHERE dir = ? AND name = ?",
+				[(dir_rel, name) for name in gone])
+			self._db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)",
+				(dir_rel, mtime_ns, synced, self._run))
+			self._changed(1)
+
+	# Return the (size, mtime_ns, ino) last recorded for a path in this or
+	# the previous run, or None.  Entries dropped during this run because
+	# the file disappeared from its directory are still returned.
+	def previous(self, dir_rel, name):
+		with self._lock:
+			if (dir_rel, name) in self._gone:
+				return self._gone[(dir_rel, name)]
+			return self._db.execute("SELECT size, mtime_ns, ino FROM files "
+				"WHERE dir = ? AND name = ?", (dir_rel, name)).fetchone()
+
+	# Record a source file as backed up.
+	def set_file(self, dir_rel, name, st):
+		if self._readonly:
+			return
+		with self._lock:
+			self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+				(dir_rel, name, st.st_size, st.st_mtime_ns, st.st_ino))
+			self._changed(1)
+
+	# True if a source directory has the same entries as when the
+	# destination was last synced to it.
+	def unchanged(self, dir_rel):
+		return (dir_rel in self._unchanged)
+
+	# Mark every directory seen in this run as synced.
+	def mark_synced(self):
+		if self._readonly:
+			return
+		with self._lock:
+			self._db.execute("UPDATE dirs SET synced = 1 WHERE seen = ?", (self._run,))
+			self._changed(1)
+
+	# Drop entries for directories that were not seen in this run.
+	# Only call this after a complete scan of the source tree.
+	def prune(self):
+		if self._readonly:
+			return
+		with self._lock:
+			self._db.execute("DELETE FROM files WHERE dir IN "
+				"(SELECT dir FROM dirs WHERE seen != ?)", (self._run,))
+			self._db.execute("DELETE FROM dirs WHERE seen != ?", (self._run,))
+			self._changed(1)
 
-import getopt
-import os.path
-import shutil
-import sys
 
 ##############################################################################
-# Print usage syntax.
+# Detects files that were moved or renamed in the source.
+#
+# During a sync, new source files and the destination files about to be
+# deleted are both held back until the walk is done.  Each new file is then
+# matched against the deletions of the same size: first by inode and
+# mtime, using the manifest's record of which source file each destination
+# file came from, and failing that by content hash.  A file rewritten in
+# place keeps its inode, so the inode alone doesn't show it is unchanged.
+# A match is moved into place with os.rename instead of being copied and
+# deleted.
 ##############################################################################
-def print_usage():
-	print("Usage:", sys.argv[0], "[-dfhsvx] <src-dir> <dst-dir>")
-	print("  Copy files from <src-dir> to <dst-dir>")
-	print("  <src-dir> and <dst-dir> are directories")
-	print("  -d = Dry run: print what would happen without actually copying")
-	print("  -f = Force copy even if destination file is newer")
-	print("  -h = Halt on copy error (default = skip and keep copying)")
-	print("  -s = Sync: delete files in <dst-dir> that are not in <src-dir>")
-	print("  -v = Verbose printing")
-	print("  -x <file> Exclude files listed in <file>")
-	sys.exit(2)
+class MoveDetector(object):
+
+	def __init__(self, dst_root_abs, manifest, hashes):
+		self.copies = []
+		self.new_dirs = set()
+		self._dst_root_abs = dst_root_abs
+		self._manifest = manifest
+		self._hashes = hashes
+		self._by_size = {}
+		self._files = []
+		self._dirs = []
+		self._digests = {}
+
+	# Hold back the deletion of a destination file or directory tree.
+	def add_delete(self, path, is_dir):
+		if not is_dir:
+			self._add_file(path)
+			return
+		tree = []
+		for (dirpath, dir_rel, files, dirs) in scan_tree(path):
+			tree.append(dirpath)
+			for entry in files:
+				self._add_file(entry.path)
+			for entry in dirs:
+				if entry.is_symlink():
+					self._add_file(entry.path)
+		self._dirs.extend(reversed(tree))
+
+	# Hold back the copy Operation of a new source file.
+	def add_copy(self, op):
+		self.copies.append(op)
+
+	# Find a held back deletion with the same contents as a source file.
+	# Returns its path and removes it from the deletions, or returns None.
+	def match(self, sfn_abs, src_stat):
+		candidates = self._by_size.get(src_stat.st_size)
+		if (src_stat.st_size == 0) or not candidates:
+			return None
+
+		if (self._manifest is not None):
+			for path in candidates:
+				(dir_path, name) = os.path.split(path)
+				prev = self._manifest.previous(os.path.relpath(dir_path, self._dst_root_abs), name)
+				if (prev is not None) and (prev == (src_stat.st_size, src_stat.st_mtime_ns, src_stat.st_ino)):
+					return self._take(path)
+
+		src_digest = self._digest(sfn_abs, src_stat)
+		if (src_digest is not None):
+			for path in candidates:
+				if (self._digest(path, None) == src_digest):
+					return self._take(path)
+		return None
+
+	# Files still to delete, then directories in bottom-up order.
+	def deletes(self):
+		files = set()
+		for paths in self._by_size.values():
+			files.update(paths)
+		return [path for path in self._files if (path in files)], self._dirs
+
+	def _add_file(self, path):
+		self._files.append(path)
+		try:
+			size = os.lstat(path).st_size
+		except OSError:
+			size = -1
+		self._by_size.setdefault(size, []).append(path)
+
+	def _take(self, path):
+		for paths in self._by_size.values():
+			if path in paths:
+				paths.remove(path)
+				break
+		return path
+
+	def _digest(self, path, st):
+		if path not in self._digests:
+			try:
+				if (st is None):
+					st = os.lstat(path)
+				if not stat.S_ISREG(st.st_mode):
+					self._digests[path] = None
+				elif (self._hashes is not None):
+					self._digests[path] = self._hashes.digest(path, st)
+				else:
+					self._digests[path] = hash_file(path)
+			except OSError:
+				self._digests[path] = None
+		return self._digests[path]
+
 
-	
 ##############################################################################
-# Print copy, deleted and error counts.
+# Cache of file content hashes, kept in <dst-dir>.
+#
+# Hashes are stored by device and inode along with the file's size and
+# mtime_ns, and are only reused while those still match.  A file that has
+# not changed since it was last hashed is never read again, whichever side
+# of the backup it is on.  A copied file's hash is stored for the new
+# destination file too, so it doesn't need to be read back.
 ##############################################################################
-def print_counts(copy_count, deleted_count, excluded_count, error_count, dry_run):
-	if dry_run:
-		print("Dry run results, no actions actually taken")
-	print("Files copied:   " + str(copy_count))
-	print("Files deleted:  " + str(deleted_count))
-	print("Files excluded: " + str(excluded_count))
-	print("Errors:         " + str(error_count))
-	
-	
+class HashStore(MetaDB):
+
+	def __init__(self, path, readonly=False):
+		MetaDB.__init__(self, path, readonly)
+		if not readonly:
+			self._db.execute("CREATE TABLE IF NOT EXISTS hashes ("
+				"dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, digest BLOB, "
+				"PRIMARY KEY (dev, ino)) WITHOUT ROWID")
+			self._db.commit()
+
+	# Return the hash of a file, reading it only if the cached hash is stale.
+	# Returns None if the file can't be read.
+	def digest(self, path, st):
+		digest = self.cached(st)
+		if (digest is not None):
+			return digest
+
+		try:
+			digest = hash_file(path)
+		except OSError:
+			return None
+		self.set(st, digest)
+		return digest
+
+	# Return the cached hash of a file with the given stat result, or None
+	# if there isn't one or the file changed since.  Never reads the file.
+	def cached(self, st):
+		with self._lock:
+			try:
+				row = self._db.execute("SELECT size, mtime_ns, digest FROM hashes "
+					"WHERE dev = ? AND ino = ?", (st.st_dev, st.st_ino)).fetchone()
+			except sqlite3.Error:
+				row = None
+		if (row is not None) and (row[0] == st.st_size) and (row[1] == st.st_mtime_ns):
+			return row[2]
+		return None
+
+	# Store the hash of a file with the given stat result.
+	def set(self, st, digest):
+		if self._readonly:
+			return
+		with self._lock:
+			self._db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)",
+				(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, digest))
+			self._changed(1)
+
+
 ##############################################################################
-# Script execution starts here.
-##############################################################################     
-if __name__ == "__main__":
-	
+# Index of the files in each snapshot, kept in <dst-dir>.
+# Maps every file in a snapshot to the source size and mtime_ns it was
+# taken from and the hash of its contents, which names its object in the
+# object store.  Snapshots are numbered in the order they were begun.
+##############################################################################
+class SnapshotIndex(MetaDB):
+
+	def __init__(self, path, readonly=False):
+		MetaDB.__init__(self, path, readonly)
+		if not readonly:
+			self._db.execute("CREATE TABLE IF NOT EXISTS snapshots ("
+				"name TEXT PRIMARY KEY, complete INTEGER, seq INTEGER) WITHOUT ROWID")
+			self._db.execute("CREATE TABLE IF NOT EXISTS files ("
+				"snapshot TEXT, dir TEXT, name TEXT, size INTEGER, mtime_ns INTEGER, "
+				"digest BLOB, PRIMARY KEY (snapshot, dir, name)) WITHOUT ROWID")
+
+			# Number the snapshots of an index made before they were
+			# numbered, in name order.
+			columns = [row[1] for row in self._db.execute("PRAGMA table_info(snapshots)")]
+			if ("seq" not in columns):
+				self._db.execute("ALTER TABLE snapshots ADD COLUMN seq INTEGER")
+				names = [row[0] for row in self._db.execute("SELECT name FROM snapshots")]
+				for (seq, name) in enumerate(sorted(names, key=snapshot_key), 1):
+					self._db.execute("UPDATE snapshots SET seq = ? WHERE name = ?", (seq, name))
+			self._db.commit()
+
+	# Numbers of the complete snapshots, as a dictionary of name -> seq.
+	# A read-only index made before snapshots were numbered has them all
+	# as 0.
+	def order(self):
+		with self._lock:
+			try:
+				try:
+					rows = self._db.execute("SELECT name, seq FROM snapshots "
+						"WHERE complete = 1").fetchall()
+				except sqlite3.OperationalError:
+					rows = self._db.execute("SELECT name, 0 FROM snapshots "
+						"WHERE complete = 1").fetchall()
+			except sqlite3.Error:
+				return {}
+		return dict(rows)
+
+	# Name of the newest complete snapshot, or None.
+	def latest(self):
+		order = self.order()
+		return max(order, key=lambda name: (order[name], snapshot_key(name)), default=None)
+
+	# Files of one directory in a snapshot, as a dictionary of
+	# name -> (size, mtime_ns, digest).
+	def entries(self, snapshot, dir_rel):
+		entries = {}
+		if (snapshot is None):
+			return entries
+		with self._lock:
+			for (name, size, mtime, digest) in self._db.execute(
+					"SELECT name, size, mtime_ns, digest FROM files "
+					"WHERE snapshot = ? AND dir = ?", (snapshot, dir_rel)):
+				entries[name] = (size, mtime, digest)
+		return entries
+
+	# Add a new, incomplete snapshot, numbered after all the others.
+	# Returns False if the name is taken.
+	def begin(self, snapshot):
+		if self._readonly:
+			return True
+		with self._lock:
+			try:
+				self._db.execute("INSERT INTO snapshots SELECT ?, 0, "
+					"COALESCE(MAX(seq), 0) + 1 FROM snapshots", (snapshot,))
+			except sqlite3.IntegrityError:
+				return False
+			self._db.commit()
+		return True
+
+	def add(self, snapshot, dir_rel, name, st, digest):
+		if self._readonly:
+			return
+		with self._lock:
+			self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+				(snapshot, dir_rel, name, st.st_size, st.st_mtime_ns, digest))
+			self._changed(1)
+
+	def finish(self, snapshot):
+		if self._readonly:
+			return
+		with self._lock:
+			self._db.execute("UPDATE snapshots SET complete = 1 WHERE name = ?", (snapshot,))
+			self._db.commit()
+
+	def remove(self, snapshot):
+		if self._readonly:
+			return
+		with self._lock:
+			self._db.execute("DELETE FROM files WHERE snapshot = ?", (snapshot,))
+			self._db.execute("DELETE FROM snapshots WHERE name = ?", (snapshot,))
+			self._db.commit()
+
+
+##############################################################################
+# Open one of the metadata databases in <dst-dir>.
+# A dry run never changes <dst-dir>, so it opens an existing database
+# read-only, or returns None if there isn't one yet.
+# Raises MetaError if the database can't be opened.
+##############################################################################
+def open_meta_db(cls, dst_root_abs, filename, dry_run):
+	meta_path = os.path.join(dst_root_abs, META_DIR)
+	path = os.path.join(meta_path, filename)
+	try:
+		if not dry_run:
+			if not os.path.isdir(meta_path):
+				os.makedirs(meta_path)
+			return cls(path)
+		if os.path.exists(path):
+			return cls(path, readonly=True)
+		return None
+	except (OSError, sqlite3.Error) as err:
+		raise MetaError("Error opening " + str(path) + ": " + str(err)) from err
+
+
+##############################################################################
+# Compiled exclude list.
+#
+# Plain entries are kept in hash sets, so checking a path costs one lookup
+# however long the list is.  Entries containing the glob characters * ? or [
+# are combined into one regular expression per kind.  An entry ending in a
+# slash excludes a directory; the walk prunes it so it is never entered.
+##############################################################################
+class ExcludeList(object):
+
+	def __init__(self, specs):
+		self._files = set()
+		self._dirs = set()
+		file_globs = []
+		dir_globs = []
+		for spec in specs:
+			is_dir = (spec[-1] == '\\') or (spec[-1] == '/')
+			key = self._key(spec)
+			if any((c in spec) for c in "*?["):
+				pattern = fnmatch.translate(key)
+				if is_dir:
+					dir_globs.append(pattern)
+				else:
+					file_globs.append(pattern)
+			elif is_dir:
+				self._dirs.add(key)
+			else:
+				self._files.add(key)
+		self._file_re = self._compile(file_globs)
+		self._dir_re = self._compile(dir_globs)
+
+	# True if a file should be excluded.
+	def file_excluded(self, path):
+		key = self._key(path)
+		if key in self._files:
+			return True
+		return (self._file_re is not None) and (self._file_re.match(key) is not None)
+
+	# True if a directory and everything under it should be excluded.
+	def dir_excluded(self, path):
+		key = self._key(path)
+		if key in self._dirs:
+			return True
+		return (self._dir_re is not None) and (self._dir_re.match(key) is not None)
+
+	# True if a directory or any directory above it should be excluded.
+	def tree_excluded(self, path):
+		path = os.path.abspath(path)
+		while True:
+			if self.dir_excluded(path):
+				return True
+			parent = os.path.dirname(path)
+			if (parent == path):
+				return False
+			path = parent
+
+	@staticmethod
+	def _key(path):
+		return os.path.normcase(path.rstrip("/\\"))
+
+	@staticmethod
+	def _compile(patterns):
+		if (len(patterns) == 0):
+			return None
+		return re.compile("|".join("(?:" + p + ")" for p in patterns))
+
+
+##############################################################################
+# Watches the directories of a source tree for changes with Linux inotify.
+#
+# inotify isn't recursive, so every directory is watched separately as the
+# backup walks it.  Events are collected in changes, a dictionary of the
+# source directories that need to be compared again: dir_rel -> True if
+# the directory is new and its whole subtree needs walking.  overflow is
+# set if the kernel dropped events, after which only a full pass can be
+# trusted.
+##############################################################################
+class Watcher(object):
+
+	IN_ATTRIB      = 0x00000004
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_FROM  = 0x00000040
+	IN_MOVED_TO    = 0x00000080
+	IN_CREATE      = 0x00000100
+	IN_DELETE      = 0x00000200
+	IN_DELETE_SELF = 0x00000400
+	IN_MOVE_SELF   = 0x00000800
+	IN_Q_OVERFLOW  = 0x00004000
+	IN_IGNORED     = 0x00008000
+	IN_ONLYDIR     = 0x01000000
+	IN_ISDIR       = 0x40000000
+	IN_NONBLOCK    = 0o4000
+	IN_CLOEXEC     = 0o2000000
+
+	MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+		IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+	EVENT = struct.Struct("iIII")     # wd, mask, cookie, len; then the name
+	READ_SIZE = 64 * 1024
+
+	def __init__(self):
+		try:
+			libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+			self._init1 = libc.inotify_init1
+			self._add_watch = libc.inotify_add_watch
+			self._rm_watch = libc.inotify_rm_watch
+		except (OSError, AttributeError):
+			raise OSError(errno.ENOSYS, "inotify is not available")
+		self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+		self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+		self._fd = self._init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+		if (self._fd < 0):
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err))
+		self._poll = select.poll()
+		self._poll.register(self._fd, select.POLLIN)
+		self._wds = {}              # watch descriptor -> dir_rel
+		self._full = False
+		self.changes = {}
+		self.overflow = False
+
+	# Watch the directories of a tree as they are walked.
+	def watching(self, tree):
+		for item in tree:
+			self.add(item[0], item[1])
+			yield item
+
+	# Watch a directory.  Watching an already watched directory again
+	# updates its path, as it may have been moved.
+	def add(self, dirpath, dir_rel):
+		wd = self._add_watch(self._fd, os.fsencode(dirpath), self.MASK)
+		if (wd >= 0):
+			self._wds[wd] = dir_rel
+			return
+		err = ctypes.get_errno()
+		if (err == errno.ENOSPC) and not self._full:
+			message("Too many directories to watch; changes in some are only seen by "
+				"full passes.  Raise fs.inotify.max_user_watches to watch them all.")
+			self._full = True
+		elif (err not in (errno.ENOENT, errno.ENOTDIR, errno.ENOSPC)):
+			message("Error watching " + str(dirpath) + ": " + os.strerror(err))
+
+	# Wait up to timeout seconds (forever if None) for events and record
+	# them.  Returns True if there were any.
+	def read(self, timeout):
+		if not self._poll.poll(None if (timeout is None) else int(timeout * 1000)):
+			return False
+		try:
+			data = os.read(self._fd, self.READ_SIZE)
+		except BlockingIOError:
+			return False
+		offset = 0
+		while (offset < len(data)):
+			(wd, mask, cookie, length) = self.EVENT.unpack_from(data, offset)
+			offset += self.EVENT.size
+			name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+			offset += length
+			self._event(wd, mask, name)
+		return True
+
+	def close(self):
+		os.close(self._fd)
+
+	def _event(self, wd, mask, name):
+		if (mask & self.IN_Q_OVERFLOW):
+			self.overflow = True
+			return
+		if (mask & self.IN_IGNORED):
+			self._wds.pop(wd, None)
+			return
+		dir_rel = self._wds.get(wd)
+		if (dir_rel is None):
+			return
+
+		# A moved directory keeps its watch, under the old path.  Drop it;
+		# the walk of the new path watches it again.
+		if (mask & self.IN_MOVE_SELF):
+			self._rm_watch(self._fd, wd)
+			self._wds.pop(wd, None)
+			return
+		if not name:
+			return
+
+		self._changed(dir_rel, False)
+		if (mask & self.IN_ISDIR) and (mask & (self.IN_CREATE | self.IN_MOVED_TO)):
+			self._changed(name if (dir_rel == ".") else os.path.join(dir_rel, name), True)
+
+	def _changed(self, dir_rel, recursive):
+		self.changes[dir_rel] = self.changes.get(dir_rel, False) or recursive
+
+
+##############################################################################
+# Keep the destination up to date with the source as it changes, after a
+# first full pass with the same watcher.
+#
+# Changes are collected until none have arrived for debounce seconds, or
+# for at most WATCH_MAX_DELAY seconds while they keep coming, and then the
+# directories they were in are backed up in one pass.  A full pass runs
+# every rescan seconds (never if 0) and whenever the kernel drops events.
+# Stops on Ctrl-C or SIGTERM.
+# Returns False if halted on an error.
+##############################################################################
+def watch_tree(backup, watcher, debounce, rescan):
+	if (backup.verbose):
+		message("Watching " + backup.src_root_abs)
+	next_rescan = (time.monotonic() + rescan) if (rescan > 0) else None
+	first = None        # time of the first and last change not yet backed up
+	last = None
+	try:
+		while True:
+			now = time.monotonic()
+			timeout = None
+			if (last is not None):
+				timeout = max(min(last + debounce, first + WATCH_MAX_DELAY) - now, 0)
+			if (next_rescan is not None):
+				wait = max(next_rescan - now, 0)
+				timeout = wait if (timeout is None) else min(timeout, wait)
+			if watcher.read(timeout) and watcher.changes:
+				last = time.monotonic()
+				if (first is None):
+					first = last
+
+			now = time.monotonic()
+			if watcher.overflow or ((next_rescan is not None) and (now >= next_rescan)):
+				if (backup.verbose):
+					message("Rescanning " + backup.src_root_abs)
+				watcher.overflow = False
+				watcher.changes = {}
+				first = last = None
+				if (rescan > 0):
+					next_rescan = now + rescan
+				if not backup.run(watcher=watcher):
+					return False
+			elif (last is not None) and ((now - last >= debounce) or (now - first >= WATCH_MAX_DELAY)):
+				changes = watcher.changes
+				watcher.changes = {}
+				first = last = None
+				if not backup.run(changes, watcher=watcher):
+					return False
+	except KeyboardInterrupt:
+		return True
+
+
+##############################################################################
+# Performance statistics for a run, written as JSON with --stats.
+#
+# Phases are wall-clock time spent by the main thread, so they add up to
+# the run's elapsed time; whatever isn't attributed to a phase is reported
+# as "other".  With -j, "copy" is the time the scan spent waiting for the
+# copy workers, and copy_busy is the time the workers spent copying, summed
+# across workers.  Also keeps the slowest copies and the directories with
+# the most entries, which cost the most listing and stat calls.
+##############################################################################
+class RunStats(object):
+
+	TOP = 10                 # slowest files and largest directories kept
+	PROGRESS_INTERVAL = 1.0  # seconds between progress line updates
+
+	shown = None             # the RunStats showing a progress line, if any
+
+	def __init__(self, counts=None):
+		self.path = None
+		self.counts = Counts() if (counts is None) else counts
+		self.phases = {}
+		self.dirs_listed = 0
+		self.entries_listed = 0
+		self.stat_calls = 0
+		self.copy_busy = 0.0
+		self._start = time.time()
+		self._clock = time.perf_counter()
+		self._lock = threading.Lock()
+		self._slowest = []       # heap of (seconds, bytes, path)
+		self._largest = []       # heap of (entries, seconds, path)
+		self._progress = None
+		self._progress_stop = threading.Event()
+		self._timers = {}
+
+	# Time a block of the main thread against a phase:
+	#   with stats.phase("scan"):
+	def phase(self, name):
+		timer = self._timers.get(name)
+		if (timer is None):
+			timer = self._timers[name] = PhaseTimer(self.phases, name)
+		return timer
+
+	# A directory was listed.
+	def listed(self, path, entries, seconds):
+		with self._lock:
+			self.dirs_listed += 1
+			self.entries_listed += entries
+			self._keep(self._largest, (entries, seconds, path))
+
+	# A file was copied.
+	def copied(self, path, written, seconds):
+		with self._lock:
+			self.copy_busy += seconds
+			self._keep(self._slowest, (seconds, written, path))
+
+	# Show a progress line on stderr until finish() is called.
+	def start_progress(self):
+		RunStats.shown = self
+		self._progress = threading.Thread(target=self._show_progress)
+		self._progress.daemon = True
+		self._progress.start()
+
+	# Erase the progress line so a message can be printed.
+	# Call with output_lock held.
+	def clear_progress(self):
+		if (self._progress is not None):
+			sys.stderr.write("\r\033[K")
+
+	# Stop the progress line and write the statistics file.
+	def finish(self):
+		if (self._progress is not None):
+			self._progress_stop.set()
+			self._progress.join()
+			with output_lock:
+				sys.stderr.write("\r" + self._progress_line() + "\n")
+				if (RunStats.shown is self):
+					RunStats.shown = None
+			self._progress = None
+		if (self.path is None):
+			return
+		try:
+			with open(self.path, "w") as f:
+				json.dump(self.report(), f, indent=2)
+				f.write("\n")
+		except OSError as err:
+			print("Error writing " + str(self.path) + ": " + str(err))
+
+	# The statistics as a dictionary.
+	def report(self):
+		elapsed = time.perf_counter() - self._clock
+		phases = dict((name, round(t, 6)) for (name, t) in sorted(self.phases.items()))
+		phases["other"] = round(max(elapsed - sum(self.phases.values()), 0.0), 6)
+		with self._lock:
+			slowest = sorted(self._slowest, reverse=True)
+			largest = sorted(self._largest, reverse=True)
+		run_counts = self.counts.copy()
+		return {
+			"started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self._start)),
+			"elapsed": round(elapsed, 6),
+			"phases": phases,
+			"copy_busy": round(self.copy_busy, 6),
+			"counts": run_counts,
+			"dirs_listed": self.dirs_listed,
+			"entries_listed": self.entries_listed,
+			"stat_calls": self.stat_calls,
+			"files_per_sec": round(run_counts["copied"] / elapsed, 3) if elapsed > 0 else 0.0,
+			"mb_per_sec": round(run_counts["bytes"] / 1e6 / elapsed, 3) if elapsed > 0 else 0.0,
+			"slowest_files": [{"path": p, "bytes": n, "seconds": round(t, 6)}
+				for (t, n, p) in slowest],
+			"largest_dirs": [{"path": p, "entries": n, "seconds": round(t, 6)}
+				for (n, t, p) in largest],
+		}
+
+	# Keep the TOP largest items of a heap.  Call with the lock held.
+	def _keep(self, heap, item):
+		if (len(heap) < self.TOP):
+			heapq.heappush(heap, item)
+		elif (item > heap[0]):
+			heapq.heapreplace(heap, item)
+
+	def _progress_line(self):
+		elapsed = time.perf_counter() - self._clock
+		counts = self.counts
+		rate = (counts["bytes"] / 1e6 / elapsed) if (elapsed > 0) else 0.0
+		return ("%d dirs, %d entries scanned, %d files copied, %.1f MB at %.1f MB/s, %d errors" %
+			(self.dirs_listed, self.entries_listed, counts["copied"], counts["bytes"] / 1e6,
+			rate, counts["errors"]))
+
+	def _show_progress(self):
+		while not self._progress_stop.wait(self.PROGRESS_INTERVAL):
+			with output_lock:
+				sys.stderr.write("\r\033[K" + self._progress_line())
+				sys.stderr.flush()
+
+
+# Adds the time spent in a with block to a phase's total.  Not reentrant;
+# RunStats.phase() keeps one per phase for the main thread.
+class PhaseTimer(object):
+
+	__slots__ = ("_phases", "_name", "_start")
+
+	def __init__(self, phases, name):
+		self._phases = phases
+		self._name = name
+		phases[name] = 0.0
+
+	def __enter__(self):
+		self._start = time.perf_counter()
+
+	def __exit__(self, *exc):
+		self._phases[self._name] += time.perf_counter() - self._start
+		return False
+
+
+
+##############################################################################
+# Run backup.py with the command line arguments in argv, not including the
+# program name.  Returns the exit code.
+##############################################################################
+def main(argv):
+
 	# Local initialization.
-	copy_count     = 0
-	deleted_count  = 0
-	excluded_count = 0
-	error_count    = 0
 	dry_run        = False
 	error_halt     = False
 	exclude        = False
 	excludeFile    = None
 	excludeList    = []
+	excluder       = None
+	checksum       = False
+	debounce       = WATCH_DEBOUNCE
+	delta_min      = 0
+	detect_moves   = False
 	force_copy     = False
+	jobs           = 1
+	keep           = 0
+	prune_only     = False
+	progress       = False
+	report         = False
+	rescan         = WATCH_RESCAN
+	scan_jobs      = 1
+	resume         = False
+	snapshot       = False
+	stats_path     = None
 	sync           = False
+	use_manifest   = False
 	verbose        = False
-        
+	verify         = False
+	read_back      = False
+	watch          = False
+
 	# Get command line options and arguments.
 	try:
-		(opts, args) = getopt.getopt(sys.argv[1:], "dfhsvx:")
+		(opts, args) = getopt.getopt(argv, "dfhj:mrsvx:", ["checksum", "delta=",
+			"detect-moves", "debounce=", "keep=", "progress", "prune", "rescan=", "resume",
+			"scan-jobs=", "snapshot", "stats=", "verify", "verify-read", "watch"])
 	except getopt.GetoptError as err:
-		print str(err)
+		print(str(err))
 		print_usage()
 
 	for (o, a) in opts:
+		if (o == "--checksum"):
+			checksum = True
 		if (o == "-d"):
 			dry_run = True
+		if (o == "--delta"):
+			delta_min = parse_size(a)
+			if (delta_min is None) or (delta_min < 1):
+				print("Invalid size '" + str(a) + "'")
+				print_usage()
+		if (o == "--detect-moves"):
+			detect_moves = True
 		if (o == "-f"):
 			force_copy = True
 		if (o == "-h"):
 			error_halt = True
+		if (o == "-j"):
+			try:
+				jobs = int(a)
+			except ValueError:
+				jobs = 0
+			if (jobs < 1):
+				print("Invalid number of workers '" + str(a) + "'")
+				print_usage()
+		if (o == "--debounce") or (o == "--rescan"):
+			try:
+				seconds = float(a)
+			except ValueError:
+				seconds = -1
+			if (seconds < 0):
+				print("Invalid number of seconds '" + str(a) + "'")
+				print_usage()
+			if (o == "--debounce"):
+				debounce = seconds
+			else:
+				rescan = seconds
+		if (o == "--scan-jobs"):
+			try:
+				scan_jobs = int(a)
+			except ValueError:
+				scan_jobs = 0
+			if (scan_jobs < 1):
+				print("Invalid number of scan threads '" + str(a) + "'")
+				print_usage()
+		if (o == "--keep"):
+			try:
+				keep = int(a)
+			except ValueError:
+				keep = 0
+			if (keep < 1):
+				print("Invalid number of snapshots '" + str(a) + "'")
+				print_usage()
+		if (o == "-m"):
+			use_manifest = True
+		if (o == "--progress"):
+			progress = True
+		if (o == "--prune"):
+			prune_only = True
+		if (o == "-r"):
+			report = True
+		if (o == "--resume"):
+			resume = True
 		if (o == "-s"):
 			sync = True
+		if (o == "--snapshot"):
+			snapshot = True
+		if (o == "--stats"):
+			stats_path = a
 		if (o == "-v"):
 			verbose = True
+		if (o == "--verify"):
+			verify = True
+		if (o == "--verify-read"):
+			verify = True
+			read_back = True
+		if (o == "--watch"):
+			watch = True
 		if (o == "-x"):
 			exclude = True
 			excludeFile = a
-        
-    # Check argument count.
+
+	counts = Counts()
+	stats = RunStats(counts)
+	stats.path = stats_path
+	if (progress):
+		stats.start_progress()
+
+	# Prune snapshots without taking a new one.  Only needs <dst-dir>.
+	if (prune_only):
+		if (len(args) < 1) or (keep < 1):
+			print_usage()
+		if not os.path.isdir(args[-1]):
+			print(str(args[-1]) + " is not a directory")
+			sys.exit(1)
+		prune_snapshots(os.path.abspath(args[-1]), keep, dry_run, verbose, counts)
+		stats.finish()
+		print_counts(counts, dry_run)
+		return 3 if (error_halt and counts["errors"] > 0) else 0
+
+	# Check argument count.
 	if (len(args) < 2):
 		print_usage()
-    	
+	if (detect_moves) and not sync:
+		print("--detect-moves requires -s")
+		print_usage()
+	if (detect_moves) and (resume):
+		print("--resume can't be combined with --detect-moves")
+		print_usage()
+	if (snapshot) and (sync or use_manifest or (delta_min > 0) or watch or verify):
+		print("--snapshot can't be combined with -s, -m, --delta, --verify or --watch")
+		print_usage()
+	if (snapshot) and (len(args) > 2):
+		print("--snapshot takes one <dst-dir>")
+		print_usage()
+
 	# Get the source and destination paths.
 	src_root = args[0]
 	if not os.path.exists(src_root):
@@ -114,16 +3293,21 @@ if __name__ == "__main__":
 		print(str(src_root) + " is not a directory")
 		sys.exit(1)
 	src_root_abs = os.path.abspath(src_root)
-        
-	dst_root = args[1]
-	if not os.path.exists(dst_root):
-		print("Destination directory '" + str(dst_root) + "' does not exist")
-		sys.exit(1)
-	if not os.path.isdir(dst_root):
-		print(str(dst_root) + " is not a directory")
-		sys.exit(1)
-	dst_root_abs = os.path.abspath(dst_root)
-	
+
+	dst_roots_abs = []
+	for dst_root in args[1:]:
+		if not os.path.exists(dst_root):
+			print("Destination directory '" + str(dst_root) + "' does not exist")
+			sys.exit(1)
+		if not os.path.isdir(dst_root):
+			print(str(dst_root) + " is not a directory")
+			sys.exit(1)
+		if os.path.abspath(dst_root) in dst_roots_abs:
+			print("Destination directory '" + str(dst_root) + "' is given twice")
+			sys.exit(1)
+		dst_roots_abs.append(os.path.abspath(dst_root))
+	dst_root_abs = dst_roots_abs[0]
+
 	# Build the exclude file list.
 	if (exclude):
 		if not os.path.exists(excludeFile):
@@ -136,120 +3320,72 @@ if __name__ == "__main__":
 				if (len(fn) > 0):
 					excludeList.append(fn)
 			f.close()
-		except (IOError, OSError, os.error) as err:
+		except OSError as err:
 			print("Error reading " + str(excludeFile) + ": " + str(err))
 			sys.exit(1)
+		excluder = ExcludeList(excludeList)
 
-	# Iterate over all source files.  
-	# Copy source to destination if criteria met.
-	for (dirpath, dirnames, filenames) in os.walk(src_root_abs):
-		for file in filenames:
-			sfn_abs = os.path.join(dirpath, file)        # source file absolute path
-			fn_rel = os.path.relpath(sfn_abs, src_root)  # source file relative path
-			src_mtime = os.path.getmtime(sfn_abs)        # source file modification time
-			
-			# See if this file is in the exclusion list.
-			if (exclude):
-				found = False
-				for f in excludeList:
-				    # If file spec ends in a slash, then treat it as a directory.
-					if ((f[-1] == '\\') or (f[-1] == '/')):
-					    if (sfn_abs.startswith(f)):
-							found = True
-							excluded_count = excluded_count + 1
-							if (verbose):
-								print("Excluding " + sfn_abs)
-							break
-					elif (sfn_abs == f):
-						found = True
-						excluded_count = excluded_count + 1
-						if (verbose):
-							print("Excluding " + sfn_abs)
-						break
-				if (found):
-					continue
-		
-            # Check for this file in the destination path.
-			dst_mtime = 0
-			dfn_abs = os.path.join(dst_root_abs, fn_rel) # destination file absolute path
-			if os.path.exists(dfn_abs):
-				dst_mtime = os.path.getmtime(dfn_abs)    # destination file modification time
-				
-			# Copy source to destination.    
-			if (force_copy or (src_mtime > dst_mtime)):
-				if (dry_run or verbose):
-					print(str(sfn_abs) + " -> " + str(dfn_abs))
-				if dry_run:
-					copy_count = copy_count + 1  # Dry run: fake copy count
-				else:
-					try:
-						# Create directories if they don't exist.
-						dst_path = os.path.dirname(dfn_abs)
-						if not os.path.exists(dst_path):
-							os.makedirs(dst_path)
-						
-						# Perform the copy.
-						shutil.copy2(sfn_abs, dfn_abs)
-						os.utime(dfn_abs, None)          # update destination atime + mtime
-						copy_count = copy_count + 1
-						
-					except (shutil.Error, IOError, OSError, os.error) as err:
-						print("Error copying " + str(sfn_abs) + ": " + str(err))
-						error_count = error_count + 1
-						if error_halt:
-							print_counts(copy_count, deleted_count, excluded_count, error_count, dry_run)
-							sys.exit(3)
-	
-	# Sync option.    
-	# Iterate over all destination files.  
-	# Delete files and directories that don't exist in the source tree.
-	if sync:
-		# Perform a top-down walk to remove files.
-		for (dirpath, dirnames, filenames) in os.walk(dst_root_abs, True):
-			for file in filenames:
-				dfn_abs = os.path.join(dirpath, file)        # destination file absolute path
-				fn_rel = os.path.relpath(dfn_abs, dst_root)  # destination file relative path
-				sfn_abs = os.path.join(src_root_abs, fn_rel) # source file absolute path
-				if not os.path.exists(sfn_abs):
-					if (dry_run or verbose):
-						print("Deleting " + str(dfn_abs))
-					if dry_run:
-						deleted_count = deleted_count + 1  # Dry run: fake deleted count
-					else:
-						try:
-							os.remove(dfn_abs)
-							deleted_count = deleted_count + 1
-							
-						except (shutil.Error, IOError, OSError, os.error) as err:
-							print("Error deleting " + str(dfn_abs) + ": " + str(err))
-							error_count = error_count + 1
-							if error_halt:
-								print_counts(copy_count, deleted_count, excluded_count, error_count, dry_run)
-								sys.exit(3)
-   
-		# Perform a bottom-up walk to remove directories.        
-		for (dirpath, dirnames, filenames) in os.walk(dst_root_abs, False):
-			for dir in dirnames:
-				ddn_abs = os.path.join(dirpath, dir)         # destination directory absolute path
-				dn_rel = os.path.relpath(ddn_abs, dst_root)  # destination directory relative path
-				sdn_abs = os.path.join(src_root_abs, dn_rel) # source directory absolute path
-				if not os.path.exists(sdn_abs):
-					if (dry_run or verbose):
-						print("Deleting " + str(ddn_abs))
-					if dry_run:
-						deleted_count = deleted_count + 1  # Dry run: fake deleted count
-					else:
-						try:
-							os.rmdir(ddn_abs)
-							deleted_count = deleted_count + 1
-							
-						except (shutil.Error, IOError, OSError, os.error) as err:
-							print("Error deleting " + str(ddn_abs) + ": " + str(err))
-							error_count = error_count + 1
-							if error_halt:
-								print_counts(copy_count, deleted_count, excluded_count, error_count, dry_run)
-								sys.exit(3)
-				
-	print_counts(copy_count, deleted_count, excluded_count, error_count, dry_run)
-	
-# End of file. 
\ No newline at end of file
+	# Snapshot mode has its own copy loop.
+	if (snapshot):
+		code = run_snapshot(src_root_abs, dst_root_abs, excluder, jobs, dry_run,
+			verbose, error_halt, counts, scan_jobs, stats)
+		if (code == 0) and (keep > 0):
+			prune_snapshots(dst_root_abs, keep, dry_run, verbose, counts)
+		stats.finish()
+		print_counts(counts, dry_run)
+		return code
+
+	# Open each destination's manifest and hash store.
+	dests = []
+	for dst_root_abs in dst_roots_abs:
+		manifest = None
+		if (use_manifest):
+			manifest = open_meta_db(Manifest, dst_root_abs, MANIFEST_FILE, dry_run)
+		hashes = None
+		if (checksum or verify):
+			hashes = open_meta_db(HashStore, dst_root_abs, HASHES_FILE, dry_run)
+			if (hashes is None):
+				hashes = HashStore(":memory:", readonly=True)
+		dests.append(Destination(dst_root_abs, manifest, hashes))
+	backup = TreeBackup(src_root_abs, dests, excluder, jobs, dry_run, verbose,
+		error_halt, force_copy, sync, delta_min, detect_moves, report, scan_jobs, counts,
+		checksum, verify, read_back, stats)
+
+	# With --watch, start watching directories as the first pass walks them.
+	# Stop cleanly on SIGTERM as well as Ctrl-C.
+	watcher = None
+	if (watch):
+		try:
+			watcher = Watcher()
+		except OSError as err:
+			print("Can't watch " + str(src_root_abs) + ": " + str(err))
+			sys.exit(1)
+		signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+	# Back up the whole tree, then with --watch keep it up to date.
+	complete = backup.run(resume=resume, watcher=watcher)
+	if complete and (watcher is not None):
+		complete = watch_tree(backup, watcher, debounce, rescan)
+		watcher.close()
+	backup.close()
+	stats.finish()
+	if (len(dests) > 1):
+		for dest in dests:
+			print(dest.root_abs + ":")
+			print_counts(dest.counts, False)
+		print("Total:")
+	print_counts(counts, dry_run)
+	return 0 if complete else 3
+
+
+##############################################################################
+# Script execution starts here.
+##############################################################################
+if __name__ == "__main__":
+	try:
+		sys.exit(main(sys.argv[1:]))
+	except MetaError as err:
+		print(str(err))
+		sys.exit(1)
+
+# End of file.
\ No newline at end of file
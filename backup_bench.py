@@ -0,0 +1,501 @@
+##############################################################################
+# backup_bench.py
+# Benchmark suite for backup.py.
+#
+# Builds synthetic source trees of several shapes, times backup.py running
+# over them, and writes the results as JSON so runs from different commits
+# can be compared.  The harness it shares with codecount_bench.py is in
+# benchlib.py.
+#
+# Shapes (sizes at --scale=1):
+#   tiny     - 1,000,000 files of 0-512 bytes in 1,000 directories
+#   huge     - 4 files of 1 GiB
+#   deep     - 256 nested directories with 4 files each
+#   wide     - 200,000 files in one directory
+#   excludes - 100,000 files in 1,000 directories, with a 20,000 entry
+#              exclude list
+#
+# Scenarios, run for each shape:
+#   cold    - full copy into an empty destination
+#   noop    - incremental run with nothing changed
+#   sync    - -s run after adding as many stale files to the destination
+#             as it has files, so every one of them is deleted
+#   exclude - full copy into an empty destination with -x
+#   crossdev - full copy into an empty destination whose first subdirectory
+#             is a symbolic link to a directory on another file system,
+#             such as /dev/shm, checking every file arrived; skipped if
+#             there is no other file system to use
+#   snapshot - --snapshot --keep=1 run after a snapshot taken with the clock
+#             a day ahead, checking the new snapshot is the one kept
+#
+# Generated trees are kept in the work directory and reused by later runs
+# with the same scale and seed.  Destinations are rebuilt every run.
+#
+# Usage:
+# See print_usage() below.
+#
+# Modification History:
+# 10/16/2026 - Tom Kerr
+# Initial creation.
+##############################################################################
+
+import getopt
+import json
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import benchlib
+
+# Full size shapes.  Sizes are multiplied by --scale.
+SHAPES = {
+	"tiny":     {"files": 1000000, "dirs": 1000, "size": 512,       "excludes": 1000},
+	"huge":     {"files": 4,       "dirs": 1,    "size": 1 << 30,   "excludes": 10},
+	"deep":     {"files": 4,       "dirs": 256,  "size": 4096,      "excludes": 100},
+	"wide":     {"files": 200000,  "dirs": 1,    "size": 1024,      "excludes": 1000},
+	"excludes": {"files": 100000,  "dirs": 1000, "size": 2048,      "excludes": 20000},
+}
+SCENARIOS = ["cold", "noop", "sync", "exclude", "crossdev", "snapshot"]
+OTHER_FILESYSTEMS = ["/dev/shm", tempfile.gettempdir()]   # for crossdev
+SNAPSHOT_CLOCKS   = ("UTC-14", "UTC+12")   # TZ of the snapshot runs, a day apart
+
+DEFAULT_SCALE  = 0.01
+DEFAULT_SEED   = 1
+WRITE_BLOCK    = 1024 * 1024        # block written repeatedly for large files
+
+
+##############################################################################
+# Print usage syntax.
+##############################################################################
+def print_usage():
+	print("Usage:", sys.argv[0], "[-b <backup.py>] [-w <dir>] [-o <file>] [-n <num>]")
+	print("       [--scale=<factor>] [--seed=<num>] [--shapes=<list>]")
+	print("       [--scenarios=<list>] [--args=<options>] [--drop-caches]")
+	print("   or:", sys.argv[0], "--compare [--threshold=<pct>] <old.json> <new.json>")
+	print("  Time backup.py over synthetic source trees")
+	print("  -b <backup.py> Script to benchmark (default = backup.py next to this one)")
+	print("  -n <num> Time each scenario <num> times and report the median (default = 1)")
+	print("  -o <file> Write the results to <file> as JSON (default = stdout)")
+	print("  -w <dir> Work directory for the generated trees (default = a temporary")
+	print("            directory, deleted afterwards)")
+	print("  --args=<options> Extra backup.py options for every run, e.g. \"-j 8 -m\"")
+	print("  --compare Compare two results files, exit 1 if any median time grew")
+	print("            by more than --threshold percent (default = 10), or any")
+	print("            run failed, left files missing from the destination or")
+	print("            pruned the newest snapshot")
+	print("  --drop-caches Drop the page cache before each cold run (needs root)")
+	print("  --scale=<factor> Multiply the shape sizes by <factor> (default = " + str(DEFAULT_SCALE) + ")")
+	print("  --scenarios=<list> Comma separated scenarios: " + ",".join(SCENARIOS))
+	print("  --seed=<num> Random seed for file names and contents (default = " + str(DEFAULT_SEED) + ")")
+	print("  --shapes=<list> Comma separated shapes: " + ",".join(sorted(SHAPES)))
+	sys.exit(2)
+
+
+##############################################################################
+# Write a file of the given size.
+# Small files get random contents.  Large files repeat one random block
+# with its first bytes changed, so they aren't sparse or trivially
+# compressible but don't cost a random number per byte.
+##############################################################################
+def write_file(path, size, rng):
+	with open(path, "wb") as f:
+		if (size <= WRITE_BLOCK):
+			f.write(rng.randbytes(size))
+			return
+		block = bytearray(rng.randbytes(WRITE_BLOCK))
+		written = 0
+		while (written < size):
+			block[0:8] = written.to_bytes(8, "little")
+			n = min(WRITE_BLOCK, size - written)
+			f.write(block[:n])
+			written += n
+
+
+##############################################################################
+# Generate a shape's source tree under root.
+# Returns the list of relative directory paths created, root being "".
+##############################################################################
+def make_tree(name, root, scale, rng):
+	shape = SHAPES[name]
+	nfiles = benchlib.scaled(shape["files"], scale)
+	ndirs = benchlib.scaled(shape["dirs"], scale)
+	size = shape["size"]
+	if (name == "huge"):
+		size = benchlib.scaled(size, scale, WRITE_BLOCK)
+	if (name == "deep"):
+		ndirs = benchlib.scaled(shape["dirs"], scale, 16)
+
+	# Deep trees nest every directory in the one before.  The others spread
+	# their directories two levels deep under the root.
+	dirs = []
+	if (name == "deep"):
+		path = ""
+		for i in range(ndirs):
+			path = os.path.join(path, "d%03d" % i)
+			dirs.append(path)
+	elif (ndirs == 1):
+		dirs.append("")
+	else:
+		for i in range(ndirs):
+			dirs.append(os.path.join("g%02d" % (i % 32), "d%04d" % i))
+	for d in dirs:
+		os.makedirs(os.path.join(root, d), exist_ok=True)
+
+	# Files per directory.  Deep trees put every file count in each level.
+	for (i, d) in enumerate(dirs):
+		if (name == "deep"):
+			count = nfiles
+		else:
+			count = nfiles // len(dirs) + (1 if (i < nfiles % len(dirs)) else 0)
+		for j in range(count):
+			if (name in ("tiny", "wide")):
+				fsize = rng.randrange(size + 1)
+			else:
+				fsize = size
+			ext = rng.choice((".c", ".h", ".txt", ".dat", ".tmp"))
+			write_file(os.path.join(root, d, "f%06d%s" % (j, ext)), fsize, rng)
+	return dirs
+
+
+##############################################################################
+# Write an exclude list for a tree.
+# A tenth of the entries name existing files, a tenth existing directories
+# and a tenth are globs; the rest name files that don't exist, as most of a
+# long exclude list won't match anything on a given run.
+##############################################################################
+def make_exclude_list(path, root, dirs, n, rng):
+	files = []
+	for d in dirs:
+		for name in sorted(os.listdir(os.path.join(root, d))):
+			if name.startswith("f"):
+				files.append(os.path.join(root, d, name))
+	lines = []
+	for i in range(n):
+		kind = i % 10
+		if (kind == 0) and files:
+			lines.append(rng.choice(files))
+		elif (kind == 1) and (len(dirs) > 1):
+			d = rng.choice(dirs[1:])
+			lines.append(os.path.join(root, d) + "/")
+		elif (kind == 2):
+			lines.append("*/d%04d/*%s" % (rng.randrange(10000), rng.choice((".tmp", ".dat"))))
+		else:
+			lines.append(os.path.join(root, "missing", "m%06d.txt" % i))
+	with open(path, "w") as f:
+		f.write("# Generated by backup_bench.py\n")
+		for line in lines:
+			f.write(line + "\n")
+
+
+##############################################################################
+# Build a shape's source tree and exclude list, reusing them if a previous
+# run already built them.  Returns (src, exclude file).
+##############################################################################
+def prepare_shape(name, work, scale, seed):
+	def make(base, rng):
+		src = os.path.join(base, "src")
+		os.makedirs(src)
+		dirs = make_tree(name, src, scale, rng)
+		make_exclude_list(os.path.join(base, "exclude.txt"), src, dirs,
+			benchlib.scaled(SHAPES[name]["excludes"], scale), rng)
+
+	base = benchlib.generate(work, name, scale, seed, "tree", make)
+	return (os.path.join(base, "src"), os.path.join(base, "exclude.txt"))
+
+
+##############################################################################
+# Add a stale file to the destination next to each existing file, so a -s
+# run has as many deletions as the tree has files.
+# Returns the number of files added.
+##############################################################################
+def add_stale_files(dst):
+	added = 0
+	for (dirpath, dirnames, filenames) in os.walk(dst):
+		if (dirpath == dst) and (".backup-meta" in dirnames):
+			dirnames.remove(".backup-meta")
+		for name in filenames:
+			open(os.path.join(dirpath, "stale-" + name), "w").close()
+			added += 1
+	return added
+
+
+##############################################################################
+# Find a writable directory on a different file system from path, for the
+# crossdev scenario.  Returns None if there isn't one.
+##############################################################################
+def other_filesystem(path):
+	dev = os.stat(path).st_dev
+	for other in OTHER_FILESYSTEMS:
+		try:
+			if os.path.isdir(other) and os.access(other, os.W_OK) and (os.stat(other).st_dev != dev):
+				return other
+		except OSError:
+			pass
+	return None
+
+
+##############################################################################
+# Count the source files missing from the destination.
+##############################################################################
+def count_missing(src, dst):
+	missing = 0
+	for (dirpath, dirnames, filenames) in os.walk(src):
+		rel = os.path.relpath(dirpath, src)
+		for name in filenames:
+			if not os.path.exists(os.path.join(dst, rel, name)):
+				missing += 1
+	return missing
+
+
+##############################################################################
+# Drop the page cache so the next run reads from disk.
+# Returns True if the cache was dropped.
+##############################################################################
+def drop_caches():
+	try:
+		os.sync()
+		with open("/proc/sys/vm/drop_caches", "w") as f:
+			f.write("3\n")
+		return True
+	except OSError:
+		return False
+
+
+##############################################################################
+# Run backup.py once, with the time zone tz if given.
+# Returns a dictionary with the elapsed time, the exit code and, if the
+# script supports --stats, its statistics.
+##############################################################################
+def run_backup(backup, options, src, dst, work, has_stats, tz=None):
+	cmd = [sys.executable, backup] + options
+	stats_file = None
+	if has_stats:
+		stats_file = os.path.join(work, "stats.json")
+		if os.path.exists(stats_file):
+			os.remove(stats_file)
+		cmd.append("--stats=" + stats_file)
+	env = None
+	if (tz is not None):
+		env = dict(os.environ, TZ=tz)
+	run = benchlib.run_timed(cmd + [src, dst], env=env)[0]
+	if (stats_file is not None) and os.path.exists(stats_file):
+		with open(stats_file) as f:
+			run["stats"] = json.load(f)
+	return run
+
+
+##############################################################################
+# Find out whether backup.py supports --stats, which older versions don't,
+# by running it with --stats over an empty tree.
+# Returns True if it ran and wrote the statistics.
+##############################################################################
+def supports_stats(backup, work):
+	probe = os.path.join(work, "stats-probe")
+	shutil.rmtree(probe, ignore_errors=True)
+	os.makedirs(os.path.join(probe, "src"))
+	os.makedirs(os.path.join(probe, "dst"))
+	stats_file = os.path.join(probe, "stats.json")
+	try:
+		proc = subprocess.run([sys.executable, backup, "--stats=" + stats_file,
+			os.path.join(probe, "src"), os.path.join(probe, "dst")],
+			stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		return (proc.returncode == 0) and os.path.isfile(stats_file)
+	finally:
+		shutil.rmtree(probe, ignore_errors=True)
+
+
+##############################################################################
+# Time one scenario on a shape.
+# Each repetition starts from the same destination state.  Returns the
+# scenario's result dictionary.
+##############################################################################
+def run_scenario(scenario, backup, options, src, exclude_file, work, repeat,
+		has_stats, drop):
+	dst = os.path.join(work, "dst")
+	link_dir = None
+	if (scenario == "crossdev"):
+		other = other_filesystem(work)
+		subdirs = sorted(d for d in os.listdir(src) if os.path.isdir(os.path.join(src, d)))
+		if (other is None):
+			return {"skipped": "no other file system to link to"}
+		if not subdirs:
+			return {"skipped": "source tree has no subdirectories"}
+	runs = []
+	for i in range(repeat):
+		if os.path.exists(dst):
+			shutil.rmtree(dst)
+		os.makedirs(dst)
+
+		# Bring the destination to the scenario's starting state.
+		run_options = list(options)
+		if scenario in ("noop", "sync"):
+			setup = run_backup(backup, options, src, dst, work, False)
+			if (setup["exit_code"] != 0):
+				return {"error": "setup run failed", "runs": [setup]}
+		if (scenario == "sync"):
+			add_stale_files(dst)
+			run_options.append("-s")
+		if (scenario == "snapshot"):
+			setup = run_backup(backup, options + ["--snapshot"], src, dst, work, False,
+				SNAPSHOT_CLOCKS[0])
+			if (setup["exit_code"] != 0):
+				return {"error": "setup run failed", "runs": [setup]}
+			run_options += ["--snapshot", "--keep=1"]
+			before = set(os.listdir(dst))
+		if (scenario == "exclude"):
+			run_options += ["-x", exclude_file]
+		if (scenario == "crossdev"):
+			if (link_dir is not None):
+				shutil.rmtree(link_dir)
+			link_dir = tempfile.mkdtemp(dir=other, prefix="backup_bench.")
+			os.symlink(link_dir, os.path.join(dst, subdirs[0]))
+
+		dropped = drop_caches() if (drop and scenario == "cold") else False
+		tz = SNAPSHOT_CLOCKS[1] if (scenario == "snapshot") else None
+		run = run_backup(backup, run_options, src, dst, work, has_stats, tz)
+		run["caches_dropped"] = dropped
+		if (scenario == "crossdev"):
+			run["missing"] = count_missing(src, dst)
+		if (scenario == "snapshot"):
+			run["newest_pruned"] = (set(os.listdir(dst)) <= before)
+		runs.append(run)
+	if (link_dir is not None):
+		shutil.rmtree(link_dir)
+
+	result = {"options": run_options, "runs": runs}
+	result.update(benchlib.summarize(runs))
+	if (scenario == "crossdev"):
+		result["missing"] = max(r["missing"] for r in runs)
+	if (scenario == "snapshot"):
+		result["newest_pruned"] = any(r["newest_pruned"] for r in runs)
+	return result
+
+
+##############################################################################
+# Compare two results files.
+# Prints the median time of each shape and scenario in both, and returns
+# True if none grew by more than threshold percent and no new run failed,
+# left files missing from the destination or pruned the newest snapshot.
+##############################################################################
+def compare(old_path, new_path, threshold):
+	return benchlib.compare(old_path, new_path, threshold, ["shape", "scenario"],
+		check=check_result)
+
+
+##############################################################################
+# What is wrong with a scenario's result, other than a failed run, or None.
+##############################################################################
+def check_result(result):
+	if result.get("missing"):
+		return "%d files missing" % result["missing"]
+	if result.get("newest_pruned"):
+		return "newest snapshot pruned"
+	return None
+
+
+##############################################################################
+# Script execution starts here.
+##############################################################################
+if __name__ == "__main__":
+
+	# Local initialization.
+	backup       = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backup.py")
+	compare_mode = False
+	drop         = False
+	extra_args   = []
+	output       = None
+	repeat       = 1
+	scale        = DEFAULT_SCALE
+	scenarios    = list(SCENARIOS)
+	seed         = DEFAULT_SEED
+	shapes       = sorted(SHAPES)
+	threshold    = 10.0
+	work         = None
+
+	# Get command line options and arguments.
+	try:
+		(opts, args) = getopt.getopt(sys.argv[1:], "b:n:o:w:", ["args=", "compare",
+			"drop-caches", "scale=", "scenarios=", "seed=", "shapes=", "threshold="])
+	except getopt.GetoptError as err:
+		print(str(err))
+		print_usage()
+
+	try:
+		for (o, a) in opts:
+			if (o == "-b"):
+				backup = a
+			if (o == "-n"):
+				repeat = int(a)
+			if (o == "-o"):
+				output = a
+			if (o == "-w"):
+				work = a
+			if (o == "--args"):
+				extra_args = a.split()
+			if (o == "--compare"):
+				compare_mode = True
+			if (o == "--drop-caches"):
+				drop = True
+			if (o == "--scale"):
+				scale = float(a)
+			if (o == "--scenarios"):
+				scenarios = a.split(",")
+			if (o == "--seed"):
+				seed = int(a)
+			if (o == "--shapes"):
+				shapes = a.split(",")
+			if (o == "--threshold"):
+				threshold = float(a)
+	except ValueError as err:
+		print(str(err))
+		print_usage()
+
+	if (compare_mode):
+		if (len(args) != 2):
+			print_usage()
+		sys.exit(0 if compare(args[0], args[1], threshold) else 1)
+
+	if (len(args) != 0) or (repeat < 1) or (scale <= 0):
+		print_usage()
+	for name in shapes:
+		if (name not in SHAPES):
+			print("Unknown shape '" + name + "'")
+			print_usage()
+	for name in scenarios:
+		if (name not in SCENARIOS):
+			print("Unknown scenario '" + name + "'")
+			print_usage()
+	if not os.path.isfile(backup):
+		print("backup.py not found at '" + str(backup) + "'")
+		sys.exit(1)
+
+	(work, temp_work) = benchlib.make_work(work, "backup-bench-")
+	results = benchlib.new_results(backup, "backup", scale, seed, repeat, extra_args)
+	failed = False
+	try:
+		has_stats = supports_stats(backup, work)
+		results["stats"] = has_stats
+		for name in shapes:
+			(src, exclude_file) = prepare_shape(name, work, scale, seed)
+			results["results"][name] = {}
+			for scenario in scenarios:
+				print("Running " + name + " " + scenario, file=sys.stderr)
+				result = run_scenario(scenario, backup, extra_args, src, exclude_file, work,
+					repeat, has_stats, drop)
+				results["results"][name][scenario] = result
+				problem = benchlib.run_failure(result) or check_result(result)
+				if (problem is not None):
+					print(name + " " + scenario + ": " + problem, file=sys.stderr)
+					failed = True
+	finally:
+		if temp_work:
+			shutil.rmtree(work, ignore_errors=True)
+		else:
+			shutil.rmtree(os.path.join(work, "dst"), ignore_errors=True)
+
+	benchlib.write_results(results, output)
+	sys.exit(1 if failed else 0)
+
+# End of file.
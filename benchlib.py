@@ -0,0 +1,212 @@
+##############################################################################
+# benchlib.py
+# Shared harness of the benchmark suites, backup_bench.py and
+# codecount_bench.py.
+#
+# Each suite generates its inputs once per shape, scale and seed in a work
+# directory, times its script over them with subprocess runs, and writes
+# the results as JSON with a description of the code benchmarked, so runs
+# from different commits can be compared with compare().
+#
+# Modification History:
+# 10/16/2026 - Tom Kerr
+# Initial creation.
+##############################################################################
+
+import json
+import os.path
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+COMPLETE_FILE  = ".complete"        # marks a fully generated shape
+RESULTS_FORMAT = 1                  # version of the JSON results layout
+STDERR_KEPT    = 2000               # characters of a failed run's stderr kept
+
+
+##############################################################################
+# Scale a shape's size, keeping at least minimum.
+##############################################################################
+def scaled(n, scale, minimum=1):
+    return max(minimum, int(n * scale))
+
+
+##############################################################################
+# Make the work directory, or a temporary one if work is None.
+# Returns (absolute work directory, True if it is temporary).
+##############################################################################
+def make_work(work, prefix):
+    temp = (work is None)
+    if temp:
+        work = tempfile.mkdtemp(prefix=prefix)
+    work = os.path.abspath(work)
+    os.makedirs(work, exist_ok=True)
+    return (work, temp)
+
+
+##############################################################################
+# Generate a shape's inputs in a directory of the work directory, unless a
+# previous run with the same scale and seed already did.  make(base, rng)
+# fills in the directory, with rng seeded from the shape and seed; what
+# names what it makes, for the progress message.
+# Returns the directory.
+##############################################################################
+def generate(work, name, scale, seed, what, make):
+    base = os.path.join(work, "%s-%g-%d" % (name, scale, seed))
+    if os.path.exists(os.path.join(base, COMPLETE_FILE)):
+        return base
+
+    if os.path.exists(base):
+        shutil.rmtree(base)
+    os.makedirs(base)
+    print("Generating " + name + " " + what + " in " + base, file=sys.stderr)
+    make(base, random.Random("%s-%d" % (name, seed)))
+    open(os.path.join(base, COMPLETE_FILE), "w").close()
+    return base
+
+
+##############################################################################
+# Run a command and time it, with the environment env if given.
+# Returns (run, proc): run is a dictionary with the elapsed time, the exit
+# code and, if it failed, the end of its stderr; proc is the finished
+# process, with its output.
+##############################################################################
+def run_timed(cmd, cwd=None, env=None):
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+
+    run = {"seconds": round(elapsed, 6), "exit_code": proc.returncode}
+    if (proc.returncode != 0):
+        run["stderr"] = proc.stderr.decode(errors="replace")[-STDERR_KEPT:]
+    return (run, proc)
+
+
+##############################################################################
+# The median and minimum time of a list of runs.
+##############################################################################
+def summarize(runs):
+    times = [r["seconds"] for r in runs]
+    return {"median": round(statistics.median(times), 6), "min": round(min(times), 6)}
+
+
+##############################################################################
+# Start the results of a suite's run.
+# Describes the script benchmarked under its name, with the Python, the
+# platform and the git commit of the script's directory, and the options
+# every run shares.
+##############################################################################
+def new_results(script, name, scale, seed, repeat, args):
+    results = {"format": RESULTS_FORMAT, "scale": scale, "seed": seed, "repeat": repeat,
+        "args": args}
+    results[name] = os.path.abspath(script)
+    results["python"] = platform.python_version()
+    results["platform"] = platform.platform()
+    results["cpus"] = os.cpu_count()
+    results["date"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    try:
+        results["commit"] = subprocess.run(["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(script)), stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        results["commit"] = None
+    results["results"] = {}
+    return results
+
+
+##############################################################################
+# Write results as JSON to output, or stdout if it is None.
+##############################################################################
+def write_results(results, output):
+    text = json.dumps(results, indent=2) + "\n"
+    if (output is None):
+        sys.stdout.write(text)
+    else:
+        with open(output, "w") as f:
+            f.write(text)
+
+
+##############################################################################
+# The results of each test of a results file, as (key, result) pairs.
+# levels is how deep the results nest, one per name in the key, like
+# shape then scenario.
+##############################################################################
+def flatten(results, levels):
+    if (levels == 0):
+        return [((), results)]
+    items = []
+    for (name, inner) in sorted(results.items()):
+        items += [((name,) + key, result) for (key, result) in flatten(inner, levels - 1)]
+    return items
+
+
+##############################################################################
+# Compare two results files.
+# Prints the median time of each test in both, labelled with the names in
+# labels, one per level the results nest.  columns are (heading, value)
+# pairs of extra values printed for both, value being a result's key or a
+# function of the result.  check(result) returns what is wrong with a
+# new result, or None.
+# Returns True if no time grew by more than threshold percent, no new test
+# failed to run and check found nothing wrong.
+##############################################################################
+def compare(old_path, new_path, threshold, labels, columns=(), check=None):
+    with open(old_path) as f:
+        old = flatten(json.load(f)["results"], len(labels))
+    with open(new_path) as f:
+        new = flatten(json.load(f)["results"], len(labels))
+    old = dict(old)
+
+    def value(result, how):
+        v = how(result) if callable(how) else result.get(how)
+        return ("%.3f" % v) if isinstance(v, float) else str(v)
+
+    ok = True
+    headings = list(labels) + ["old (s)", "new (s)", "change"]
+    for (heading, how) in columns:
+        headings += ["old " + heading, "new " + heading]
+    print(" ".join("%-10s" % h for h in labels) + " " +
+        " ".join("%10s" % h for h in headings[len(labels):]))
+    for (key, result) in new:
+        before = old.get(key, {})
+        (t0, t1) = (before.get("median"), result.get("median"))
+        flags = []
+        if (t0 is None) or (t1 is None) or (t0 <= 0):
+            fields = [str(t0), str(t1), "-"]
+        else:
+            change = (t1 - t0) / t0 * 100.0
+            fields = ["%.3f" % t0, "%.3f" % t1, "%+.1f%%" % change]
+            if (change > threshold):
+                flags.append("slower")
+                ok = False
+        for (heading, how) in columns:
+            fields += [value(before, how), value(result, how)]
+        problem = run_failure(result)
+        if (problem is None) and (check is not None):
+            problem = check(result)
+        if (problem is not None):
+            flags.append(problem)
+            ok = False
+        print(" ".join("%-10s" % k for k in key) + " " + " ".join("%10s" % f for f in fields) +
+            "".join("  " + f for f in flags))
+    return ok
+
+
+##############################################################################
+# What went wrong running a test, or None if it ran: a result with an
+# error, or runs that exited non-zero, whose times mean nothing.
+##############################################################################
+def run_failure(result):
+    if ("error" in result):
+        return "error: " + str(result["error"])
+    failed = sum(1 for r in result.get("runs", []) if (r.get("exit_code", 0) != 0))
+    if (failed > 0):
+        return "%d runs failed" % failed
+    return None
+
+# End of file.
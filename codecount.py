@@ -1,171 +1,1040 @@
 ##############################################################################
 # codecount.py
-# Quick and dirty line of code counter for C/C++/C# souce files.
+# Quick and dirty line of code counter for C/C++/C#, Java, JavaScript, Go,
+# Python and shell source files.
 #
 # Modification History:
+# 10/16/2026 - Tom Kerr
+# Count Java, JavaScript, Go, Python and shell sources too, with a lexer
+# compiled from a table of languages, and print totals per language.
+#
+# 10/16/2026 - Tom Kerr
+# Add --diff to count the changes between two git revisions.
+#
+# 10/16/2026 - Tom Kerr
+# Walk the tree with os.scandir(), skipping what .gitignore files and
+# --exclude patterns ignore, and take the paths to search as arguments.
+#
+# 10/16/2026 - Tom Kerr
+# Count files as bytes, jumping between comments and literals with find()
+# and counting lines with bytes methods, which is faster and works for
+# files that aren't UTF-8.
+#
+# 10/16/2026 - Tom Kerr
+# Add --cache to reuse the counts of unchanged files from earlier runs.
+#
+# 10/16/2026 - Tom Kerr
+# Add -j to parse files with a pool of processes.
+#
+# 10/16/2026 - Tom Kerr
+# Count each file in a single pass with a lexer that separates code,
+# comments and literals, which handles escaped quotes, several strings on
+# a line, and comment markers and braces inside strings and comments.
+#
 # 08/10/2014 - Tom Kerr
 # Initial creation.
 ##############################################################################
 
+import getopt
+import hashlib
+import itertools
+import multiprocessing
 import os
 import re
+import sqlite3
+import subprocess
 import sys
 
+# Ignore files read in each directory, and the directories always ignored
+IGNORE_FILES    = (".gitignore", ".codecountignore")
+DEFAULT_IGNORES = (".git/", ".hg/", ".svn/")
+
+BATCH_SIZE   = 64          # files handed to a worker process at a time
+CHUNK_SIZE   = 4096        # files looked up and queued for parsing at a time
+CACHE_FORMAT = 4           # bump when the counts of a file change meaning
+HASH_CHUNK   = 1024 * 1024 # bytes read at a time when hashing a file
+
+# Characters of a C preprocessing number, for digit separators
+DIGITS          = frozenset(b"0123456789")
+PP_NUMBER_CHARS = frozenset(b"0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_.'")
+PP_NUMBER_NEXT  = frozenset(bytes([c]) for c in PP_NUMBER_CHARS if c not in b".'")
+
 
 ##############################################################################
-# Find the max nesting level in a C/C++/C# statement.
+# A language's lexical rules, compiled into a scanner.
+#
+# line_comments are the tokens that start a comment running to the end of
+# the line, and block_comments (open, close) pairs.  strings are
+# (open, close, escape, multiline) tuples: escape is the character that
+# escapes the next one, the close delimiter itself if it is escaped by
+# doubling it, or None; a string that isn't multiline ends at a newline if
+# it isn't closed.  nest is the pair of characters whose nesting maxnest
+# measures, or None.  With digit_separators a quote inside a number, as in
+# 1'000 or 0xFFFF'FFFF, is a C++14 digit separator rather than the start of
+# a character literal.
+#
+# The rules are compiled into one regular expression that matches a
+# comment or literal at its start, and the set of characters such a
+# lexeme can start with, which find_lexemes() jumps between.  Sources are
+# lexed as bytes, which works for any ASCII compatible encoding since every
+# delimiter is ASCII.
 ##############################################################################
-def max_nest_level(sourceline, nest, maxnest):
-    for c in sourceline:
-        if (c == '{'):
-            nest += 1
-            if (nest > maxnest):
-                maxnest = nest
-        elif (c == '}'):
-            nest -= 1
-            if (nest < 0):
-                nest = 0
-    return (nest, maxnest)
-    
-    
+class Language(object):
+
+    def __init__(self, name, extensions, line_comments=(), block_comments=(), strings=(),
+            nest=None, line_continuation=False, comment_at_word_start=False,
+            digit_separators=False):
+        self.name = name
+        self.extensions = extensions
+        self.nest = nest.encode() if (nest is not None) else None
+        self.digit_separators = digit_separators
+        if (nest is not None):
+            self.not_nest = bytes(c for c in range(256) if c not in self.nest)
+
+        # Alternatives for each kind of lexeme, by its opening delimiter.
+        comments = []
+        literals = []
+        for token in line_comments:
+            if line_continuation:
+                # A // comment continues after a backslash at the end of a
+                # line, CRLF line endings included.  Other backslashes are
+                # plain text: in \\ at the end of a line, the second one
+                # still continues the comment.
+                regex = re.escape(token) + r"[^\\\n]*(?:\\(?:\r?\n)?[^\\\n]*)*"
+            else:
+                regex = re.escape(token) + r"[^\n]*"
+            if comment_at_word_start:
+                # As in shell, where # inside a word as in $# isn't a comment.
+                regex = r"(?<![^\s;&|()])" + regex
+            comments.append((token, regex))
+        for (open, close) in block_comments:
+            comments.append((open, self._block_re(open, close)))
+        for (open, close, escape, multiline) in strings:
+            literals.append((open, self._string_re(open, close, escape, multiline)))
+
+        # Longer delimiters first, so """ isn't taken for an empty "" string.
+        alternatives = []
+        if comments:
+            comments.sort(key=lambda c: -len(c[0]))
+            alternatives.append("(?P<comment>" + "|".join(r for (t, r) in comments) + ")")
+        if literals:
+            literals.sort(key=lambda s: -len(s[0]))
+            alternatives.append("(?P<literal>" + "|".join(r for (t, r) in literals) + ")")
+        self.lexeme_re = re.compile("|".join(alternatives).encode(), re.DOTALL)
+        self.delimiters = tuple(sorted(set(t[0].encode() for (t, r) in comments + literals)))
+
+    @staticmethod
+    def _block_re(open, close):
+        if (len(close) != 2) or (close[0] == close[1]):
+            return re.escape(open) + r".*?(?:" + re.escape(close) + r"|\Z)"
+
+        # The unrolled form of the above for a close like */, which doesn't
+        # backtrack over every character.
+        (first, last) = (re.escape(close[0]), re.escape(close[1]))
+        return (re.escape(open) + "[^" + first + "]*(?:" + first + "+[^" + first + last + "][^" +
+            first + "]*)*(?:" + first + "+(?:" + last + r"|\Z)|\Z)")
+
+    @staticmethod
+    def _string_re(open, close, escape, multiline):
+        if (len(close) > 1):
+            body = (r"(?:" + re.escape(escape) + r".|.)*?") if escape else r".*?"
+            return re.escape(open) + body + r"(?:" + re.escape(close) + r"|\Z)"
+
+        stop = close + (escape if (escape and escape != close) else "") + ("" if multiline else "\n")
+        chars = "[^" + "".join(re.escape(c) for c in stop) + "]*"
+        if (escape == close):
+            body = chars + r"(?:" + re.escape(close * 2) + chars + r")*"
+        elif escape:
+            body = chars + r"(?:" + re.escape(escape) + r".?" + chars + r")*"
+        else:
+            body = chars
+        return re.escape(open) + body + r"(?:" + re.escape(close) + r")?"
+
+
+# The languages counted, and the extensions they are found by.  Python
+# docstrings count as code, like any other string.  JavaScript regular
+# expression literals aren't recognized, so a quote or comment marker in
+# one can throw off the counts after it.
+C_STRINGS = (('"', '"', "\\", False), ("'", "'", "\\", False))
+LANGUAGES = [
+    Language("c", (".c", ".h", ".cpp", ".cc", ".cxx", ".hpp", ".hh", ".hxx"),
+        line_comments=("//",), block_comments=(("/*", "*/"),), strings=C_STRINGS,
+        nest="{}", line_continuation=True, digit_separators=True),
+    Language("csharp", (".cs",),
+        line_comments=("//",), block_comments=(("/*", "*/"),),
+        strings=C_STRINGS + (('@"', '"', '"', True),), nest="{}"),
+    Language("java", (".java",),
+        line_comments=("//",), block_comments=(("/*", "*/"),),
+        strings=C_STRINGS + (('"""', '"""', "\\", True),), nest="{}"),
+    Language("javascript", (".js", ".mjs", ".cjs", ".jsx", ".ts", ".tsx"),
+        line_comments=("//",), block_comments=(("/*", "*/"),),
+        strings=C_STRINGS + (("`", "`", "\\", True),), nest="{}"),
+    Language("go", (".go",),
+        line_comments=("//",), block_comments=(("/*", "*/"),),
+        strings=C_STRINGS + (("`", "`", None, True),), nest="{}"),
+    Language("python", (".py", ".pyw"),
+        line_comments=("#",),
+        strings=C_STRINGS + (('"""', '"""', "\\", True), ("'''", "'''", "\\", True))),
+    Language("shell", (".sh", ".bash"),
+        line_comments=("#",), comment_at_word_start=True,
+        strings=(('"', '"', "\\", True), ("'", "'", None, True)), nest="{}"),
+]
+LANGUAGE_NAMES = {lang.name: lang for lang in LANGUAGES}
+EXTENSIONS = {ext: lang for lang in LANGUAGES for ext in lang.extensions}
+C = LANGUAGE_NAMES["c"]
+
+spaces = b" \t\r\x0b\x0c"   # whitespace other than newlines, as bytes.strip()
+
+
 ##############################################################################
-# Parse a C/C++/C# source file.
+# Count the lines of data that aren't only whitespace.
+# With the other whitespace deleted, those are the newlines that don't
+# follow another newline or start the data, and a last line without one.
 ##############################################################################
-def parse_source_file(file):
+def count_nonblank_lines(data):
+    lines = data.translate(None, spaces)
+    nonblank = lines.count(b"\n") - lines.replace(b"\n", b"\n ").count(b" \n")
+    if lines.startswith(b"\n"):
+        nonblank -= 1
+    if lines and not lines.endswith(b"\n"):
+        nonblank += 1
+    return nonblank
+
+
+##############################################################################
+# Find the comments and literals in source of a Language.
+# Jumps from one possible delimiter to the next with find() and only runs
+# the lexer at those, since most of a source is plain code.  Yields
+# (comment, start, end), with comment True for a comment and False for a
+# literal.
+##############################################################################
+def find_lexemes(data, language):
+    end = len(data)
+    find = data.find
+    match = language.lexeme_re.match
+    delimiters = language.delimiters
+    quote = 0x27 if language.digit_separators else None   # may be a digit separator
+    nexts = []
+    for delimiter in delimiters:
+        pos = find(delimiter)
+        nexts.append(pos if (pos >= 0) else end)
 
-    # Define some regular expressions.
-    blank_re = re.compile("^\s*$")
-    comment1_re = re.compile("^\s*?/\*.*?\*/") # Single line C comment with no code
-    comment2_re = re.compile("^\s*?//.*?$")    # Single line C++ comment with no code
-    multi_begin_re = re.compile("^.*?/\*")     # C begin comment
-    multi_end_re = re.compile("^.*?\*/")       # C end comment
-    quoted_re = re.compile('"(.*?)"')          # Any quoted string
-    source1_re = re.compile("^(\s*?\S+?\s*?)(\s*?/\*.*?\*/)") # nbnc with C single line comment
-    source2_re = re.compile("^(\s*?\S+?\s*?)(//.*?)$")        # nbnc with C++ single line comment
-    
-    lines = 0
-    blanks = 0
+    while True:
+        pos = min(nexts)
+        if (pos >= end):
+            return
+        if (data[pos] == quote) and is_digit_separator(data, pos):
+            m = None
+        else:
+            m = match(data, pos)
+        if (m is None):
+            # A delimiter that doesn't start a lexeme here, like a / that
+            # isn't a comment, or a digit separator.
+            nxt = pos + 1
+        else:
+            nxt = m.end()
+            yield (m.lastgroup == "comment", pos, nxt)
+
+        for (i, pos) in enumerate(nexts):
+            if (pos < nxt):
+                pos = find(delimiters[i], nxt)
+                nexts[i] = pos if (pos >= 0) else end
+
+
+##############################################################################
+# Return True if the quote at data[pos] is a digit separator: one inside a
+# preprocessing number, which starts with a digit or a . and a digit and
+# runs on over digits, letters, _, . and quotes, as in 1'000, 0xAB'CD or
+# 1.5e1'0.  A quote after a letter that isn't part of a number, as in u8'a'
+# or case'{', starts a character literal.
+##############################################################################
+def is_digit_separator(data, pos):
+    if (pos == 0) or (data[pos - 1] not in PP_NUMBER_CHARS) or \
+            (data[pos + 1:pos + 2] not in PP_NUMBER_NEXT):
+        return False
+    start = pos
+    while (start > 0) and (data[start - 1] in PP_NUMBER_CHARS):
+        start -= 1
+    if (data[start:start + 1] == b"."):
+        start += 1
+    return (start < pos) and (data[start] in DIGITS)
+
+
+##############################################################################
+# Count the lines of source of a Language, given as bytes.
+#
+# One pass over the comments and literals splits the source into code and
+# comments.  Each keeps the other's newlines, so their lines line up with
+# the source lines, and the lines are counted in bulk with bytes methods.
+# The nesting is measured in the code outside literals.
+#
+# Each line is blank if it is only whitespace, a comment line if any part
+# of it is in a comment, and non-blank-non-comment if any part of it is
+# code, so a line of code with a trailing comment counts as both.  Strings
+# are code, and comment markers and braces inside them are ignored.
+# maxnest is the deepest nesting of the language's nest pair in code.
+#
+# Returns (lines, blanks, comments, nbnc, maxnest).
+##############################################################################
+def count_source(data, language=C):
+    lines = data.count(b"\n")
+    if data and (data[-1] != 0x0A):   # \n
+        lines += 1
+    nbnc = count_nonblank_lines(data)
+    blanks = lines - nbnc
     comments = 0
-    nbnc = 0
-    maxnest = 0
-    
-    multiline = False
+
+    code_parts = []      # code, with comments cut down to their newlines
+    comment_parts = []   # comments, with code cut down to its newlines
+    nest_parts = []      # code outside literals
+    code_end = 0         # end of the last comment
+    nest_end = 0         # end of the last comment or literal
+    for (comment, start, end) in find_lexemes(data, language):
+        nest_parts.append(data[nest_end:start])
+        nest_end = end
+        if comment:
+            code_parts.append(data[code_end:start])
+            code_parts.append(b"\n" * data.count(b"\n", start, end))
+            comment_parts.append(b"\n" * data.count(b"\n", code_end, start))
+            comment_parts.append(data[start:end])
+            code_end = end
+    nest_parts.append(data[nest_end:])
+
+    if comment_parts:
+        code_parts.append(data[code_end:])
+        comments = count_nonblank_lines(b"".join(comment_parts))
+        nbnc = count_nonblank_lines(b"".join(code_parts))
+
     nest = 0
-    
-    # Open the file for reading.  
+    maxnest = 0
+    if (language.nest is not None):
+        opening = language.nest[0]
+        for token in b"".join(nest_parts).translate(None, language.not_nest):
+            if (token == opening):
+                nest += 1
+                if (nest > maxnest):
+                    maxnest = nest
+            elif (nest > 0):
+                nest -= 1
+
+    return (lines, blanks, comments, nbnc, maxnest)
+
+
+##############################################################################
+# The Language of a file by its extension, or None if it isn't one counted.
+##############################################################################
+def file_language(path):
+    return EXTENSIONS.get(os.path.splitext(path)[1])
+
+
+##############################################################################
+# Parse a source file.
+# The file is read in one go as bytes, so files in encodings other than
+# UTF-8 are counted too.  Files of no known language are counted as C.
+##############################################################################
+def parse_source_file(file):
+
+    # Open the file for reading.
     # Note that no exception processing is implemented yet.
-    f = open(file, 'r')
-    
-    for line in f:
-        lines += 1
-        
-        # Remove quoted strings to avoid comment confusion.
-        m = quoted_re.search(line)
-        if m:
-            #sys.stdout.write("Q")
-            line = line.replace(m.group(1), "")
-            
-        # Blank line.
-        if blank_re.search(line):
-            #sys.stdout.write("A")
-            blanks += 1
-            continue
-        
-        # Finish parsing a C multi-line comment.
-        if multiline:
-            #sys.stdout.write("B")
-            comments += 1
-            if multi_end_re.search(line):
-                multiline = 0
-                
+    with open(file, "rb") as f:
+        data = f.read()
+    return count_source(data, file_language(file) or C)
+
+
+##############################################################################
+# Hash the contents of a file.
+##############################################################################
+def hash_file(path):
+    h = hashlib.blake2b()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(HASH_CHUNK)
+            if (len(data) == 0):
+                break
+            h.update(data)
+    return h.digest()
+
+
+##############################################################################
+# Cache of the counts of each file from earlier runs, kept in an SQLite
+# database.
+#
+# An entry is used while the file's size and mtime_ns are unchanged.  With
+# use_hash, the hash of the file's contents is kept as well, and a file
+# whose size and mtime_ns changed but whose contents didn't, as after a
+# fresh checkout, keeps its entry too.  close() evicts the entries of
+# files that no longer exist.  Files outside this run's paths or languages
+# keep theirs, so runs over different parts of a tree can share a cache.
+##############################################################################
+class ResultCache(object):
+
+    def __init__(self, path, use_hash=False):
+        self.use_hash = use_hash
+        self._seen = set()
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA synchronous = NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'format'").fetchone()
+        if (row is None) or (row[0] != CACHE_FORMAT):
+            self._db.execute("DROP TABLE IF EXISTS results")
+            self._db.execute("DROP TABLE IF EXISTS blobs")
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('format', ?)", (CACHE_FORMAT,))
+        self._db.execute("CREATE TABLE IF NOT EXISTS results ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest BLOB, "
+            "lines INTEGER, blanks INTEGER, comments INTEGER, nbnc INTEGER, "
+            "maxnest INTEGER) WITHOUT ROWID")
+        self._db.execute("CREATE TABLE IF NOT EXISTS blobs ("
+            "sha TEXT, language TEXT, lines INTEGER, blanks INTEGER, comments INTEGER, "
+            "nbnc INTEGER, maxnest INTEGER, PRIMARY KEY (sha, language)) WITHOUT ROWID")
+        self._db.commit()
+
+    # Look up the counts of a file.
+    # Returns (counts, key), where counts is None if the file has to be
+    # parsed, and key is what to pass to store() with its counts.
+    def lookup(self, path):
+        path = os.path.abspath(path)
+        self._seen.add(path)
+        st = os.stat(path)
+        key = (path, st.st_size, st.st_mtime_ns, None)
+        row = self._db.execute("SELECT size, mtime_ns, digest, lines, blanks, comments, "
+            "nbnc, maxnest FROM results WHERE path = ?", (path,)).fetchone()
+        if (row is not None) and (row[0] == st.st_size) and (row[1] == st.st_mtime_ns):
+            return (row[3:], None)
+
+        if self.use_hash:
+            key = (path, st.st_size, st.st_mtime_ns, hash_file(path))
+            if (row is not None) and (row[0] == st.st_size) and (row[2] == key[3]):
+                self.store(key, row[3:])
+                return (row[3:], None)
+        return (None, key)
+
+    # Store the counts of a file for the key returned by lookup().
+    def store(self, key, counts):
+        self._db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            key + tuple(counts))
+
+    # Look up the counts of a git blob counted as the named language, or
+    # None if they aren't cached.
+    def blob(self, sha, language):
+        row = self._db.execute("SELECT lines, blanks, comments, nbnc, maxnest FROM blobs "
+            "WHERE sha = ? AND language = ?", (sha, language)).fetchone()
+        return tuple(row) if (row is not None) else None
+
+    # Store the counts of a git blob counted as the named language.  A blob
+    # never changes, so its entry is never evicted.
+    def store_blob(self, sha, language, counts):
+        self._db.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (sha, language) + tuple(counts))
+
+    # Save the cache.  With evict, first evict the entries of files that
+    # no longer exist.  Only the files that weren't looked up need checking.
+    def close(self, evict=True):
+        if evict:
+            stale = []
+            for (path,) in self._db.execute("SELECT path FROM results"):
+                if (path not in self._seen) and not os.path.exists(path):
+                    stale.append((path,))
+            self._db.executemany("DELETE FROM results WHERE path = ?", stale)
+        self._db.commit()
+        self._db.close()
+
+
+##############################################################################
+# Translate a .gitignore pattern into a regular expression for the path of
+# a file relative to the directory of the ignore file.
+# A pattern with a slash other than at its end only matches relative to
+# that directory; one without matches a name at any depth below it.  * and
+# ? don't match a slash, and ** matches any number of directories.
+##############################################################################
+def ignore_pattern_re(pattern):
+    anchored = ("/" in pattern)
+    pattern = pattern.lstrip("/")
+    if pattern.startswith("**/"):
+        anchored = False
+        pattern = pattern[3:]
+
+    regex = ""
+    i = 0
+    n = len(pattern)
+    while (i < n):
+        c = pattern[i]
+        i += 1
+        if (c == "*"):
+            if pattern.startswith("*/", i):
+                regex += "(?:.*/)?"      # /**/
+                i += 2
+            elif (i == n - 1) and (pattern[i] == "*"):
+                regex += ".*"            # trailing /**
+                i += 1
+            else:
+                regex += "[^/]*"
+        elif (c == "?"):
+            regex += "[^/]"
+        elif (c == "["):
+            j = pattern.find("]", i + 1)
+            if (j < 0):
+                regex += "\\["
+            else:
+                chars = pattern[i:j]
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                regex += "[" + chars.replace("\\", "\\\\") + "]"
+                i = j + 1
+        elif (c == "\\") and (i < n):
+            regex += re.escape(pattern[i])
+            i += 1
         else:
-        
-            # Single line C comment with no code.
-            m = comment1_re.search(line)
-            if m:
-                #sys.stdout.write("C")
-                comments += 1
-                continue
-            
-            # Single line C++ comment with no code.
-            m = comment2_re.search(line)
-            if m:
-                #sys.stdout.write("D")
-                comments += 1
-                continue
-            
-            # nbnc with C single line comment.
-            m = source1_re.search(line)
-            if m:
-                #sys.stdout.write("E")
-                nbnc += 1
-                comments += 1
-                (nest, maxnest) = max_nest_level(m.group(1), nest, maxnest)
+            regex += re.escape(c)
+    if not anchored:
+        regex = "(?:.*/)?" + regex
+    return regex
+
+
+##############################################################################
+# The patterns of one .gitignore-style ignore file, or of --exclude.
+#
+# Lines are patterns as in .gitignore: blank lines and lines starting with
+# # are skipped, a pattern ending in a slash only matches directories, and
+# one starting with ! includes again what an earlier one excluded.  The
+# last pattern that matches a path decides.  Runs of patterns with the
+# same sign are combined into one regular expression, so a file of plain
+# exclusions costs one match per path.
+##############################################################################
+class IgnoreFile(object):
+
+    def __init__(self, base, patterns):
+        self.base = base         # directory relative to the root, "" or ending in /
+        self._groups = []        # (negate, regex for any path, regex for directories)
+        negate = False
+        any_res = []
+        dir_res = []
+        for line in patterns:
+            line = line.rstrip("\r\n")
+            if (line == "") or line.startswith("#"):
                 continue
-            
-            # nbnc with C++ single line comment.
-            m = source2_re.search(line)
-            if m:
-                #sys.stdout.write("F")
-                nbnc += 1
-                comments += 1
-                (nest, maxnest) = max_nest_level(m.group(1), nest, maxnest)
+            line = line.rstrip(" ")
+            is_negate = line.startswith("!")
+            if is_negate:
+                line = line[1:]
+            elif line.startswith("\\"):
+                line = line[1:] if (line[1:2] in ("!", "#")) else line
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if (line == ""):
                 continue
-            
-            # Look for start of multi-line C comment.
-            if multi_begin_re.search(line):
-                #sys.stdout.write("G")
-                multiline = 1
-                comments += 1
+            if (is_negate != negate) and (any_res or dir_res):
+                self._add_group(negate, any_res, dir_res)
+                any_res = []
+                dir_res = []
+            negate = is_negate
+            (dir_res if dir_only else any_res).append(ignore_pattern_re(line))
+        if any_res or dir_res:
+            self._add_group(negate, any_res, dir_res)
+
+    # Read an ignore file in the directory base.
+    # Returns None if the file doesn't exist or has no patterns.
+    @staticmethod
+    def read(path, base):
+        try:
+            with open(path, "r", errors="replace") as f:
+                ignore = IgnoreFile(base, f)
+        except OSError:
+            return None
+        return ignore if ignore._groups else None
+
+    # Decide whether a path relative to the root is ignored.
+    # Returns True or False if a pattern matches, None if none does.
+    def match(self, rel, is_dir):
+        rel = rel[len(self.base):]
+        for (negate, any_re, dir_re) in reversed(self._groups):
+            if ((any_re is not None) and any_re.fullmatch(rel)) or \
+                    (is_dir and (dir_re is not None) and dir_re.fullmatch(rel)):
+                return not negate
+        return None
+
+    def _add_group(self, negate, any_res, dir_res):
+        self._groups.append((negate, self._compile(any_res), self._compile(dir_res)))
+
+    @staticmethod
+    def _compile(patterns):
+        if (len(patterns) == 0):
+            return None
+        return re.compile("|".join("(?:" + p + ")" for p in patterns))
+
+
+##############################################################################
+# True if a path relative to the root is ignored by the ignore files that
+# apply to its directory, outermost first.
+##############################################################################
+def is_ignored(ignores, rel, is_dir):
+    for ignore in reversed(ignores):
+        ignored = ignore.match(rel, is_dir)
+        if (ignored is not None):
+            return ignored
+    return False
+
+
+##############################################################################
+# Find the source files under the roots, in os.walk() order.
+# Source files are those whose extension is in extensions.
+#
+# Each directory is listed once with os.scandir().  The .gitignore-style
+# IGNORE_FILES in each directory apply below it, on top of the excludes,
+# which apply to every root as if they were in an ignore file there.
+# Ignored directories are pruned without being listed.  A root that is a
+# file is returned as it is.
+##############################################################################
+def find_source_files(roots, excludes=(), extensions=EXTENSIONS):
+    top_ignores = [IgnoreFile("", list(DEFAULT_IGNORES) + list(excludes))]
+    for root in roots:
+        if not os.path.isdir(root):
+            yield root
+            continue
+
+        stack = [(root, "", top_ignores)]
+        while stack:
+            (path, rel, ignores) = stack.pop()
+            for name in IGNORE_FILES:
+                ignore = IgnoreFile.read(os.path.join(path, name), rel)
+                if (ignore is not None):
+                    ignores = ignores + [ignore]
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
                 continue
-                
-            # Everything else should be a stand alone non-blank-non-comment.
-            #sys.stdout.write("H")
-            nbnc += 1
-            (nest, maxnest) = max_nest_level(line, nest, maxnest)
-        
-    f.close()
-    
-    return (lines, blanks, comments, nbnc, maxnest) 
+
+            dirs = []
+            for entry in entries:
+                entry_rel = rel + entry.name
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    if not entry.is_symlink() and not is_ignored(ignores, entry_rel, True):
+                        dirs.append((entry.path, entry_rel + "/", ignores))
+                elif (os.path.splitext(entry.name)[1] in extensions) and \
+                        not is_ignored(ignores, entry_rel, False):
+                    yield entry.path
+            stack.extend(reversed(dirs))
+
+
+##############################################################################
+# Count the source files, yielding (file, counts) in the order given.
+# With more than one job the files are parsed in batches by a pool of
+# processes, but the results still come back in order as they finish.
+# With a ResultCache, only the files it doesn't have are parsed.
+#
+# files may be a generator, like the walk of a tree, and is read
+# CHUNK_SIZE files at a time: each chunk is looked up in the cache and its
+# files to parse queued before the results of the one before are returned,
+# so the pool keeps busy without the whole list of files in memory.
+##############################################################################
+def count_files(files, jobs=1, cache=None):
+    if (jobs <= 1) and (cache is None):
+        for file in files:
+            yield (file, parse_source_file(file))
+        return
+
+    files = iter(files)
+    pool = None
+    pending = None   # (entries, results) of the chunk being parsed
+    try:
+        while True:
+            entries = []
+            parse = []
+            for file in itertools.islice(files, CHUNK_SIZE):
+                (counts, key) = cache.lookup(file) if (cache is not None) else (None, None)
+                entries.append((file, counts, key))
+                if (counts is None):
+                    parse.append(file)
+
+            if (pool is None) and (jobs > 1) and (len(parse) > 1):
+                pool = multiprocessing.Pool(jobs)
+            if (pool is not None):
+                results = pool.imap(parse_source_file, parse, BATCH_SIZE)
+            else:
+                results = map(parse_source_file, parse)
+
+            if (pending is not None):
+                for item in finish_chunk(pending, cache):
+                    yield item
+            if not entries:
+                return
+            pending = (entries, results)
+    finally:
+        if (pool is not None):
+            pool.terminate()
+
+
+##############################################################################
+# Yield (file, counts) for a chunk of count_files(), taking the counts of
+# the files that weren't cached from its results in turn, and caching them.
+##############################################################################
+def finish_chunk(chunk, cache):
+    (entries, results) = chunk
+    for (file, counts, key) in entries:
+        if (counts is None):
+            counts = next(results)
+            if (cache is not None):
+                cache.store(key, counts)
+        yield (file, counts)
+
+
+##############################################################################
+# Error running git or reading from the repository.
+##############################################################################
+class GitError(Exception):
+    pass
+
+
+##############################################################################
+# Run a git command in the current directory and return its output.
+# Raises GitError if git can't be run or fails.
+##############################################################################
+def run_git(args):
+    try:
+        proc = subprocess.run(["git"] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as err:
+        raise GitError("Can't run git: " + str(err))
+    if (proc.returncode != 0):
+        raise GitError(proc.stderr.decode(errors="replace").strip())
+    return proc.stdout
+
+
+##############################################################################
+# True if an IgnoreFile ignores a path relative to its directory, or any
+# directory above it, as the walk would have pruned it.
+##############################################################################
+def path_ignored(ignore, path):
+    parts = path.split("/")
+    for i in range(1, len(parts)):
+        if ignore.match("/".join(parts[:i]), True):
+            return True
+    return bool(ignore.match(path, False))
+
+
+##############################################################################
+# Find the source files that differ between two git revisions.
+# Returns a list of (path, status, old sha, new sha) in git's order, with
+# None for the sha of a side the file doesn't exist in.  Submodules and
+# symbolic links count as not existing.
+##############################################################################
+def git_changed_files(old, new, pathspecs=(), excludes=(), extensions=EXTENSIONS):
+    ignore = IgnoreFile("", excludes)
+    out = run_git(["diff-tree", "-r", "-z", "--no-renames", old, new, "--"] + list(pathspecs))
+    fields = out.split(b"\0")
+    changed = []
+    for i in range(0, len(fields) - 1, 2):
+        (old_mode, new_mode, old_sha, new_sha, status) = fields[i].decode().lstrip(":").split(" ")
+        path = os.fsdecode(fields[i + 1])
+        if (os.path.splitext(path)[1] not in extensions) or path_ignored(ignore, path):
+            continue
+        old_sha = old_sha if old_mode.startswith("100") else None
+        new_sha = new_sha if new_mode.startswith("100") else None
+        if (old_sha != new_sha):
+            changed.append((path, status, old_sha, new_sha))
+    return changed
+
+
+##############################################################################
+# Reads blobs from the repository with one long-running git cat-file
+# --batch process, so there's no checkout and no process per blob.
+##############################################################################
+class BlobReader(object):
+
+    def __init__(self):
+        try:
+            self._proc = subprocess.Popen(["git", "cat-file", "--batch"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except OSError as err:
+            raise GitError("Can't run git: " + str(err))
+
+    # Return the contents of a blob.
+    def read(self, sha):
+        self._proc.stdin.write(sha.encode() + b"\n")
+        self._proc.stdin.flush()
+        header = self._proc.stdout.readline().split()
+        if (len(header) != 3) or (header[1] != b"blob"):
+            raise GitError("Can't read blob " + sha)
+        size = int(header[2])
+        data = self._proc.stdout.read(size + 1)   # and the newline after it
+        return data[:size]
+
+    def close(self):
+        self._proc.stdin.close()
+        self._proc.wait()
+
+
+##############################################################################
+# Count a blob's contents as the named language, for count_blobs().
+##############################################################################
+def count_blob(blob):
+    (data, language) = blob
+    return count_source(data, LANGUAGE_NAMES[language])
+
+
+##############################################################################
+# Count git blobs, given as (sha, Language), yielding their counts in the
+# order given.
+# A sha of None, for a file that doesn't exist on one side, counts as
+# empty.  Blobs in the ResultCache aren't read; the others are read in
+# order and, with more than one job, counted by a pool of processes.
+##############################################################################
+def count_blobs(blobs, jobs=1, cache=None):
+    cached = []
+    read = []
+    for (sha, language) in blobs:
+        counts = None
+        if (sha is None):
+            counts = (0, 0, 0, 0, 0)
+        elif (cache is not None):
+            counts = cache.blob(sha, language.name)
+        cached.append(counts)
+        if (counts is None):
+            read.append((sha, language.name))
+
+    reader = BlobReader() if read else None
+    pool = multiprocessing.Pool(jobs) if (jobs > 1) and (len(read) > 1) else None
+    try:
+        contents = ((reader.read(sha), language) for (sha, language) in read)
+        if (pool is not None):
+            results = pool.imap(count_blob, contents, BATCH_SIZE)
+        else:
+            results = map(count_blob, contents)
+        misses = iter(read)
+        for counts in cached:
+            if (counts is None):
+                counts = next(results)
+                if (cache is not None):
+                    cache.store_blob(*next(misses), counts)
+            yield counts
+    finally:
+        if (pool is not None):
+            pool.terminate()
+        if (reader is not None):
+            reader.close()
+
+
+##############################################################################
+# Print the change in the counts of the source files between two git
+# revisions, in CSV format.
+# Each row is a changed file with git's status letter and the new counts
+# minus the old.  The totals rows, for each language and for all of them,
+# add up the changes, except for maxnest, which is the change in the
+# deepest nesting of the changed files.
+# Returns the exit code.
+##############################################################################
+def print_git_diff(old, new, pathspecs, excludes, extensions, jobs, cache):
+    try:
+        changed = git_changed_files(old, new, pathspecs, excludes, extensions)
+    except GitError as err:
+        print(str(err))
+        return 1
+
+    languages = [file_language(c[0]) for c in changed]
+    old_blobs = [(c[2], lang) for (c, lang) in zip(changed, languages)]
+    new_blobs = [(c[3], lang) for (c, lang) in zip(changed, languages)]
+    totals = {}   # language name or None for all -> [4 deltas, old maxnest, new maxnest, files]
+
+    # Print a header line in CSV format.
+    print("file,status,lines,blanks,comments,non-blank-non-comment,maxnest")
+
+    try:
+        counts = count_blobs(old_blobs + new_blobs, jobs, cache)
+        old_counts = [next(counts) for c in changed]
+        for ((path, status, old_sha, new_sha), language, before) in \
+                zip(changed, languages, old_counts):
+            after = next(counts)
+            deltas = [a - b for (a, b) in zip(after, before)]
+            for name in (language.name, None):
+                total = totals.setdefault(name, [0, 0, 0, 0, 0, 0, 0])
+                for i in range(4):
+                    total[i] += deltas[i]
+                total[4] = max(total[4], before[4])
+                total[5] = max(total[5], after[4])
+                total[6] += 1
+            print(path + "," + status + "," + ",".join(str(d) for d in deltas))
+    except GitError as err:
+        print(str(err))
+        return 1
+
+    # Print totals, for each language and for all of them.
+    for language in LANGUAGES:
+        if (language.name in totals):
+            total = totals[language.name]
+            print("totals:" + language.name + ",," + ",".join(str(t) for t in total[:4]) +
+                "," + str(total[5] - total[4]))
+            print("files:" + language.name + "," + str(total[6]))
+    total = totals.get(None, [0, 0, 0, 0, 0, 0, 0])
+    print("totals,," + ",".join(str(t) for t in total[:4]) + "," + str(total[5] - total[4]))
+    print("files," + str(len(changed)))
+    return 0
+
+
+##############################################################################
+# Print usage syntax.
+##############################################################################
+def print_usage():
+    print("Usage:", sys.argv[0], "[-j <num>] [--cache=<file> [--cache-hash]]")
+    print("       [--exclude=<pattern> ...] [--lang=<list>] [<path> ...]")
+    print("   or:", sys.argv[0], "--diff=<old>..<new> [-j <num>] [--cache=<file>]")
+    print("       [--exclude=<pattern> ...] [--lang=<list>] [<path> ...]")
+    print("  Count the lines of the source files under each <path> (default = the")
+    print("  current directory) and print them in CSV format, with totals for each")
+    print("  language.  Files and directories matched by the .gitignore or")
+    print("  .codecountignore files in each directory are skipped, as are .git, .hg")
+    print("  and .svn")
+    print("  --cache=<file> Keep the counts of each file in <file> and only parse the")
+    print("            files that changed since the last run")
+    print("  --diff=<old>..<new> Print how the counts of the source files changed")
+    print("            between two revisions of the git repository in the current")
+    print("            directory, reading only the changed files from git.  <path>")
+    print("            limits it to those paths.  With --cache, the counts of each")
+    print("            file version are kept so other revisions can reuse them")
+    print("  --cache-hash With --cache, also keep a hash of each file, so files whose")
+    print("            contents didn't change are not parsed even if their time did")
+    print("  --exclude=<pattern> Skip files and directories matching the .gitignore")
+    print("            style <pattern> under each <path>; can be given more than once")
+    print("  -j <num> Parse files with <num> parallel processes (default = 1)")
+    print("  --lang=<list> Only count the comma separated languages: " +
+        ",".join(lang.name for lang in LANGUAGES))
+    sys.exit(2)
+
+
+##############################################################################
+# Run codecount with the given command line arguments.
+# Returns the exit code.
+##############################################################################
+def main(argv):
+
+    # Local initialization.
+    cache_file = None
+    cache_hash = False
+    diff       = None
+    excludes   = []
+    extensions = EXTENSIONS
+    jobs       = 1
+
+    # Get command line options and arguments.
+    try:
+        (opts, args) = getopt.getopt(argv, "j:", ["cache=", "cache-hash", "diff=",
+            "exclude=", "lang="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        print_usage()
+
+    for (o, a) in opts:
+        if (o == "--cache"):
+            cache_file = a
+        if (o == "--cache-hash"):
+            cache_hash = True
+        if (o == "--diff"):
+            diff = a.split("..")
+            if (len(diff) != 2) or (diff[0] == "") or (diff[1] == ""):
+                print("Invalid revisions '" + a + "'")
+                print_usage()
+        if (o == "--exclude"):
+            excludes.append(a)
+        if (o == "--lang"):
+            names = a.split(",")
+            for name in names:
+                if (name not in LANGUAGE_NAMES):
+                    print("Unknown language '" + name + "'")
+                    print_usage()
+            extensions = {ext: lang for (ext, lang) in EXTENSIONS.items() if (lang.name in names)}
+        if (o == "-j"):
+            try:
+                jobs = int(a)
+            except ValueError:
+                jobs = 0
+            if (jobs < 1):
+                print("Invalid number of processes '" + str(a) + "'")
+                print_usage()
+
+    if cache_hash and (cache_file is None):
+        print("--cache-hash requires --cache", file=sys.stderr)
+        print_usage()
+    if cache_hash and (diff is not None):
+        print("--cache-hash can't be combined with --diff", file=sys.stderr)
+        print_usage()
+
+    if (diff is not None):
+        cache = None
+        if (cache_file is not None):
+            try:
+                cache = ResultCache(cache_file)
+            except sqlite3.Error as err:
+                print("Can't open cache '" + cache_file + "': " + str(err))
+                return 1
+        status = print_git_diff(diff[0], diff[1], args, excludes, extensions, jobs, cache)
+        if (cache is not None):
+            cache.close(evict=False)
+        return status
+
+    roots = args if (len(args) > 0) else [os.getcwd()]
+    for root in roots:
+        if not os.path.exists(root):
+            print("Path '" + root + "' not found")
+            return 1
+
+    cache = None
+    if (cache_file is not None):
+        try:
+            cache = ResultCache(cache_file, cache_hash)
+        except sqlite3.Error as err:
+            print("Can't open cache '" + cache_file + "': " + str(err))
+            return 1
+
+    file_count = 0
+    (totalLines, totalBlanks, totalComments, totalNbnc, totalMaxnest) = (0, 0, 0, 0, 0)
+    language_totals = {}   # name -> [lines, blanks, comments, nbnc, maxnest, files]
+
+    # Print a header line in CSV format.
+    print("file,lines,blanks,comments,non-blank-non-comment,maxnest")
+
+    # Traverse the directory hierarchy looking for source files.
+    files = find_source_files(roots, excludes, extensions)
+    for (sourcefile, counts) in count_files(files, jobs, cache):
+        (lines, blanks, comments, nbnc, maxnest) = counts
+        file_count += 1
+        totalLines += lines
+        totalBlanks += blanks
+        totalComments += comments
+        totalNbnc += nbnc
+        if (maxnest > totalMaxnest):
+            totalMaxnest = maxnest
+
+        language = (file_language(sourcefile) or C).name
+        totals = language_totals.setdefault(language, [0, 0, 0, 0, 0, 0])
+        for i in range(4):
+            totals[i] += counts[i]
+        totals[4] = max(totals[4], maxnest)
+        totals[5] += 1
+
+        # Print the result in CSV format.
+        print(sourcefile + "," + str(lines) + "," + str(blanks) + "," +
+            str(comments) + "," + str(nbnc) + "," + str(maxnest))
+
+    # Print totals, for each language and for all of them.
+    for language in LANGUAGES:
+        if (language.name in language_totals):
+            totals = language_totals[language.name]
+            print("totals:" + language.name + "," + ",".join(str(t) for t in totals[:5]))
+            print("files:" + language.name + "," + str(totals[5]))
+    print("totals," + str(totalLines) + "," + str(totalBlanks) + "," + str(totalComments) +
+        "," + str(totalNbnc) + "," + str(totalMaxnest))
+
+    print("files," + str(file_count))
+    if (cache is not None):
+        cache.close()
+    return 0
 
 
 ##############################################################################
 # Script execution starts here.
-##############################################################################            
-
-# This is the expected file name format for C/C++/C# source files
-sourcefile_re = re.compile(".+\.(c$|cpp$|cs$|h$)")
-
-file_count = 0;
-(totalLines, totalBlanks, totalComments, totalNbnc, totalMaxnest) = (0, 0, 0, 0, 0)
-
-# Print a header line in CSV format.
-print("file,lines,blanks,comments,non-blank-non-comment,maxnest")
-
-# Traverse the directory hierarchy looking for source files.
-for root, dirs, files in os.walk(os.getcwd()):
-    for file in files:
-        if sourcefile_re.match(file):
-        
-            # Found a source file.
-            file_count += 1
-            sourcefile = os.path.join(root, file)
-            (lines, blanks, comments, nbnc, maxnest) = parse_source_file(sourcefile)
-            totalLines += lines
-            totalBlanks += blanks
-            totalComments += comments
-            totalNbnc += nbnc
-            if (maxnest > totalMaxnest):
-                totalMaxnest = maxnest
-            
-            # Print the result in CSV format.
-            print(sourcefile + "," + str(lines) + "," + str(blanks) + "," + 
-                str(comments) + "," + str(nbnc) + "," + str(maxnest))
-
-# Print totals.
-print("totals," + str(totalLines) + "," + str(totalBlanks) + "," + str(totalComments) +
-    "," + str(totalNbnc) + "," + str(totalMaxnest))
-    
-print("files," + str(file_count))
-
-# End of file
\ No newline at end of file
+##############################################################################
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+
+# End of file
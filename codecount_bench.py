@@ -0,0 +1,484 @@
+##############################################################################
+# codecount_bench.py
+# Accuracy and benchmark suite for codecount.py.
+#
+# Writes a corpus of C/C++/C# sources with known counts, checks that
+# codecount.py counts them right, times it, and writes the results as JSON
+# so runs from different commits can be compared.  The harness it shares
+# with backup_bench.py is in benchlib.py.
+#
+# Shapes (sizes at --scale=1):
+#   corpus - each case below in a file of its own, checked file by file
+#   huge   - one C file of 256 MiB, for the single file path
+#   tree   - 20,000 C/C++/C# files of about 8 KiB in 200 directories, and
+#            2,000 other files to skip, for the whole tree path
+#
+# The huge and tree files are made of the cases that can be repeated, so
+# their expected counts are the sums of the cases' counts, and the maxnest
+# of the deepest.  Throughput is measured on the median time less the time
+# codecount.py takes over an empty directory, so it isn't swamped by the
+# interpreter starting up.
+#
+# codecount.py is run in the generated directory with no arguments, which
+# every version of it counts, so older commits can be benchmarked too.
+# Generated files are kept in the work directory and reused by later runs
+# with the same scale and seed.
+#
+# Usage:
+# See print_usage() below.
+#
+# Modification History:
+# 10/16/2026 - Tom Kerr
+# Initial creation.
+##############################################################################
+
+import getopt
+import json
+import os.path
+import shutil
+import sys
+
+import benchlib
+
+# The corpus.  Each case is a file name, its source and its expected
+# (lines, blanks, comments, non-blank-non-comment, maxnest).  Cases that
+# don't end cleanly, as with an unterminated comment, can't be repeated.
+CASES = {
+    "string_comment_markers.c": {"counts": (8, 1, 0, 7, 1), "repeat": True, "source":
+        '#include <stdio.h>\n'
+        '\n'
+        'int main(void)\n'
+        '{\n'
+        '    printf("http://example.com/*not a comment*/\\n");\n'
+        '    puts("// still code");\n'
+        '    return 0;\n'
+        '}\n'},
+    "escaped_quotes.c": {"counts": (6, 0, 3, 6, 0), "repeat": True, "source":
+        'const char *a = "say \\"hi\\" // not a comment";\n'
+        'const char *b = "back\\\\";  // a comment\n'
+        'char c = \'"\';  /* a comment */\n'
+        'char d = \'\\\'\';\n'
+        'const char *e = "\\"/*";\n'
+        'int f = 1;  /* closes */\n'},
+    "nested_braces.cpp": {"counts": (10, 0, 1, 9, 4), "repeat": True, "source":
+        'namespace n {\n'
+        'class A {\n'
+        '    void f() {\n'
+        '        if (x) {\n'
+        '            const char *s = "{{{{";\n'
+        '            // }}}} {{{{\n'
+        '        }\n'
+        '    }\n'
+        '};\n'
+        '}\n'},
+    "comment_closes_mid_line.c": {"counts": (10, 1, 8, 4, 0), "repeat": True, "source":
+        'int a; /* starts here\n'
+        '   continues\n'
+        '   ends here */ int b;\n'
+        '/* one */ int c; /* two */\n'
+        '/* only a comment */\n'
+        '\n'
+        '/*\n'
+        ' * block\n'
+        ' */\n'
+        'int d;\n'},
+    "blank_lines_in_comment.h": {"counts": (6, 2, 3, 1, 0), "repeat": True, "source":
+        '/*\n'
+        '\n'
+        '   text after a blank line\n'
+        '\n'
+        '*/\n'
+        '#define X 1\n'},
+    "comment_markers_in_comments.c": {"counts": (4, 0, 3, 3, 0), "repeat": True, "source":
+        '// a line comment with /* inside\n'
+        'int x;\n'
+        '/* a block comment with // inside */ int y;\n'
+        '/* a block with /* another opener */ int z;\n'},
+    "line_continuation.c": {"counts": (3, 0, 2, 1, 0), "repeat": True, "source":
+        '// a comment continued \\\n'
+        '   onto this line\n'
+        'int x;\n'},
+    "even_backslash_continuation.c": {"counts": (4, 0, 3, 2, 0), "repeat": True, "source":
+        'int x; // path C:\\dir\\\\\n'
+        '   { still the comment\n'
+        '// a \\ b\n'
+        'int y;\n'},
+    "digit_separators.cpp": {"counts": (2, 0, 1, 2, 0), "repeat": True, "source":
+        'int n = 1\'000\'000; // a comment\n'
+        'int m = 0x1\'FF; char q = \'{\';\n'},
+    "crlf_whitespace.c": {"counts": (5, 2, 2, 2, 0), "repeat": True, "source":
+        'int a;\r\n'
+        '\t \r\n'
+        '// c\r\n'
+        'int b; // d\r\n'
+        ' \t\r\n'},
+    "crlf_continuation.c": {"counts": (3, 0, 2, 2, 0), "repeat": True, "source":
+        'int x; // a comment continued \\\r\n'
+        'onto this line\r\n'
+        'int y;\r\n'},
+    "u8_char_literal.cpp": {"counts": (2, 0, 1, 2, 1), "repeat": True, "source":
+        'int x = u8\'a\'; { // }\n'
+        '}\n'},
+    "hex_digit_separators.cpp": {"counts": (3, 0, 2, 3, 1), "repeat": True, "source":
+        'int m = 0xAB\'CD; // c\n'
+        'unsigned k = 0xFFFF\'FFFF; { }\n'
+        'switch (c) { case\'{\': break; } // c\n'},
+    "unterminated_string.c": {"counts": (2, 0, 1, 2, 0), "repeat": True, "source":
+        'char *s = "no closing quote;\n'
+        'int x; // comment\n'},
+    "verbatim_strings.cs": {"counts": (7, 0, 1, 7, 1), "repeat": True, "source":
+        'class P {\n'
+        '    string a = @"C:\\temp\\"; // a comment\n'
+        '    string b = @"line one\n'
+        '// not a comment\n'
+        '""quoted"" /* not a comment */";\n'
+        '    string c = "{";\n'
+        '}\n'},
+    "csharp_class.cs": {"counts": (12, 1, 4, 8, 3), "repeat": True, "source":
+        '/// <summary>A class.</summary>\n'
+        'namespace N\n'
+        '{\n'
+        '    class Q\n'
+        '    {\n'
+        '        int F() { return 1; } // one\n'
+        '\n'
+        '        /* two\n'
+        '           lines */\n'
+        '        string G() => "/* } */";\n'
+        '    }\n'
+        '}\n'},
+    "no_final_newline.h": {"counts": (2, 0, 1, 1, 0), "repeat": False, "source":
+        'int x;\n'
+        '/* last */'},
+    "unterminated_comment.c": {"counts": (3, 0, 2, 1, 0), "repeat": False, "source":
+        'int x;\n'
+        '/* runs to the end\n'
+        'of the file\n'},
+    "empty.c": {"counts": (0, 0, 0, 0, 0), "repeat": False, "source": ''},
+}
+
+# The language of each extension, whose cases can be mixed in one file.
+LANGUAGES = {".c": "c", ".h": "c", ".cpp": "c", ".cs": "csharp"}
+
+# Full size shapes.  Sizes are multiplied by --scale.
+SHAPES = {
+    "corpus": {"files": len(CASES), "dirs": 1,   "size": 0,       "others": 0},
+    "huge":   {"files": 1,          "dirs": 1,   "size": 1 << 28, "others": 0},
+    "tree":   {"files": 20000,      "dirs": 200, "size": 8192,    "others": 2000},
+}
+
+DEFAULT_SCALE  = 0.1
+DEFAULT_SEED   = 1
+BLOCK_SIZE     = 64 * 1024          # block of cases repeated for large files
+EXPECTED_FILE  = "expected.json"    # expected counts of a generated shape
+
+
+##############################################################################
+# Print usage syntax.
+##############################################################################
+def print_usage():
+    print("Usage:", sys.argv[0], "[-c <codecount.py>] [-w <dir>] [-o <file>] [-n <num>]")
+    print("       [--scale=<factor>] [--seed=<num>] [--shapes=<list>] [--args=<options>]")
+    print("   or:", sys.argv[0], "--compare [--threshold=<pct>] <old.json> <new.json>")
+    print("  Check codecount.py's counts of a corpus of sources with known counts, and")
+    print("  time it.  Exit 1 if any count is wrong")
+    print("  -c <codecount.py> Script to benchmark (default = codecount.py next to this one)")
+    print("  -n <num> Time each shape <num> times and report the median (default = 1)")
+    print("  -o <file> Write the results to <file> as JSON (default = stdout)")
+    print("  -w <dir> Work directory for the generated sources (default = a temporary")
+    print("            directory, deleted afterwards)")
+    print("  --args=<options> Extra codecount.py options for every run, e.g. \"-j 8\"")
+    print("  --compare Compare two results files, exit 1 if any median time grew")
+    print("            by more than --threshold percent (default = 10), or the new")
+    print("            one has failed runs or wrong counts")
+    print("  --scale=<factor> Multiply the shape sizes by <factor> (default = " + str(DEFAULT_SCALE) + ")")
+    print("  --seed=<num> Random seed for the order of the cases (default = " + str(DEFAULT_SEED) + ")")
+    print("  --shapes=<list> Comma separated shapes: " + ",".join(sorted(SHAPES)))
+    sys.exit(2)
+
+
+##############################################################################
+# Add the counts of a case to a running total.
+##############################################################################
+def add_counts(total, counts):
+    return [t + c for (t, c) in zip(total[:4], counts[:4])] + [max(total[4], counts[4])]
+
+
+##############################################################################
+# Make a block of about size bytes of randomly chosen repeatable cases of a
+# language.  Returns (source, counts).
+##############################################################################
+def make_block(language, size, rng):
+    names = sorted(name for (name, case) in CASES.items()
+        if case["repeat"] and (LANGUAGES[os.path.splitext(name)[1]] == language))
+    parts = []
+    length = 0
+    counts = [0, 0, 0, 0, 0]
+    while (length < size) or (len(parts) == 0):
+        case = CASES[rng.choice(names)]
+        parts.append(case["source"])
+        length += len(case["source"])
+        counts = add_counts(counts, case["counts"])
+    return ("".join(parts), counts)
+
+
+##############################################################################
+# Write a source file.  Sources are written as bytes, so line endings are
+# kept as they are in the cases.
+##############################################################################
+def write_source(path, source):
+    with open(path, "wb") as f:
+        f.write(source.encode())
+
+
+##############################################################################
+# Generate a shape's sources under root.
+# Returns the expected counts, as a dictionary of file paths relative to
+# root to their counts.
+##############################################################################
+def make_shape(name, root, scale, rng):
+    shape = SHAPES[name]
+    expected = {}
+
+    if (name == "corpus"):
+        for (file, case) in sorted(CASES.items()):
+            write_source(os.path.join(root, file), case["source"])
+            expected[file] = list(case["counts"])
+        return expected
+
+    if (name == "huge"):
+        # One block repeated, as generating every case afresh would take
+        # longer than counting them.
+        size = benchlib.scaled(shape["size"], scale, BLOCK_SIZE)
+        (block, counts) = make_block("c", BLOCK_SIZE, rng)
+        repeat = max(1, size // len(block))
+        with open(os.path.join(root, "huge.c"), "wb") as f:
+            data = block.encode()
+            for i in range(repeat):
+                f.write(data)
+        expected["huge.c"] = [c * repeat for c in counts[:4]] + [counts[4]]
+        return expected
+
+    # A tree of mixed sources spread two levels deep, with other files
+    # between them that codecount.py should skip.
+    nfiles = benchlib.scaled(shape["files"], scale)
+    ndirs = benchlib.scaled(shape["dirs"], scale)
+    nothers = benchlib.scaled(shape["others"], scale)
+    dirs = [os.path.join("g%02d" % (i % 16), "d%04d" % i) for i in range(ndirs)]
+    for d in dirs:
+        os.makedirs(os.path.join(root, d), exist_ok=True)
+    for i in range(nfiles):
+        ext = rng.choice(sorted(LANGUAGES))
+        file = os.path.join(dirs[i % ndirs], "f%06d%s" % (i, ext))
+        (source, counts) = make_block(LANGUAGES[ext], rng.randrange(shape["size"] * 2), rng)
+        write_source(os.path.join(root, file), source)
+        expected[file] = counts
+    for i in range(nothers):
+        ext = rng.choice((".txt", ".o", ".json", ".md"))
+        file = os.path.join(dirs[i % ndirs], "x%06d%s" % (i, ext))
+        write_source(os.path.join(root, file), "int x; /* not counted */\n" * 16)
+    return expected
+
+
+##############################################################################
+# Generate a shape's sources, reusing them if a previous run already did.
+# Returns (src, expected counts).
+##############################################################################
+def prepare_shape(name, work, scale, seed):
+    def make(base, rng):
+        os.makedirs(os.path.join(base, "src"))
+        expected = make_shape(name, os.path.join(base, "src"), scale, rng)
+        with open(os.path.join(base, EXPECTED_FILE), "w") as f:
+            json.dump(expected, f)
+
+    base = benchlib.generate(work, name, scale, seed, "sources", make)
+    with open(os.path.join(base, EXPECTED_FILE)) as f:
+        return (os.path.join(base, "src"), json.load(f))
+
+
+##############################################################################
+# Run codecount.py once in a directory.
+# Returns a dictionary with the elapsed time and the exit code, and the
+# output parsed into a dictionary of file paths relative to the directory to
+# their counts, with the overall totals under "totals" and the number of
+# files under "files".
+##############################################################################
+def run_codecount(codecount, options, src):
+    (run, proc) = benchlib.run_timed([sys.executable, codecount] + options, cwd=src)
+    counts = {}
+    for line in proc.stdout.decode(errors="replace").splitlines()[1:]:
+        fields = line.rsplit(",", 5)
+        try:
+            if (fields[0] == "files"):
+                counts["files"] = int(fields[1])
+            elif (len(fields) == 6) and (":" not in fields[0]):
+                # Per-language totals rows, like totals:c, aren't checked.
+                name = fields[0]
+                if (name != "totals"):
+                    name = os.path.relpath(name, src)
+                counts[name] = [int(f) for f in fields[1:]]
+        except ValueError:
+            pass
+    return (run, counts)
+
+
+##############################################################################
+# Check counts against the expected ones.
+# Returns a list of the mismatches, each a dictionary with the file, the
+# expected counts and the counts got.
+##############################################################################
+def check_counts(expected, counts):
+    failed = []
+    total = [0, 0, 0, 0, 0]
+    for (file, want) in sorted(expected.items()):
+        total = add_counts(total, want)
+        got = counts.get(file)
+        if (got != want):
+            failed.append({"file": file, "expected": want, "got": got})
+    if (counts.get("totals") != total):
+        failed.append({"file": "totals", "expected": total, "got": counts.get("totals")})
+    if (counts.get("files") != len(expected)):
+        failed.append({"file": "files", "expected": len(expected), "got": counts.get("files")})
+    return failed
+
+
+##############################################################################
+# Time codecount.py over an empty directory, to take its start up time out
+# of the throughput.
+##############################################################################
+def time_startup(codecount, options, work, repeat):
+    empty = os.path.join(work, "empty")
+    os.makedirs(empty, exist_ok=True)
+    runs = [run_codecount(codecount, options, empty)[0] for i in range(repeat)]
+    return benchlib.summarize(runs)["median"]
+
+
+##############################################################################
+# Time and check one shape.
+# Returns the shape's result dictionary.
+##############################################################################
+def run_shape(codecount, options, src, expected, repeat, startup):
+    size = 0
+    for file in expected:
+        size += os.path.getsize(os.path.join(src, file))
+    lines = sum(counts[0] for counts in expected.values())
+
+    runs = []
+    failed = []
+    for i in range(repeat):
+        (run, counts) = run_codecount(codecount, options, src)
+        runs.append(run)
+        if (i == 0):
+            failed = check_counts(expected, counts)
+
+    # Runs too short to time past the start up have no throughput.
+    result = {"files": len(expected), "bytes": size, "lines": lines, "runs": runs}
+    result.update(benchlib.summarize(runs))
+    net = result["median"] - startup
+    result["lines_per_sec"] = round(lines / net, 1) if (net > 0) else None
+    result["mb_per_sec"] = round(size / net / 1e6, 3) if (net > 0) else None
+    result["failed"] = failed
+    return result
+
+
+##############################################################################
+# Compare two results files.
+# Prints the median time, throughput and number of wrong counts of each
+# shape in both, and returns True if no time grew by more than threshold
+# percent and the new results have no failed runs or wrong counts.
+##############################################################################
+def compare(old_path, new_path, threshold):
+    columns = [("MB/s", "mb_per_sec"), ("bad", lambda result: len(result.get("failed", [])))]
+    return benchlib.compare(old_path, new_path, threshold, ["shape"], columns,
+        lambda result: "wrong counts" if result.get("failed") else None)
+
+
+##############################################################################
+# Script execution starts here.
+##############################################################################
+if __name__ == "__main__":
+
+    # Local initialization.
+    codecount    = os.path.join(os.path.dirname(os.path.abspath(__file__)), "codecount.py")
+    compare_mode = False
+    extra_args   = []
+    output       = None
+    repeat       = 1
+    scale        = DEFAULT_SCALE
+    seed         = DEFAULT_SEED
+    shapes       = sorted(SHAPES)
+    threshold    = 10.0
+    work         = None
+
+    # Get command line options and arguments.
+    try:
+        (opts, args) = getopt.getopt(sys.argv[1:], "c:n:o:w:", ["args=", "compare",
+            "scale=", "seed=", "shapes=", "threshold="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        print_usage()
+
+    try:
+        for (o, a) in opts:
+            if (o == "-c"):
+                codecount = a
+            if (o == "-n"):
+                repeat = int(a)
+            if (o == "-o"):
+                output = a
+            if (o == "-w"):
+                work = a
+            if (o == "--args"):
+                extra_args = a.split()
+            if (o == "--compare"):
+                compare_mode = True
+            if (o == "--scale"):
+                scale = float(a)
+            if (o == "--seed"):
+                seed = int(a)
+            if (o == "--shapes"):
+                shapes = a.split(",")
+            if (o == "--threshold"):
+                threshold = float(a)
+    except ValueError as err:
+        print(str(err))
+        print_usage()
+
+    if (compare_mode):
+        if (len(args) != 2):
+            print_usage()
+        sys.exit(0 if compare(args[0], args[1], threshold) else 1)
+
+    if (len(args) != 0) or (repeat < 1) or (scale <= 0):
+        print_usage()
+    for name in shapes:
+        if (name not in SHAPES):
+            print("Unknown shape '" + name + "'")
+            print_usage()
+    if not os.path.isfile(codecount):
+        print("codecount.py not found at '" + str(codecount) + "'")
+        sys.exit(1)
+    codecount = os.path.abspath(codecount)
+
+    (work, temp_work) = benchlib.make_work(work, "codecount-bench-")
+    results = benchlib.new_results(codecount, "codecount", scale, seed, repeat, extra_args)
+    try:
+        results["startup"] = time_startup(codecount, extra_args, work, repeat)
+        for name in shapes:
+            (src, expected) = prepare_shape(name, work, scale, seed)
+            print("Running " + name, file=sys.stderr)
+            results["results"][name] = run_shape(codecount, extra_args, src, expected,
+                repeat, results["startup"])
+            for failure in results["results"][name]["failed"]:
+                print(name + ": " + failure["file"] + " expected " + str(failure["expected"]) +
+                    ", got " + str(failure["got"]), file=sys.stderr)
+    finally:
+        if temp_work:
+            shutil.rmtree(work, ignore_errors=True)
+
+    benchlib.write_results(results, output)
+
+    failed = any(result["failed"] for result in results["results"].values())
+    sys.exit(1 if failed else 0)
+
+# End of file.